@@ -0,0 +1,169 @@
+import asyncio
+import contextlib
+import functools
+import heapq
+import itertools
+import math
+
+from aiohttp import web
+
+# Negotiations (SDP offer/answer plus connection setup) run at once; the rest queue
+MAX_NEGOTIATIONS = 8
+
+# Negotiations allowed to wait for a slot; beyond this, requests are turned away at once
+MAX_QUEUED = 256
+
+# Longest a negotiation waits for a slot, in seconds, before it is given up with a 503
+MAX_QUEUE_WAIT = 10.0
+
+# Per-user token bucket: sustained negotiations per second (0 disables the limit), and
+# the burst allowed on top, sized so a user joining a full room can subscribe to everyone at once
+USER_RATE = 2.0
+USER_BURST = 64
+
+# Queue priorities; lower runs first. Users finishing their setup (subscribing
+# to the peers of a room they already joined) go ahead of new joins.
+PRIORITY_SETUP = 0
+PRIORITY_JOIN = 1
+
+# How often idle per-user buckets are dropped, in seconds
+BUCKET_PRUNE_INTERVAL = 60.0
+
+# Weight of the latest negotiation in the running average used for Retry-After
+DURATION_SMOOTHING = 0.1
+
+
+class NegotiationScheduler:
+    """Admission control for SDP negotiation.
+
+    At most `concurrency` negotiations run at a time. Further requests wait
+    in a priority queue, FIFO within a priority. When the queue is full, or
+    a request has waited `max_wait` seconds, it fails fast with a 503 whose
+    Retry-After estimates when a slot will be free. Each user also has a
+    token bucket, and requests beyond it get a 429. During a reconnect storm
+    the loop therefore sets up a bounded number of connections that can
+    finish in time, instead of starting all of them and timing them all out.
+    """
+
+    def __init__(self, concurrency=MAX_NEGOTIATIONS, max_queued=MAX_QUEUED, max_wait=MAX_QUEUE_WAIT,
+                 rate=USER_RATE, burst=USER_BURST, wait_observer=None):
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.rate = rate
+        self.burst = burst
+        self.wait_observer = wait_observer # Called with each queued request's wait, in seconds
+        self.active = 0
+        self._queue = [] # Heap of (priority, sequence, future)
+        self._waiting = 0 # Queue entries still wanting a slot
+        self._sequence = itertools.count()
+        self._buckets = {} # username -> [tokens, last refill]
+        self._pruned = 0.0
+        self.duration = 0.0 # Smoothed seconds per negotiation
+        self.admitted = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.expired = 0
+        self.rate_limited = 0
+        self.wait_seconds_max = 0.0
+
+    def admit(self, priority):
+        """Decorate a negotiation coroutine taking `params` to run under the scheduler."""
+        def decorate(handler):
+            @functools.wraps(handler)
+            async def admitted(params):
+                async with self.slot(params.get('username'), priority):
+                    return await handler(params)
+            return admitted
+        return decorate
+
+    @contextlib.asynccontextmanager
+    async def slot(self, username, priority):
+        """Hold one negotiation slot for `username`, waiting for it by `priority`."""
+        loop = asyncio.get_running_loop()
+        if username and self.rate:
+            self._take_token(username, loop.time())
+        if self.active < self.concurrency and not self._waiting:
+            self.active += 1
+        else:
+            await self._wait(priority, loop)
+        self.admitted += 1
+        started = loop.time()
+        try:
+            yield
+        finally:
+            self.duration += DURATION_SMOOTHING * (loop.time() - started - self.duration)
+            self._release()
+
+    async def _wait(self, priority, loop):
+        if self._waiting >= self.max_queued:
+            self.rejected += 1
+            raise self._unavailable('Server is busy')
+        future = loop.create_future()
+        heapq.heappush(self._queue, (priority, next(self._sequence), future))
+        self._waiting += 1
+        self.delayed += 1
+        enqueued = loop.time()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done():
+                self._release() # The slot was handed over as we gave up; pass it on
+            else:
+                future.cancel()
+                self._waiting -= 1
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.expired += 1
+            raise self._unavailable('Timed out waiting to negotiate')
+        finally:
+            waited = loop.time() - enqueued
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+            if self.wait_observer is not None:
+                self.wait_observer(waited)
+
+    def _release(self):
+        """Free a slot, handing it straight to the highest-priority waiter."""
+        while self._queue:
+            future = heapq.heappop(self._queue)[2]
+            if not future.cancelled():
+                self._waiting -= 1
+                future.set_result(None) # The slot passes over; `active` is unchanged
+                return
+        self.active -= 1
+
+    def _take_token(self, username, now):
+        if now - self._pruned > BUCKET_PRUNE_INTERVAL:
+            self._pruned = now
+            self._buckets = {name: bucket for name, bucket in self._buckets.items()
+                             if bucket[0] + (now - bucket[1]) * self.rate < self.burst}
+        bucket = self._buckets.get(username)
+        if bucket is None:
+            bucket = self._buckets[username] = [self.burst, now]
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            self.rate_limited += 1
+            retry_after = max(math.ceil((1 - bucket[0]) / self.rate), 1)
+            raise web.HTTPTooManyRequests(headers={'Retry-After': str(retry_after)},
+                                          text=f"Too many negotiations from {username}")
+        bucket[0] -= 1
+
+    def _unavailable(self, reason):
+        # Time for the queue ahead to drain through every slot, at the recent pace
+        retry_after = max(math.ceil((self._waiting + 1) * self.duration / max(self.concurrency, 1)), 1)
+        return web.HTTPServiceUnavailable(headers={'Retry-After': str(retry_after)}, text=reason)
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'queued': self._waiting,
+            'concurrency': self.concurrency,
+            'admitted': self.admitted,
+            'delayed': self.delayed,
+            'rejected': self.rejected,
+            'expired': self.expired,
+            'rate_limited': self.rate_limited,
+            'negotiation_seconds': self.duration,
+            'wait_seconds_max': self.wait_seconds_max,
+        }
@@ -0,0 +1,128 @@
+import asyncio
+import gzip
+import hashlib
+import os
+import time
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None # Brotli variants are only built when the package is installed
+
+# How often a cached file's mtime is checked, in seconds, so a busy page does
+# not turn every request into a stat() call
+RELOAD_CHECK_INTERVAL = 1.0
+
+# The page revalidates on every load (a cheap 304); scripts and styles are not
+# fingerprinted, so they may only be reused for a short while without asking
+PAGE_CACHE_CONTROL = 'no-cache'
+ASSET_CACHE_CONTROL = 'public, max-age=300'
+
+# Content-Encoding -> (compress function, ETag suffix), in order of preference
+ENCODINGS = {'gzip': (lambda data: gzip.compress(data, 9, mtime=0), 'gz')}
+if brotli is not None:
+    ENCODINGS = dict({'br': (brotli.compress, 'br')}, **ENCODINGS)
+
+
+def accepted_encodings(header):
+    """Return the content codings named in an Accept-Encoding header, minus any with q=0."""
+    accepted = set()
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        params = params.replace(' ', '')
+        if coding and params not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(coding.lower())
+    return accepted
+
+
+class Asset:
+    """One file held in memory with its precompressed variants."""
+
+    def __init__(self, path, content_type, cache_control):
+        self.path = path
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.mtime = None
+        self.variants = {} # Content-Encoding ('identity', 'gzip', 'br') -> (body, etag)
+        self._checked = 0.0
+
+    def load(self):
+        """Read the file and rebuild every variant. Blocking; call off the event loop once serving."""
+        mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path, 'rb') as f:
+            body = f.read()
+        tag = hashlib.blake2b(body, digest_size=12).hexdigest()
+        variants = {'identity': (body, f'"{tag}"')}
+        for encoding, (compress, suffix) in ENCODINGS.items():
+            compressed = compress(body)
+            if len(compressed) < len(body):
+                variants[encoding] = (compressed, f'"{tag}-{suffix}"')
+        self.variants = variants
+        self.mtime = mtime
+
+    async def refresh(self):
+        """Reload the file if it changed on disk, checking at most once per interval."""
+        now = time.monotonic()
+        if now - self._checked < RELOAD_CHECK_INTERVAL:
+            return
+        self._checked = now
+        loop = asyncio.get_running_loop()
+        try:
+            mtime = (await loop.run_in_executor(None, os.stat, self.path)).st_mtime_ns
+        except OSError:
+            return # Keep serving the cached copy if the file is briefly missing
+        if mtime != self.mtime:
+            await loop.run_in_executor(None, self.load)
+
+    def select(self, accept_encoding):
+        """Return (encoding, body, etag) for the best variant the client accepts."""
+        accepted = accepted_encodings(accept_encoding)
+        for encoding in ENCODINGS:
+            if encoding in accepted and encoding in self.variants:
+                return (encoding,) + self.variants[encoding]
+        return ('identity',) + self.variants['identity']
+
+
+class AssetCache:
+    """Serves a fixed set of files from memory.
+
+    Each file is read once, compressed ahead of time, and served with an
+    ETag and Cache-Control header. Requests whose If-None-Match matches get
+    an empty 304. Files are re-read only after their mtime changes.
+    """
+
+    def __init__(self):
+        self.assets = {} # URL path -> Asset
+
+    def add(self, url, path, content_type, cache_control=ASSET_CACHE_CONTROL):
+        asset = self.assets[url] = Asset(str(path), content_type, cache_control)
+        asset.load()
+        return asset
+
+    def add_routes(self, router):
+        """Register a GET (and HEAD) route for every cached file."""
+        for url in self.assets:
+            router.add_get(url, self.handler)
+
+    async def handler(self, request):
+        asset = self.assets[request.path]
+        await asset.refresh()
+        encoding, body, etag = asset.select(request.headers.get('Accept-Encoding', ''))
+        headers = {
+            'ETag': etag,
+            'Cache-Control': asset.cache_control,
+            'Vary': 'Accept-Encoding',
+        }
+
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+            if '*' in tags or etag in tags:
+                return web.Response(status=304, headers=headers)
+
+        headers['Content-Type'] = asset.content_type
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return web.Response(body=body, headers=headers)
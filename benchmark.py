@@ -0,0 +1,435 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import ssl
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
+from aiortc.mediastreams import AudioStreamTrack
+
+# How long to wait for one client to join or for the server to settle, in seconds
+JOIN_TIMEOUT = 30.0
+SETTLE_TIMEOUT = 15.0
+
+# Metrics compared against a stored baseline: (result key, statistic, direction,
+# absolute slack). 'up' means higher is worse. The slack keeps tiny baseline
+# values from turning scheduling noise into a regression.
+BASELINE_METRICS = [
+    ('join_ms', 'p90', 'up', 25.0),
+    ('first_frame_ms', 'p90', 'up', 50.0),
+    ('video_fps', 'mean', 'down', 1.0),
+    ('cpu_percent_per_peer', None, 'up', 1.0),
+    ('rss_growth_mb', None, 'up', 5.0),
+]
+
+
+def run_server(port, pool_size, cert_file=None, key_file=None):
+    """Entry point of the benchmark's server process."""
+    import server
+
+    logging.getLogger().setLevel(logging.WARNING)
+    ssl_context = None
+    if cert_file:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(cert_file, key_file)
+    web.run_app(server.init_app(pool_size=pool_size), host='127.0.0.1', port=port,
+                ssl_context=ssl_context, print=None)
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of `values`, or None when there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q / 100 * len(ordered)) - 1, 0)]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+
+def split_candidates(sdp):
+    """Remove candidate lines from `sdp` and return them as trickle payloads.
+
+    aiortc gathers before it finishes setLocalDescription, so its offers
+    carry every candidate. Sending them separately instead exercises
+    /ice-candidate the way a browser does.
+    """
+    lines = []
+    candidates = []
+    mid = None
+    mline_index = -1
+    for line in sdp.splitlines():
+        if line.startswith('m='):
+            mline_index += 1
+            mid = None
+        elif line.startswith('a=mid:'):
+            mid = line[len('a=mid:'):]
+        if line.startswith('a=candidate:'):
+            candidates.append({'candidate': line[2:], 'sdpMid': mid, 'sdpMLineIndex': mline_index})
+        elif line != 'a=end-of-candidates':
+            lines.append(line)
+    # Candidates for a bundled transport repeat in every section; send them once
+    first_mid = candidates[0]['sdpMid'] if candidates else None
+    candidates = [c for c in candidates if c['sdpMid'] == first_mid]
+    return '\r\n'.join(lines) + '\r\n', candidates
+
+
+class SyntheticClient:
+    """A headless participant sending synthetic audio and video.
+
+    Joins through /offer like the browser client, then opens a receive-only
+    link to every other participant through /connect-peer and counts the
+    frames delivered on each.
+    """
+
+    def __init__(self, username, session, url):
+        self.username = username
+        self.session = session
+        self.url = url
+        self.connection = None
+        self.links = {} # target -> RTCPeerConnection
+        self.frames = {} # (target, kind) -> frames received
+        self.first_frame = {} # target -> seconds from /connect-peer to first video frame
+        self._readers = []
+
+    async def _post(self, path, payload):
+        async with self.session.post(self.url + path, json=payload) as response:
+            if response.status >= 400:
+                raise RuntimeError(f"{path} failed for {self.username}: {response.status} {await response.text()}")
+            return await response.json() if response.content_type == 'application/json' else None
+
+    async def _negotiate(self, pc, path, target, payload):
+        await pc.setLocalDescription(await pc.createOffer())
+        sdp, candidates = split_candidates(pc.localDescription.sdp)
+        # Trickled ahead of the offer, so the server has to hold them until it has a connection
+        await self._post('/ice-candidate', {'username': self.username, 'target': target, 'candidates': candidates})
+        answer = await self._post(path, dict(payload, username=self.username, sdp=sdp, type='offer'))
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=answer['sdp'], type=answer['type']))
+        return answer
+
+    async def join(self):
+        """Connect to the server; return the join latency in seconds and the other peers."""
+        started = time.perf_counter()
+        pc = self.connection = RTCPeerConnection()
+        connected = asyncio.get_running_loop().create_future()
+
+        @pc.on('connectionstatechange')
+        def on_state():
+            if pc.connectionState in ('connected', 'failed') and not connected.done():
+                connected.set_result(pc.connectionState)
+
+        pc.addTrack(VideoStreamTrack())
+        pc.addTrack(AudioStreamTrack())
+        answer = await self._negotiate(pc, '/offer', 'server', {})
+        if await asyncio.wait_for(connected, JOIN_TIMEOUT) != 'connected':
+            raise RuntimeError(f"{self.username} failed to connect")
+        return time.perf_counter() - started, answer.get('otherPeers', [])
+
+    async def subscribe(self, target):
+        """Open a receive-only link to `target`."""
+        started = time.perf_counter()
+        pc = self.links[target] = RTCPeerConnection()
+        pc.addTransceiver('video', direction='recvonly')
+        pc.addTransceiver('audio', direction='recvonly')
+
+        @pc.on('track')
+        def on_track(track):
+            self._readers.append(asyncio.ensure_future(self._count(target, track, started)))
+
+        await self._negotiate(pc, '/connect-peer', target, {'target': target})
+
+    async def _count(self, target, track, started):
+        key = (target, track.kind)
+        self.frames[key] = 0
+        while True:
+            try:
+                await track.recv()
+            except Exception:
+                return
+            if track.kind == 'video' and target not in self.first_frame:
+                self.first_frame[target] = time.perf_counter() - started
+            self.frames[key] += 1
+
+    async def close(self):
+        for reader in self._readers:
+            reader.cancel()
+        for pc in self.links.values():
+            await pc.close()
+        if self.connection is not None:
+            await self.connection.close()
+
+
+async def server_stats(session, url):
+    async with session.get(url + '/stats') as response:
+        return await response.json()
+
+
+async def wait_for_server(session, url, timeout=SETTLE_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return await server_stats(session, url)
+        except aiohttp.ClientError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def wait_for_idle(session, url, timeout=SETTLE_TIMEOUT):
+    """Wait until the server has torn every peer down; return its final stats."""
+    deadline = time.monotonic() + timeout
+    while True:
+        stats = await server_stats(session, url)
+        if (stats['peers'] == 0 and stats['links'] == 0) or time.monotonic() > deadline:
+            return stats
+        await asyncio.sleep(0.5)
+
+
+async def run_step(session, url, peers, duration, warmup, start_rss):
+    """Run `peers` clients in a full mesh and measure the server while they stream."""
+    clients = [SyntheticClient(f"bench{peers}-{i}", session, url) for i in range(peers)]
+    joins = await asyncio.gather(*(client.join() for client in clients), return_exceptions=True)
+    failures = [str(result) for result in joins if isinstance(result, Exception)]
+    joined = [client for client, result in zip(clients, joins) if not isinstance(result, Exception)]
+
+    subscriptions = [client.subscribe(other.username) for client in joined for other in joined if other is not client]
+    results = await asyncio.gather(*subscriptions, return_exceptions=True)
+    failures += [str(result) for result in results if isinstance(result, Exception)]
+
+    await asyncio.sleep(warmup)
+    before = await server_stats(session, url)
+    frames_before = [dict(client.frames) for client in joined]
+    await asyncio.sleep(duration)
+    after = await server_stats(session, url)
+
+    video_fps = []
+    audio_fps = []
+    for client, counted in zip(joined, frames_before):
+        for (target, kind), frames in client.frames.items():
+            rate = (frames - counted.get((target, kind), 0)) / duration
+            (video_fps if kind == 'video' else audio_fps).append(rate)
+
+    cpu = after['process']['cpu_seconds'] - before['process']['cpu_seconds']
+    for client in clients:
+        await client.close()
+    idle = await wait_for_idle(session, url)
+
+    mb = 1024 * 1024
+    return {
+        'peers': peers,
+        'joined': len(joined),
+        'links': after['links'],
+        'failures': failures,
+        'join_ms': summarize([result[0] * 1000 for result in joins if not isinstance(result, Exception)]),
+        'first_frame_ms': summarize([seconds * 1000 for client in joined for seconds in client.first_frame.values()]),
+        'video_fps': {'mean': sum(video_fps) / len(video_fps) if video_fps else 0.0, 'min': min(video_fps, default=0.0)},
+        'audio_fps': {'mean': sum(audio_fps) / len(audio_fps) if audio_fps else 0.0, 'min': min(audio_fps, default=0.0)},
+        'relay_frames_dropped': after['relay']['frames_dropped'] - before['relay']['frames_dropped'],
+        'cpu_percent_per_peer': 100 * cpu / duration / max(len(joined), 1),
+        'rss_mb': after['process']['rss_bytes'] / mb,
+        'rss_growth_mb': (after['process']['rss_bytes'] - start_rss) / mb,
+        'rss_retained_mb': (idle['process']['rss_bytes'] - start_rss) / mb, # Still held after everyone left
+    }
+
+
+async def run_soak(session, url, cycles, samples):
+    """Join and leave `cycles` times next to one resident peer, sampling server memory.
+
+    Each cycle joins a client, subscribes it to the resident peer and closes
+    it. Anything the server fails to reclaim shows up as growth between the
+    early and late samples.
+    """
+    resident = SyntheticClient('soak-resident', session, url)
+    await resident.join()
+    every = max(cycles // samples, 1)
+    failures = []
+    trace = []
+    started = time.perf_counter()
+    for cycle in range(cycles):
+        client = SyntheticClient(f"soak-{cycle}", session, url)
+        try:
+            await client.join()
+            await client.subscribe(resident.username)
+        except Exception as e:
+            failures.append(str(e))
+        await client.close()
+        if cycle % every == 0 or cycle == cycles - 1:
+            stats = await server_stats(session, url)
+            trace.append({'cycle': cycle, 'peers': stats['peers'], 'links': stats['links'],
+                          'rss_bytes': stats['process']['rss_bytes'], 'open_fds': stats['process']['open_fds']})
+    elapsed = time.perf_counter() - started
+    await resident.close()
+    idle = await wait_for_idle(session, url)
+
+    # The first tenth of the run warms up allocator pools and caches
+    settled = trace[len(trace) // 10:] or trace
+    mb = 1024 * 1024
+    return {
+        'cycles': cycles,
+        'cycles_per_second': cycles / elapsed,
+        'failures': failures,
+        'rss_start_mb': settled[0]['rss_bytes'] / mb,
+        'rss_end_mb': settled[-1]['rss_bytes'] / mb,
+        'rss_growth_mb': (settled[-1]['rss_bytes'] - settled[0]['rss_bytes']) / mb,
+        'open_fds_start': settled[0]['open_fds'],
+        'open_fds_end': settled[-1]['open_fds'],
+        'peers_left': idle['peers'],
+        'links_left': idle['links'],
+        'reaper': idle['reaper'],
+        'trace': trace,
+    }
+
+
+def print_soak_report(soak):
+    print(f"{soak['cycles']} join/leave cycles at {soak['cycles_per_second']:.1f}/s, {len(soak['failures'])} failed")
+    print(f"{'cycle':>7} {'peers':>5} {'links':>5} {'rss MB':>7} {'fds':>5}")
+    for sample in soak['trace']:
+        print(f"{sample['cycle']:>7} {sample['peers']:>5} {sample['links']:>5} "
+              f"{sample['rss_bytes'] / (1024 * 1024):>7.1f} {'-' if sample['open_fds'] is None else sample['open_fds']:>5}")
+    print(f"RSS {soak['rss_start_mb']:.1f} -> {soak['rss_end_mb']:.1f} MB after warm-up ({soak['rss_growth_mb']:+.1f} MB); "
+          f"open fds {soak['open_fds_start']} -> {soak['open_fds_end']}; "
+          f"{soak['peers_left']} peers and {soak['links_left']} links left; reaper {soak['reaper']['reclaimed']}")
+
+
+def metric_value(step, key, statistic):
+    value = step.get(key)
+    return value.get(statistic) if statistic else value
+
+
+def compare(results, baseline, tolerance):
+    """Return a description of every metric that regressed against `baseline`."""
+    regressions = []
+    baseline_steps = {step['peers']: step for step in baseline.get('steps', [])}
+    for step in results['steps']:
+        reference = baseline_steps.get(step['peers'])
+        if reference is None:
+            continue
+        for key, statistic, direction, slack in BASELINE_METRICS:
+            value = metric_value(step, key, statistic)
+            expected = metric_value(reference, key, statistic)
+            if value is None or expected is None:
+                continue
+            if direction == 'up':
+                limit = expected * (1 + tolerance) + slack
+                worse = value > limit
+            else:
+                limit = expected * (1 - tolerance) - slack
+                worse = value < limit
+            if worse:
+                name = f"{key}.{statistic}" if statistic else key
+                regressions.append(f"{step['peers']} peers: {name} {value:.1f} (baseline {expected:.1f}, limit {limit:.1f})")
+        if step['failures'] and not reference.get('failures'):
+            regressions.append(f"{step['peers']} peers: {len(step['failures'])} clients failed to connect")
+    return regressions
+
+
+def print_report(results):
+    header = f"{'peers':>5} {'links':>5} {'join p50/p90/p99 ms':>22} {'1st frame p90':>13} {'video fps':>10} {'cpu%/peer':>9} {'rss MB':>7} {'growth':>7} {'retained':>8}"
+    print(header)
+    for step in results['steps']:
+        join = step['join_ms']
+        join_text = '/'.join('-' if join[q] is None else f"{join[q]:.0f}" for q in ('p50', 'p90', 'p99'))
+        first = step['first_frame_ms']['p90']
+        print(f"{step['peers']:>5} {step['links']:>5} {join_text:>22} {'-' if first is None else f'{first:.0f}':>13} "
+              f"{step['video_fps']['mean']:>10.1f} {step['cpu_percent_per_peer']:>9.1f} {step['rss_mb']:>7.1f} "
+              f"{step['rss_growth_mb']:>7.1f} {step['rss_retained_mb']:>8.1f}")
+        for failure in step['failures']:
+            print(f"      failed: {failure}")
+
+
+async def run_benchmark(url, peer_counts, duration, warmup, use_tls, soak_cycles=0, soak_samples=20):
+    connector = aiohttp.TCPConnector(ssl=False) if use_tls else None # Self-signed certificate
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = await wait_for_server(session, url)
+        if soak_cycles:
+            return {'url': url, 'soak': await run_soak(session, url, soak_cycles, soak_samples)}
+        start_rss = start['process']['rss_bytes']
+        steps = []
+        for peers in peer_counts:
+            steps.append(await run_step(session, url, peers, duration, warmup, start_rss))
+            print(f"Finished {peers} peers", file=sys.stderr)
+    return {'url': url, 'duration': duration, 'steps': steps}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test server.py with synthetic aiortc clients')
+    parser.add_argument('--peers', type=int, nargs='+', default=[2, 4, 8],
+                        help='Participant counts to run, each as a full mesh (default: 2 4 8)')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds to measure each step')
+    parser.add_argument('--warmup', type=float, default=3.0, help='Seconds to let media settle before measuring')
+    parser.add_argument('--port', type=int, default=8765, help='Localhost port for the server under test')
+    parser.add_argument('--https', action='store_true', help='Serve over TLS with a throwaway self-signed certificate')
+    parser.add_argument('--pool-size', type=int, default=0, help='Passed to init_app()')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', help='Fail if results regress against this stored results file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed relative regression against the baseline (default: 0.25)')
+    parser.add_argument('--soak', type=int, default=0, metavar='CYCLES',
+                        help='Instead of the mesh steps, run this many join/leave cycles and track server memory')
+    parser.add_argument('--soak-samples', type=int, default=20, help='Memory samples taken during a soak run')
+    parser.add_argument('--soak-limit', type=float,
+                        help='Fail if server RSS grows by more than this many MB during a soak run')
+    args = parser.parse_args()
+
+    cert_dir = tempfile.TemporaryDirectory()
+    cert_file = key_file = None
+    if args.https:
+        from generate_cert import generate_self_signed_cert
+        cert_file = str(Path(cert_dir.name) / 'cert.pem')
+        key_file = str(Path(cert_dir.name) / 'key.pem')
+        generate_self_signed_cert(cert_file, key_file)
+
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=run_server, args=(args.port, args.pool_size, cert_file, key_file), daemon=True)
+    process.start()
+    url = f"{'https' if args.https else 'http'}://127.0.0.1:{args.port}"
+    try:
+        results = asyncio.run(run_benchmark(url, args.peers, args.duration, args.warmup, args.https,
+                                            args.soak, args.soak_samples))
+    finally:
+        process.terminate()
+        process.join()
+        cert_dir.cleanup()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.soak:
+        soak = results['soak']
+        print_soak_report(soak)
+        if args.soak_limit is not None and soak['rss_growth_mb'] > args.soak_limit:
+            print(f"REGRESSION RSS grew {soak['rss_growth_mb']:.1f} MB (limit {args.soak_limit:.1f})")
+            sys.exit(1)
+        return
+
+    print_report(results)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main()
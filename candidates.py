@@ -0,0 +1,85 @@
+import collections
+import math
+import time
+
+# How long candidates wait for their connection before being discarded
+CANDIDATE_TTL = 30.0
+
+# Upper bound on candidates held for a single (username, target) pair
+MAX_PENDING_PER_PAIR = 64
+
+# Upper bound on pairs with queued candidates; candidates for further pairs are refused
+MAX_PENDING_PAIRS = 4096
+
+
+class PendingCandidates:
+    """Holds ICE candidates that arrive before their connection can use them.
+
+    Browsers start trickling candidates as soon as they set their local
+    description, which is usually before the server has registered the
+    matching RTCPeerConnection or applied the remote description. Candidates
+    are queued per (username, target) pair and handed back in one batch once
+    the connection is ready. Entries expire `ttl` seconds after the first
+    candidate was queued; expiry is swept lazily in insertion order. At most
+    `max_pairs` pairs are held at once, so made-up usernames cannot grow the
+    queue without bound.
+    """
+
+    def __init__(self, ttl=CANDIDATE_TTL, limit=MAX_PENDING_PER_PAIR, max_pairs=MAX_PENDING_PAIRS):
+        self.ttl = ttl
+        self.limit = limit
+        self.max_pairs = max_pairs
+        self._pending = {} # key -> (deadline, [RTCIceCandidate])
+        self._deadlines = collections.deque() # (deadline, key), oldest first
+        self.queued = 0
+        self.expired = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, key, candidates):
+        """Queue `candidates` for `key`; return how many were accepted, or None if full."""
+        now = time.monotonic()
+        self._expire(now)
+        entry = self._pending.get(key)
+        if entry is None:
+            if len(self._pending) >= self.max_pairs:
+                self.dropped += len(candidates)
+                return None
+            entry = self._pending[key] = (now + self.ttl, [])
+            self._deadlines.append((entry[0], key))
+        room = self.limit - len(entry[1])
+        accepted = candidates[:max(room, 0)]
+        entry[1].extend(accepted)
+        self.queued += len(accepted)
+        self.dropped += len(candidates) - len(accepted)
+        return len(accepted)
+
+    def pop(self, key):
+        """Remove and return every live candidate queued for `key`."""
+        self._expire(time.monotonic())
+        entry = self._pending.pop(key, None)
+        return entry[1] if entry else []
+
+    def retry_after(self):
+        """Return whole seconds until the oldest pair expires and makes room."""
+        if not self._deadlines:
+            return 1
+        return max(math.ceil(self._deadlines[0][0] - time.monotonic()), 1)
+
+    def _expire(self, now):
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, key = self._deadlines.popleft()
+            entry = self._pending.get(key)
+            if entry is not None and entry[0] == deadline:
+                del self._pending[key]
+                self.expired += len(entry[1])
+
+    def stats(self):
+        return {
+            'pairs': len(self._pending),
+            'queued': self.queued,
+            'expired': self.expired,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,238 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+import sqlite3
+import time
+
+import aiohttp
+from aiohttp import web
+
+from workers import ShardLink, relayed_headers
+
+# A node that has not refreshed its heartbeat for this long, in seconds, is
+# considered gone; its users are ignored until another node takes them over
+NODE_TTL = 15.0
+
+# Internal routes require this header when the cluster is given a token
+CLUSTER_TOKEN_HEADER = 'X-Cluster-Token'
+
+# Set on signaling requests forwarded to an owning node, so they are never forwarded again
+FORWARDED_HEADER = 'X-Forwarded-Node'
+
+
+class MemoryDirectory:
+    """A session directory held in this process.
+
+    Records which node owns each user, the user's room and the kinds of
+    tracks it sends. Only nodes in the same process can share it, so it
+    serves single-node setups and tests; SqliteDirectory is the shared one.
+    """
+
+    def __init__(self, ttl=NODE_TTL):
+        self.ttl = ttl
+        self._nodes = {} # node -> last heartbeat (wall clock)
+        self._sessions = {} # username -> {'node', 'room', 'kinds', 'registered'}
+
+    def _live(self, entry, now):
+        return now - self._nodes.get(entry['node'], 0.0) <= self.ttl
+
+    async def heartbeat(self, node):
+        self._nodes[node] = time.time()
+
+    async def is_live(self, node):
+        """Return whether `node` is listed with a fresh heartbeat."""
+        return time.time() - self._nodes.get(node, 0.0) <= self.ttl
+
+    async def register(self, username, node, room, kinds):
+        """Record `node` as the owner of `username`, replacing any previous owner."""
+        self._sessions[username] = {'node': node, 'room': room, 'kinds': list(kinds), 'registered': time.time()}
+
+    async def unregister(self, username, node):
+        """Forget `username` if `node` still owns it."""
+        entry = self._sessions.get(username)
+        if entry is not None and entry['node'] == node:
+            del self._sessions[username]
+
+    async def lookup(self, username):
+        """Return the entry for `username` if its node is alive, else None."""
+        entry = self._sessions.get(username)
+        if entry is None or not self._live(entry, time.time()):
+            return None
+        return dict(entry, username=username)
+
+    async def members(self, rooms):
+        """Return the live entries of every user in `rooms`, keyed by username."""
+        now = time.time()
+        return {username: dict(entry, username=username) for username, entry in self._sessions.items()
+                if entry['room'] in rooms and self._live(entry, now)}
+
+    async def remove_node(self, node):
+        """Forget a node and every user it owns."""
+        self._nodes.pop(node, None)
+        self._sessions = {username: entry for username, entry in self._sessions.items() if entry['node'] != node}
+
+    async def close(self):
+        pass
+
+
+class SqliteDirectory(MemoryDirectory):
+    """A session directory in an SQLite file shared by nodes on one host.
+
+    A stand-in for a networked store: every call is one short transaction,
+    run on a private thread so the event loop never waits on the file lock.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS nodes (node TEXT PRIMARY KEY, heartbeat REAL NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS sessions (username TEXT PRIMARY KEY, node TEXT NOT NULL, '
+        'room TEXT NOT NULL, kinds TEXT NOT NULL, registered REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS sessions_room ON sessions (room)',
+    )
+
+    LIVE_SESSIONS = ('SELECT s.username, s.node, s.room, s.kinds, s.registered FROM sessions s '
+                     'JOIN nodes n ON n.node = s.node WHERE n.heartbeat >= ?')
+
+    def __init__(self, path, ttl=NODE_TTL):
+        super().__init__(ttl)
+        self.path = path
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='directory')
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            for statement in self.SCHEMA:
+                self._db.execute(statement)
+        return self._db
+
+    async def _run(self, sql, args=()):
+        def run():
+            return self._connect().execute(sql, args).fetchall()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, run)
+
+    @staticmethod
+    def _entry(row):
+        username, node, room, kinds, registered = row
+        return {'username': username, 'node': node, 'room': room, 'kinds': json.loads(kinds), 'registered': registered}
+
+    async def heartbeat(self, node):
+        await self._run('INSERT INTO nodes VALUES (?, ?) ON CONFLICT (node) DO UPDATE SET heartbeat = excluded.heartbeat',
+                        (node, time.time()))
+
+    async def is_live(self, node):
+        rows = await self._run('SELECT 1 FROM nodes WHERE node = ? AND heartbeat >= ?', (node, time.time() - self.ttl))
+        return bool(rows)
+
+    async def register(self, username, node, room, kinds):
+        await self._run('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)',
+                        (username, node, room, json.dumps(list(kinds)), time.time()))
+
+    async def unregister(self, username, node):
+        await self._run('DELETE FROM sessions WHERE username = ? AND node = ?', (username, node))
+
+    async def lookup(self, username):
+        rows = await self._run(self.LIVE_SESSIONS + ' AND s.username = ?', (time.time() - self.ttl, username))
+        return self._entry(rows[0]) if rows else None
+
+    async def members(self, rooms):
+        rooms = list(rooms)
+        if not rooms:
+            return {}
+        placeholders = ', '.join('?' * len(rooms))
+        rows = await self._run(self.LIVE_SESSIONS + f' AND s.room IN ({placeholders})', [time.time() - self.ttl] + rooms)
+        return {row[0]: self._entry(row) for row in rows}
+
+    async def remove_node(self, node):
+        await self._run('DELETE FROM sessions WHERE node = ?', (node,))
+        await self._run('DELETE FROM nodes WHERE node = ?', (node,))
+
+    async def close(self):
+        def close():
+            if self._db is not None:
+                self._db.close()
+        await asyncio.get_running_loop().run_in_executor(self.executor, close)
+        self.executor.shutdown(wait=False)
+
+
+class NodeLink(ShardLink):
+    """A node's view of the other server nodes sharing a session directory.
+
+    Local joins and leaves are written to the directory. The rosters of rooms
+    with local users are pulled from it by poll(), and users owned by other
+    nodes are cascaded from their owner exactly as ShardLink does between
+    workers. Nodes are named by the base URL the others reach them at.
+    """
+
+    def __init__(self, node_url, directory, relay, token=None):
+        super().__init__(node_url, [], None, relay)
+        self.directory = directory
+        self.token = token
+        self._registered = {} # remote username -> directory registration time
+
+    @property
+    def session(self):
+        if self._session is None:
+            headers = {CLUSTER_TOKEN_HEADER: self.token} if self.token else None
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False), headers=headers)
+        return self._session
+
+    def owner_url(self, owner):
+        return owner['worker']
+
+    async def publish(self, event, username, room, kinds=()):
+        """Record a local join/leave in the directory."""
+        if event == 'joined':
+            await self.directory.register(username, self.index, room, kinds)
+        else:
+            await self.directory.unregister(username, self.index)
+
+    async def owner_of(self, username):
+        """Return the URL of the live node owning `username`, or None."""
+        entry = await self.directory.lookup(username)
+        return entry['node'] if entry is not None else None
+
+    async def poll(self, rooms, complete=False):
+        """Return presence messages bringing the remote users of `rooms` up to date.
+
+        With `complete`, `rooms` is every room with local users, and remote
+        users of any other room are dropped as well.
+        """
+        await self.directory.heartbeat(self.index)
+        entries = await self.directory.members(rooms)
+        messages = []
+        for username, entry in entries.items():
+            if entry['node'] == self.index or self._registered.get(username) == entry['registered']:
+                continue
+            self._registered[username] = entry['registered'] # New, or re-offered since the last poll
+            messages.append({'event': 'joined', 'username': username, 'room': entry['room'],
+                             'worker': entry['node'], 'kinds': entry['kinds']})
+        for username, owner in list(self.remote_peers.items()):
+            if username not in entries and (complete or owner['room'] in rooms):
+                self._registered.pop(username, None)
+                messages.append({'event': 'left', 'username': username, 'worker': owner['worker']})
+        return messages
+
+    async def _open_cascade(self, username):
+        # Only ever offer to a node the directory lists, never to a URL taken on trust
+        node = self.remote_peers[username]['worker']
+        if not await self.directory.is_live(node):
+            raise web.HTTPBadGateway(text=f"{node} is not a live cluster node")
+        return await super()._open_cascade(username)
+
+    async def forward(self, owner, path, body):
+        """Relay a signaling request to the node that owns its user."""
+        headers = {'Content-Type': 'application/json', FORWARDED_HEADER: self.index}
+        try:
+            async with self.session.post(owner + path, data=body, headers=headers) as resp:
+                return web.Response(status=resp.status, body=await resp.read(),
+                                    headers=relayed_headers(resp))
+        except aiohttp.ClientError as e:
+            logging.error("Node %s unreachable: %s", owner, e)
+            raise web.HTTPBadGateway(text='Owning node unavailable')
+
+    async def close(self):
+        await self.directory.remove_node(self.index)
+        await super().close()
+        await self.directory.close()
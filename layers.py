@@ -0,0 +1,121 @@
+import asyncio
+import logging
+
+# Simulcast layer names a client may declare on /offer, best quality first
+LAYER_NAMES = ('high', 'medium', 'low')
+
+# How often each subscriber's feedback is sampled, in seconds
+CHECK_INTERVAL = 2.0
+
+# Step down a layer when the subscriber reports this much loss (0-1) or RTT (s)
+DOWNGRADE_LOSS = 0.10
+DOWNGRADE_RTT = 0.5
+
+# Step up only after this many consecutive checks below UPGRADE_LOSS
+UPGRADE_LOSS = 0.02
+UPGRADE_AFTER = 3
+
+# Receiver-estimated bandwidth (REMB) needed to stay on a layer, in bps
+LAYER_BITRATES = {'high': 400000, 'medium': 250000, 'low': 0}
+
+
+def order_layers(layers):
+    """Return [(name, track)] for the declared layers, best quality first."""
+    return [(name, layers[name]) for name in LAYER_NAMES if name in layers]
+
+
+def sender_feedback(report, sender):
+    """Extract (loss fraction, round-trip time, REMB bitrate) for `sender`.
+
+    Loss and RTT come from the subscriber's RTCP receiver reports. aiortc
+    applies REMB straight to the sender's encoder without exposing it, so the
+    estimate is read back from the encoder when there is one.
+    """
+    loss = rtt = None
+    for stats in report.values():
+        if stats.type == 'remote-inbound-rtp':
+            loss = stats.fractionLost / 256 # RTCP carries an 8-bit fixed point fraction
+            rtt = stats.roundTripTime
+    encoder = getattr(sender, '_RTCRtpSender__encoder', None)
+    bitrate = getattr(encoder, 'target_bitrate', None)
+    return loss, rtt, bitrate
+
+
+class LayerSelector:
+    """Chooses which simulcast layer one subscriber receives.
+
+    Each subscriber has its own sender and encoder, so switching layers for a
+    subscriber on a poor link never affects the rest of the room. Switching
+    re-points the sender's relay subscription at another layer; the change in
+    resolution makes the subscriber's encoder restart on a keyframe.
+    """
+
+    def __init__(self, layers, relay, label):
+        self.sender = None
+        self.track = None
+        self.layers = order_layers(layers)
+        self.relay = relay
+        self.label = label
+        self.index = len(self.layers) - 1 # Start on the cheapest layer and probe upwards
+        self.switches = 0
+        self._good_checks = 0
+        self._task = None
+
+    @property
+    def layer(self):
+        return self.layers[self.index][0]
+
+    def attach(self, pc):
+        """Add the starting layer to `pc` and remember the sender carrying it."""
+        self.track = self.relay.subscribe(self.layers[self.index][1])
+        self.sender = pc.addTrack(self.track)
+        return self.sender
+
+    def start(self):
+        if len(self.layers) > 1:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def decide(self, loss, rtt, bitrate):
+        """Return the layer index to use given the latest feedback."""
+        name = self.layer
+        congested = ((loss is not None and loss > DOWNGRADE_LOSS)
+                     or (rtt is not None and rtt > DOWNGRADE_RTT)
+                     or (bitrate is not None and bitrate < LAYER_BITRATES[name]))
+        if congested:
+            self._good_checks = 0
+            return min(self.index + 1, len(self.layers) - 1)
+
+        if loss is not None and loss < UPGRADE_LOSS:
+            self._good_checks += 1
+        else:
+            self._good_checks = 0
+        if self._good_checks >= UPGRADE_AFTER and self.index > 0:
+            better = self.layers[self.index - 1][0]
+            if bitrate is None or bitrate >= LAYER_BITRATES[better]:
+                self._good_checks = 0
+                return self.index - 1
+        return self.index
+
+    def switch(self, index):
+        self.index = index
+        self.relay.resubscribe(self.track, self.layers[index][1])
+        self.switches += 1
+        logging.info("Switched %s to %s layer", self.label, self.layer)
+
+    async def _run(self):
+        try:
+            while True:
+                await asyncio.sleep(CHECK_INTERVAL)
+                if self.track.readyState != "live":
+                    return
+                index = self.decide(*sender_feedback(await self.sender.getStats(), self.sender))
+                if index != self.index:
+                    self.switch(index)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.error("Layer selection for %s stopped: %s", self.label, e)
@@ -0,0 +1,99 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+
+# Same layout logging.basicConfig() uses, so text output looks as it always has
+TEXT_FORMAT = '%(levelname)s:%(name)s:%(message)s'
+
+# Per-candidate signaling logs go to this logger so they can be sampled on their own
+CANDIDATE_LOGGER = 'signaling.candidates'
+
+# Attributes every LogRecord has; anything else was passed through `extra=`
+RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format each record as a single-line JSON object.
+
+    Fields passed with `extra=` are emitted alongside the standard ones, so
+    call sites can attach usernames and counts without baking them into the
+    message text.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SampleFilter(logging.Filter):
+    """Let through one record in every `every`.
+
+    Passed records carry a `sampled` field with the number of records they
+    stand for, so totals can still be recovered from the log.
+    """
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self._skipped = 0
+
+    def filter(self, record):
+        if self._skipped + 1 < self.every:
+            self._skipped += 1
+            return False
+        record.sampled = self._skipped + 1
+        self._skipped = 0
+        return True
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """Hand records to the listener thread untouched.
+
+    The stock QueueHandler merges the message arguments before enqueueing so
+    records can cross process boundaries. The queue here never leaves the
+    process, so all formatting is left to the listener thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level='INFO', json_format=False, candidate_sample=1):
+    """Route all logging through a background thread; return its QueueListener.
+
+    The event loop only appends records to an in-memory queue. Formatting and
+    writing to stderr happen on the listener's thread. Records below `level`
+    are discarded before any arguments are formatted.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(LocalQueueHandler(log_queue))
+    root.setLevel(level)
+
+    candidates = logging.getLogger(CANDIDATE_LOGGER)
+    for existing in list(candidates.filters):
+        candidates.removeFilter(existing)
+    if candidate_sample > 1:
+        candidates.addFilter(SampleFilter(candidate_sample))
+
+    listener.start()
+    atexit.register(listener.stop) # Flush whatever is still queued on exit
+    return listener
@@ -0,0 +1,208 @@
+import asyncio
+import bisect
+import functools
+import math
+import time
+
+# Latency buckets in seconds, from a fast ICE candidate to a slow negotiation
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Event-loop lag buckets in seconds
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Buckets in seconds for time spent queued before negotiating, up to the default give-up
+QUEUE_WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# How often the event-loop lag probe wakes up, in seconds
+LAG_INTERVAL = 0.5
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """A metric family whose children are created once per label set.
+
+    Children carry their label string pre-rendered, so updating one on a hot
+    path is a single attribute update with no formatting.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._child(format_labels(self.labelnames, values))
+        return child
+
+    def remove(self, *values):
+        self._children.pop(values, None)
+
+    def retain(self, keep):
+        """Drop every child whose label values are not in `keep`."""
+        for values in [values for values in self._children if values not in keep]:
+            del self._children[values]
+
+    def __getattr__(self, attribute):
+        # Unlabelled metrics forward inc()/set()/observe() to their only child
+        if attribute == '_default':
+            raise AttributeError(attribute)
+        return getattr(self._default, attribute)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for child in list(self._children.values()):
+            lines.extend(child.render(self.name))
+        return lines
+
+
+class _Value:
+    __slots__ = ('label_text', 'value')
+
+    def __init__(self, label_text):
+        self.label_text = label_text
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def render(self, name):
+        return [f"{name}{self.label_text} {format_value(self.value)}"]
+
+
+class Counter(_Metric):
+    type = 'counter'
+    _child = _Value
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+    _child = _Value
+
+
+class _HistogramValue:
+    __slots__ = ('label_text', 'buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, label_text, buckets):
+        self.label_text = label_text
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self, func):
+        """Decorate a coroutine function so each call's duration is observed."""
+        @functools.wraps(func)
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.observe(time.perf_counter() - started)
+        return timed
+
+    def render(self, name):
+        lines = []
+        labels = self.label_text[1:-1] + ',' if self.label_text else ''
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}le="{format_value(bound)}"}} {cumulative}')
+        lines.append(f"{name}_sum{self.label_text} {format_value(self.sum)}")
+        lines.append(f"{name}_count{self.label_text} {self.count}")
+        return lines
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _child(self, label_text):
+        return _HistogramValue(label_text, self.buckets)
+
+
+class MetricsRegistry:
+    """Holds metric families and renders them in Prometheus text format.
+
+    Values that are expensive or pointless to maintain inline, such as
+    connection states or per-track rates, are filled in at scrape time by
+    collectors: coroutine functions registered with `collector()` that update
+    their gauges just before rendering.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def collector(self, func):
+        self._collectors.append(func)
+        return func
+
+    async def render(self):
+        for collect in self._collectors:
+            await collect()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+async def monitor_loop_lag(histogram, gauge, interval=LAG_INTERVAL):
+    """Measure how late the event loop wakes a sleeping task, forever."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(loop.time() - expected, 0.0)
+        histogram.observe(lag)
+        gauge.set(lag)
@@ -0,0 +1,196 @@
+import asyncio
+import collections
+import logging
+from fractions import Fraction
+
+import av
+import numpy as np
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+
+# Mixed audio format: 20 ms frames of 48 kHz interleaved 16-bit stereo
+SAMPLE_RATE = 48000
+CHANNELS = 2
+FRAME_SAMPLES = 960
+FRAME_SECONDS = FRAME_SAMPLES / SAMPLE_RATE
+TIME_BASE = Fraction(1, SAMPLE_RATE)
+
+# Audio held per input to absorb jitter; anything older is dropped to bound latency
+MAX_BUFFERED_SAMPLES = 5 * FRAME_SAMPLES
+
+# Mixed frames held per output for a slow sender; the oldest is dropped
+OUTPUT_BUFFER_SIZE = 5
+
+# Smoothed RMS level (fraction of full scale) above which a user counts as speaking
+SPEAKING_LEVEL = 0.02
+LEVEL_SMOOTHING = 0.3
+
+
+class MixedAudioTrack(MediaStreamTrack):
+    """One participant's mix-minus-self audio, fed by the mixer's clock."""
+
+    kind = 'audio'
+
+    def __init__(self):
+        super().__init__()
+        self._frames = collections.deque(maxlen=OUTPUT_BUFFER_SIZE)
+        self._wakeup = asyncio.Event()
+
+    def _push(self, frame):
+        self._frames.append(frame)
+        self._wakeup.set()
+
+    async def recv(self):
+        while not self._frames:
+            if self.readyState != 'live':
+                raise MediaStreamError
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        return self._frames.popleft()
+
+    def stop(self):
+        super().stop()
+        self._wakeup.set()
+
+
+class _Input:
+    """Decoded audio from one user, converted to the mix format and buffered."""
+
+    def __init__(self, track):
+        self.track = track
+        self.resampler = av.AudioResampler(format='s16', layout='stereo', rate=SAMPLE_RATE)
+        self.buffer = np.zeros((0, CHANNELS), dtype=np.int16)
+        self.task = asyncio.ensure_future(self._read())
+
+    async def _read(self):
+        try:
+            while True:
+                frame = await self.track.recv()
+                for converted in self.resampler.resample(frame):
+                    samples = converted.to_ndarray().reshape(-1, CHANNELS)
+                    self.buffer = np.concatenate((self.buffer, samples))[-MAX_BUFFERED_SAMPLES:]
+        except (MediaStreamError, asyncio.CancelledError):
+            pass
+
+    def take(self):
+        """Return the next frame's worth of samples, padded with silence on underrun."""
+        chunk = self.buffer[:FRAME_SAMPLES]
+        self.buffer = self.buffer[FRAME_SAMPLES:]
+        if len(chunk) < FRAME_SAMPLES:
+            chunk = np.concatenate((chunk, np.zeros((FRAME_SAMPLES - len(chunk), CHANNELS), dtype=np.int16)))
+        return chunk
+
+    def close(self):
+        self.task.cancel()
+        self.track.stop()
+
+
+class AudioMixer:
+    """Mixes every user's audio into one downstream track per participant.
+
+    Each inbound audio track is decoded once (by its receiver) and read by
+    the mixer. Every 20 ms the mixer sums all inputs in one vectorized pass
+    and gives each participant the sum minus their own input, so clients
+    receive a single audio stream instead of one per other user. The same
+    pass measures each input's level for speaker detection.
+    """
+
+    def __init__(self):
+        self.inputs = {} # username -> _Input
+        self.outputs = {} # username -> MixedAudioTrack
+        self.levels = {} # username -> smoothed RMS level, 0-1
+        self.ticks = 0
+        self.late_ticks = 0
+        self._task = None
+
+    def add_input(self, username, track):
+        """Mix `track` (a relay subscription) as `username`'s voice."""
+        self.remove_input(username)
+        self.inputs[username] = _Input(track)
+
+    def remove_input(self, username):
+        source = self.inputs.pop(username, None)
+        if source is not None:
+            source.close()
+        self.levels.pop(username, None)
+
+    def add_output(self, username):
+        """Return a new mix-minus track for `username`, replacing any previous one."""
+        previous = self.outputs.get(username)
+        if previous is not None:
+            previous.stop()
+        track = self.outputs[username] = MixedAudioTrack()
+        return track
+
+    def remove(self, username):
+        self.remove_input(username)
+        output = self.outputs.pop(username, None)
+        if output is not None:
+            output.stop()
+
+    def speaking(self):
+        return sorted(username for username, level in self.levels.items() if level >= SPEAKING_LEVEL)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        for username in list(self.inputs) + list(self.outputs):
+            self.remove(username)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        try:
+            while True:
+                deadline += FRAME_SECONDS
+                delay = deadline - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                elif -delay > OUTPUT_BUFFER_SIZE * FRAME_SECONDS:
+                    self.late_ticks += 1
+                    deadline = loop.time() # Too far behind to catch up; skip ahead
+                self.mix()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.error("Audio mixer stopped: %s", e)
+
+    def mix(self):
+        """Produce one frame for every output."""
+        self.outputs = {username: track for username, track in self.outputs.items() if track.readyState == 'live'}
+        names = list(self.inputs)
+        if names:
+            stacked = np.stack([self.inputs[name].take() for name in names]).astype(np.int32) # (users, samples, channels)
+            total = stacked.sum(axis=0)
+            mixes = np.clip(total - stacked, -32768, 32767).astype(np.int16)
+
+            rms = np.sqrt(np.mean(np.square(stacked, dtype=np.float64), axis=(1, 2))) / 32768
+            for name, level in zip(names, rms.tolist()):
+                previous = self.levels.get(name, level)
+                self.levels[name] = previous + LEVEL_SMOOTHING * (level - previous)
+        else:
+            total = np.zeros((FRAME_SAMPLES, CHANNELS), dtype=np.int32)
+        full_mix = np.clip(total, -32768, 32767).astype(np.int16)
+
+        index = {name: i for i, name in enumerate(names)}
+        pts = self.ticks * FRAME_SAMPLES
+        for username, track in self.outputs.items():
+            i = index.get(username)
+            samples = mixes[i] if i is not None else full_mix
+            frame = av.AudioFrame.from_ndarray(samples.reshape(1, -1), format='s16', layout='stereo')
+            frame.sample_rate = SAMPLE_RATE
+            frame.pts = pts
+            frame.time_base = TIME_BASE
+            track._push(frame)
+        self.ticks += 1
+
+    def stats(self):
+        return {
+            'inputs': len(self.inputs),
+            'outputs': len(self.outputs),
+            'ticks': self.ticks,
+            'late_ticks': self.late_ticks,
+            'speaking': self.speaking(),
+        }
@@ -0,0 +1,90 @@
+import asyncio
+import collections
+import logging
+import time
+
+from aiortc import RTCPeerConnection
+
+# Pooled connections older than this are discarded rather than handed out, so
+# their DTLS certificates are always comfortably inside their validity window.
+MAX_IDLE_AGE = 3600.0
+
+
+class ConnectionPool:
+    """Keeps pre-built RTCPeerConnections ready for incoming offers.
+
+    Building a connection generates its DTLS certificate, which is pure CPU
+    work on the event loop. The pool does that ahead of time and refills
+    itself in the background, one connection per loop iteration, after each
+    checkout. Idle pooled connections hold no sockets: aiortc only creates
+    ICE transports once a remote description is applied.
+    """
+
+    def __init__(self, size, factory=RTCPeerConnection, max_idle_age=MAX_IDLE_AGE):
+        self.size = size
+        self.factory = factory
+        self.max_idle_age = max_idle_age
+        self._idle = collections.deque() # (created_at, pc), oldest first
+        self._refill_task = None
+        self.hits = 0
+        self.misses = 0
+        self.build_seconds = 0.0 # Smoothed cost of building one connection
+        self.saved_seconds = 0.0
+
+    def __len__(self):
+        return len(self._idle)
+
+    def acquire(self):
+        """Return a ready connection, building one inline if the pool is empty."""
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][0] > self.max_idle_age:
+            self._idle.popleft() # Never used, so nothing to close
+        if self._idle:
+            pc = self._idle.popleft()[1]
+            self.hits += 1
+            self.saved_seconds += self.build_seconds
+        else:
+            pc = self._build()
+            self.misses += 1
+        self._schedule_refill()
+        return pc
+
+    def start(self):
+        self._schedule_refill()
+
+    async def close(self):
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+        while self._idle:
+            await self._idle.popleft()[1].close()
+
+    def _build(self):
+        started = time.perf_counter()
+        pc = self.factory()
+        elapsed = time.perf_counter() - started
+        self.build_seconds = elapsed if not self.build_seconds else 0.9 * self.build_seconds + 0.1 * elapsed
+        return pc
+
+    def _schedule_refill(self):
+        if len(self._idle) < self.size and (self._refill_task is None or self._refill_task.done()):
+            self._refill_task = asyncio.ensure_future(self._refill())
+
+    async def _refill(self):
+        try:
+            while len(self._idle) < self.size:
+                self._idle.append((time.monotonic(), self._build()))
+                await asyncio.sleep(0) # Let signaling and media run between builds
+        except Exception as e:
+            logging.error("Failed to refill connection pool: %s", e)
+
+    def stats(self):
+        checkouts = self.hits + self.misses
+        return {
+            'size': self.size,
+            'idle': len(self._idle),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / checkouts if checkouts else 0.0,
+            'build_ms': self.build_seconds * 1000,
+            'saved_ms': self.saved_seconds * 1000,
+        }
@@ -0,0 +1,148 @@
+import asyncio
+import collections
+import logging
+import os
+import time
+
+# How often connections are checked, in seconds
+REAP_INTERVAL = 5.0
+
+# A connection that is not connected this long after it was first seen, or
+# after it last carried traffic, is closed
+CONNECT_TIMEOUT = 30.0
+
+# A connected connection that has received nothing for this long is closed; 0 disables
+IDLE_TIMEOUT = 120.0
+
+# Links a single user may hold as a subscriber
+MAX_LINKS_PER_USER = 64
+
+# Longest a graceful shutdown waits for connections to close, in seconds
+DRAIN_TIMEOUT = 10.0
+
+
+def open_files():
+    """Return how many file descriptors this process holds, or None without /proc."""
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+async def bytes_received(pc):
+    """Return the bytes received on `pc`'s transports (media and RTCP, not ICE checks)."""
+    report = await pc.getStats()
+    return sum(stats.bytesReceived for stats in report.values() if stats.type == 'transport')
+
+
+class Reaper:
+    """Closes the connections that state callbacks leave behind.
+
+    Cleanup normally runs from iceconnectionstatechange callbacks. Those never
+    fire for a client that vanished before ICE started, and they leave
+    connected but silent sessions alone. Every `interval` seconds the reaper
+    walks the main connections and links, and closes the ones that are closed
+    or failed, not connected within `connect_timeout`, or idle for longer
+    than `idle_timeout`. Closures are counted by role and reason, together
+    with the file descriptors (mostly UDP sockets) and resident memory the
+    process gave back across them.
+    """
+
+    def __init__(self, sessions, close_peer, close_link, rss, interval=REAP_INTERVAL,
+                 connect_timeout=CONNECT_TIMEOUT, idle_timeout=IDLE_TIMEOUT, max_links=MAX_LINKS_PER_USER):
+        self.sessions = sessions
+        self.close_peer = close_peer # coroutine(username)
+        self.close_link = close_link # coroutine(subscriber, source, pc)
+        self.rss = rss # Returns this process's resident memory in bytes
+        self.interval = interval
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.max_links = max_links
+        self._watched = {} # RTCPeerConnection -> [bytes received, last activity]
+        self._task = None
+        self.sweeps = 0
+        self.reclaimed = collections.Counter() # (role, reason) -> connections closed
+        self.released_fds = 0
+        self.released_bytes = 0
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logging.error("Connection reaper sweep failed: %s", e)
+
+    async def _verdict(self, pc, now):
+        """Return why `pc` should be closed, or None to keep it."""
+        watched = self._watched.get(pc)
+        if watched is None:
+            watched = self._watched[pc] = [None, now]
+        state = pc.connectionState
+        if state in ('closed', 'failed'):
+            return state
+        if state != 'connected':
+            return 'connect_timeout' if now - watched[1] > self.connect_timeout else None
+        received = await bytes_received(pc)
+        if received != watched[0]:
+            watched[0] = received
+            watched[1] = now
+        elif self.idle_timeout and now - watched[1] > self.idle_timeout:
+            return 'idle'
+        return None
+
+    async def sweep(self):
+        """Check every registered connection once and close the ones that are done."""
+        now = time.monotonic()
+        doomed = []
+        for peer in list(self.sessions):
+            reason = await self._verdict(peer.connection, now)
+            if reason is not None:
+                doomed.append(('main', reason, (peer.username, peer.connection)))
+        for (subscriber, source), pc in self.sessions.links():
+            reason = await self._verdict(pc, now)
+            if reason is not None:
+                doomed.append(('link', reason, (subscriber, source, pc)))
+        self.sweeps += 1
+
+        if doomed:
+            fds_before, rss_before = open_files(), self.rss()
+            for role, reason, target in doomed:
+                if role == 'main':
+                    username, pc = target
+                    peer = self.sessions.get(username)
+                    if peer is None or peer.connection is not pc:
+                        continue # Already cleaned up, or replaced by a re-offer
+                    logging.info("Reaping main connection of %s (%s)", username, reason)
+                    await self.close_peer(username)
+                else:
+                    subscriber, source, pc = target
+                    if self.sessions.get_link(subscriber, source) is not pc:
+                        continue
+                    logging.info("Reaping link %s->%s (%s)", subscriber, source, reason)
+                    await self.close_link(subscriber, source, pc)
+                self.reclaimed[role, reason] += 1
+            fds_after = open_files()
+            if fds_before is not None and fds_after is not None:
+                self.released_fds += max(fds_before - fds_after, 0)
+            self.released_bytes += max(rss_before - self.rss(), 0)
+
+        # Forget connections that are gone, however they went
+        live = {peer.connection for peer in self.sessions} | {pc for key, pc in self.sessions.links()}
+        self._watched = {pc: watched for pc, watched in self._watched.items() if pc in live}
+
+    def stats(self):
+        return {
+            'sweeps': self.sweeps,
+            'watched': len(self._watched),
+            'reclaimed': {f"{role}_{reason}": count for (role, reason), count in self.reclaimed.items()},
+            'released_fds': self.released_fds,
+            'released_rss_bytes': self.released_bytes,
+        }
@@ -0,0 +1,239 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import logging
+import queue
+import time
+import urllib.parse
+from fractions import Fraction
+from pathlib import Path
+
+import av
+from aiortc.mediastreams import MediaStreamError
+
+from relay import copy_frame
+
+# Length of each recorded file, in seconds. Segments roll over on a video
+# frame so every file starts with a keyframe.
+SEGMENT_SECONDS = 60.0
+
+# Frames buffered between the event loop and a recording's writer thread.
+# When the disk or encoder falls behind, new frames are dropped here.
+QUEUE_SIZE = 256
+
+# Recordings that may run at once; each one occupies a writer thread
+MAX_RECORDINGS = 4
+
+VIDEO_TIME_BASE = Fraction(1, 90000)
+
+# Longest directory name used for a user's recordings, in characters
+MAX_NAME_LENGTH = 128
+
+
+def directory_name(username):
+    """Return a single path component naming `username`'s recordings.
+
+    Usernames are chosen by clients, so separators are percent-escaped and a
+    leading dot is escaped too (making '..' harmless). Long names are cut
+    short and made unique with a hash, so the result always stays one level
+    below the recording directory.
+    """
+    name = urllib.parse.quote(username, safe='')
+    if name.startswith('.'):
+        name = '%2E' + name[1:]
+    if len(name) > MAX_NAME_LENGTH:
+        digest = hashlib.blake2b(username.encode('utf-8'), digest_size=8).hexdigest()
+        name = f"{name[:MAX_NAME_LENGTH - len(digest) - 1]}-{digest}"
+    return name
+
+
+class _Segment:
+    """One output file. Only ever touched by its recording's writer thread."""
+
+    def __init__(self, path, started, kinds, video_size):
+        self.path = path
+        self.started = started
+        self.container = av.open(str(path), mode='w')
+        self.streams = {}
+        self.origins = {} # kind -> (first media time, first arrival time), for pts rebasing
+        self.last_pts = {}
+        if 'video' in kinds:
+            stream = self.container.add_stream('libvpx', rate=30)
+            stream.width, stream.height = video_size
+            stream.pix_fmt = 'yuv420p'
+            stream.codec_context.time_base = VIDEO_TIME_BASE
+            self.streams['video'] = stream
+        if 'audio' in kinds:
+            self.streams['audio'] = self.container.add_stream('libopus', rate=48000)
+
+    def write(self, kind, arrival, frame):
+        stream = self.streams.get(kind)
+        if stream is None:
+            return
+        if kind == 'video':
+            copy = copy_frame(frame, stream.width, stream.height)
+            time_base = VIDEO_TIME_BASE
+        else:
+            copy = copy_frame(frame)
+            time_base = Fraction(1, frame.sample_rate)
+
+        # Keep each stream's own clock, anchored at its first arrival in this segment
+        media_time = float(frame.pts * frame.time_base) if frame.pts is not None and frame.time_base else arrival
+        first_media, first_arrival = self.origins.setdefault(kind, (media_time, arrival))
+        pts = int(((first_arrival - self.started) + (media_time - first_media)) / time_base)
+        pts = max(pts, self.last_pts.get(kind, -1) + 1)
+        self.last_pts[kind] = pts
+        copy.pts = pts
+        copy.time_base = time_base
+        for packet in stream.encode(copy):
+            self.container.mux(packet)
+
+    def close(self):
+        for stream in self.streams.values():
+            for packet in stream.encode(None):
+                self.container.mux(packet)
+        self.container.close()
+
+
+class Recording:
+    """Records one user's tracks into a series of WebM segments.
+
+    Reader tasks on the event loop take frames from relay subscriptions and
+    offer them to a bounded queue without waiting. Encoding and file I/O run
+    on a writer thread. If that thread falls behind, frames are dropped at
+    the queue, and live forwarding never slows down.
+    """
+
+    def __init__(self, username, tracks, directory, relay,
+                 segment_seconds=SEGMENT_SECONDS, queue_size=QUEUE_SIZE):
+        self.username = username
+        self.directory = Path(directory) / directory_name(username)
+        self.segment_seconds = segment_seconds
+        self.kinds = {track.kind for track in tracks}
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.subscriptions = [relay.subscribe(track) for track in tracks]
+        self.started_at = time.time()
+        self.frames_recorded = 0
+        self.frames_dropped = 0
+        self.segments = []
+        self.error = None
+        self._readers = []
+        self._writer = None
+
+    def start(self, executor):
+        loop = asyncio.get_running_loop()
+        self._readers = [asyncio.ensure_future(self._read(track, loop)) for track in self.subscriptions]
+        self._writer = loop.run_in_executor(executor, self._write)
+
+    async def stop(self):
+        for reader in self._readers:
+            reader.cancel()
+        for track in self.subscriptions:
+            track.stop()
+        if self._writer is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.queue.put, None) # Waits for room, off the loop
+            await self._writer
+
+    async def _read(self, track, loop):
+        try:
+            while True:
+                frame = await track.recv()
+                try:
+                    self.queue.put_nowait((track.kind, loop.time(), frame))
+                except queue.Full:
+                    self.frames_dropped += 1
+        except (MediaStreamError, asyncio.CancelledError):
+            pass
+
+    def _write(self):
+        segment = None
+        rotate_on = 'video' if 'video' in self.kinds else 'audio'
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                kind, arrival, frame = item
+                if segment is None:
+                    if kind != rotate_on:
+                        continue # The first file starts on a video frame, like every other
+                    segment = self._open_segment(arrival, frame)
+                elif kind == rotate_on and arrival - segment.started >= self.segment_seconds:
+                    segment.close()
+                    segment = self._open_segment(arrival, frame)
+                segment.write(kind, arrival, frame)
+                self.frames_recorded += 1
+        except Exception as e:
+            self.error = str(e)
+            logging.error("Recording of %s failed: %s", self.username, e)
+            self._drain()
+        finally:
+            if segment is not None:
+                try:
+                    segment.close()
+                except Exception as e:
+                    logging.error("Failed to finish segment %s: %s", segment.path, e)
+
+    def _drain(self):
+        """Consume the queue until the stop marker so stop() never waits forever."""
+        while self.queue.get() is not None:
+            self.frames_dropped += 1
+
+    def _open_segment(self, arrival, frame):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"{int(self.started_at)}-{len(self.segments):04d}.webm"
+        video_size = (frame.width, frame.height) if isinstance(frame, av.VideoFrame) else None
+        self.segments.append(str(path))
+        logging.info("Recording %s to %s", self.username, path)
+        return _Segment(path, arrival, self.kinds, video_size)
+
+    def stats(self):
+        return {
+            'started_at': self.started_at,
+            'frames_recorded': self.frames_recorded,
+            'frames_dropped': self.frames_dropped,
+            'queued': self.queue.qsize(),
+            'segments': list(self.segments),
+            'error': self.error,
+        }
+
+
+class RecordingManager:
+    """Starts and stops recordings, sharing one bounded pool of writer threads."""
+
+    def __init__(self, directory, relay, max_recordings=MAX_RECORDINGS, segment_seconds=SEGMENT_SECONDS):
+        self.directory = directory
+        self.relay = relay
+        self.max_recordings = max_recordings
+        self.segment_seconds = segment_seconds
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_recordings, thread_name_prefix='recorder')
+        self.recordings = {} # username -> Recording
+
+    def __contains__(self, username):
+        return username in self.recordings
+
+    def start(self, username, tracks):
+        """Start recording `tracks` for `username`; return False if the limit is reached."""
+        if len(self.recordings) >= self.max_recordings:
+            return False
+        recording = self.recordings[username] = Recording(
+            username, tracks, self.directory, self.relay, self.segment_seconds)
+        recording.start(self.executor)
+        return True
+
+    async def stop(self, username):
+        """Stop `username`'s recording, returning its final stats, or None if there was none."""
+        recording = self.recordings.pop(username, None)
+        if recording is None:
+            return None
+        await recording.stop()
+        return recording.stats()
+
+    async def close(self):
+        for username in list(self.recordings):
+            await self.stop(username)
+        self.executor.shutdown(wait=False)
+
+    def stats(self):
+        return {username: recording.stats() for username, recording in self.recordings.items()}
@@ -0,0 +1,256 @@
+import collections
+
+from layers import LAYER_NAMES
+
+# Number of roster changes kept for incremental (`since`) roster queries.
+# Clients further behind than this get a full snapshot instead.
+ROSTER_HISTORY = 1024
+
+# Room for users that do not name one
+DEFAULT_ROOM = 'default'
+
+
+class Peer:
+    """Server-side state for one user connected to this process."""
+
+    __slots__ = ('username', 'room', 'connection', 'tracks', 'layers')
+
+    def __init__(self, username, connection, room=DEFAULT_ROOM):
+        self.username = username
+        self.room = room
+        self.connection = connection # Main server RTCPeerConnection
+        self.tracks = [] # Tracks *sent by* this user to the server
+        self.layers = {} # Simulcast layer name -> video track (a subset of `tracks`)
+
+    def primary_tracks(self):
+        """Return the tracks to forward when no layer selection is done:
+        every non-layer track plus the best simulcast layer."""
+        layered = set(self.layers.values())
+        tracks = [track for track in self.tracks if track not in layered]
+        for name in LAYER_NAMES:
+            if name in self.layers:
+                tracks.append(self.layers[name])
+                break
+        return tracks
+
+
+class Roster:
+    """The users listed in one room.
+
+    Carries a version that is bumped on every join and leave, so clients can
+    ask for just the changes since the version they last saw.
+    """
+
+    def __init__(self, history=ROSTER_HISTORY, version=0):
+        self._names = {} # Insertion-ordered set of usernames
+        self._snapshot = ()
+        self._snapshot_version = version
+        self._changes = collections.deque(maxlen=history) # (version, event, username)
+        self.version = version
+
+    def __contains__(self, username):
+        return username in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def join(self, username):
+        self._names[username] = None
+        self._record('joined', username)
+
+    def leave(self, username):
+        del self._names[username]
+        self._record('left', username)
+
+    def names(self):
+        """Return a tuple of every listed username, rebuilt only after changes."""
+        if self._snapshot_version != self.version:
+            self._snapshot = tuple(self._names)
+            self._snapshot_version = self.version
+        return self._snapshot
+
+    def changes_since(self, version):
+        """Return (joined, left) since `version`, or None if it is too old.
+
+        Cost is proportional to the number of changes, not to roster size.
+        """
+        if version == self.version:
+            return [], []
+        if version > self.version or not self._changes or version < self._changes[0][0] - 1:
+            return None
+        latest = {}
+        for change_version, event, username in reversed(self._changes):
+            if change_version <= version:
+                break
+            latest.setdefault(username, event)
+        changed = list(latest.items())[::-1] # Back to chronological order
+        joined = [name for name, event in changed if event == 'joined']
+        left = [name for name, event in changed if event == 'left']
+        return joined, left
+
+    def _record(self, event, username):
+        self.version += 1
+        self._changes.append((self.version, event, username))
+
+
+class SessionRegistry:
+    """Indexes connected peers, the relay links between them and the rooms.
+
+    A link is the RTCPeerConnection over which `subscriber`'s client receives
+    `source`'s media. Links are keyed by the directed (subscriber, source)
+    pair and indexed under both users, so tearing one user down only visits
+    that user's own links.
+
+    Every user visible to this process (including users served by other
+    shards) is listed in exactly one room. Rosters are kept per room, so
+    roster queries and broadcasts cost in proportion to the room, not to
+    the whole server. A room's Roster exists while anyone is listed in it,
+    and a recreated room's versions carry on above every version handed out
+    before, so a version from an earlier roster is never mistaken for a
+    current one.
+    """
+
+    def __init__(self, history=ROSTER_HISTORY):
+        self._peers = {}
+        self._links = {} # (subscriber, source) -> RTCPeerConnection
+        self._links_by_user = {} # username -> set of link keys involving it
+        self._rooms = {} # room -> Roster
+        self._room_of = {} # username -> room, for every listed user
+        self._history = history
+        self._retired_version = 0 # Highest version of any roster already deleted
+
+    def __contains__(self, username):
+        return username in self._peers
+
+    def __len__(self):
+        return len(self._peers)
+
+    def __iter__(self):
+        return iter(self._peers.values())
+
+    def get(self, username):
+        return self._peers.get(username)
+
+    def add(self, username, connection, room=DEFAULT_ROOM):
+        """Register a newly connected local user and list them in `room`."""
+        peer = self._peers[username] = Peer(username, connection, room)
+        self.join(username, room)
+        return peer
+
+    def remove(self, username):
+        """Unregister `username`, returning its Peer and the links it was part of."""
+        peer = self._peers.pop(username, None)
+        links = self.pop_links(username)
+        self.leave(username)
+        return peer, links
+
+    # Links
+
+    def add_link(self, subscriber, source, pc):
+        """Record `pc` as the link; return the connection it replaced, if any."""
+        key = (subscriber, source)
+        previous = self._links.get(key)
+        self._links[key] = pc
+        self._links_by_user.setdefault(subscriber, set()).add(key)
+        self._links_by_user.setdefault(source, set()).add(key)
+        return previous
+
+    def get_link(self, subscriber, source):
+        return self._links.get((subscriber, source))
+
+    def remove_link(self, subscriber, source, pc=None):
+        """Forget a link; with `pc`, only if it is still the registered one."""
+        key = (subscriber, source)
+        if key not in self._links or (pc is not None and self._links[key] is not pc):
+            return None
+        self._unindex(key)
+        return self._links.pop(key)
+
+    def pop_links(self, username):
+        """Forget every link involving `username` and return them as (key, pc)."""
+        removed = []
+        for key in self._links_by_user.pop(username, ()):
+            other = key[1] if key[0] == username else key[0]
+            keys = self._links_by_user.get(other)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._links_by_user[other]
+            removed.append((key, self._links.pop(key)))
+        return removed
+
+    def subscribers_of(self, source):
+        """Return (subscriber, pc) for every link carrying `source`'s media."""
+        return [(key[0], self._links[key]) for key in self._links_by_user.get(source, ()) if key[1] == source]
+
+    def subscription_count(self, username):
+        """Return how many links `username` receives media over."""
+        return sum(1 for key in self._links_by_user.get(username, ()) if key[0] == username)
+
+    def links(self):
+        """Return ((subscriber, source), pc) for every link."""
+        return list(self._links.items())
+
+    def link_count(self):
+        return len(self._links)
+
+    def _unindex(self, key):
+        for username in key:
+            keys = self._links_by_user.get(username)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._links_by_user[username]
+
+    # Rooms
+
+    def join(self, username, room=DEFAULT_ROOM):
+        """List `username` in `room`; return False if already listed anywhere."""
+        if username in self._room_of:
+            return False
+        roster = self._rooms.get(room)
+        if roster is None:
+            roster = self._rooms[room] = Roster(self._history, self._retired_version)
+        roster.join(username)
+        self._room_of[username] = room
+        return True
+
+    def leave(self, username):
+        """Unlist `username`; return the room it left, or None if it was not listed."""
+        room = self._room_of.pop(username, None)
+        if room is None:
+            return None
+        roster = self._rooms[room]
+        roster.leave(username)
+        if not roster:
+            del self._rooms[room]
+            self._retired_version = max(self._retired_version, roster.version)
+        return room
+
+    def is_listed(self, username):
+        return username in self._room_of
+
+    def room_of(self, username):
+        return self._room_of.get(username)
+
+    def roster(self, room):
+        """Return the Roster of `room`, or None if nobody is listed in it."""
+        return self._rooms.get(room)
+
+    def members(self, room):
+        """Return the local Peers listed in `room`."""
+        roster = self._rooms.get(room)
+        if roster is None:
+            return []
+        return [self._peers[name] for name in roster.names() if name in self._peers]
+
+    def others(self, username):
+        """Return everyone listed in `username`'s room except `username`."""
+        roster = self._rooms.get(self._room_of.get(username))
+        if roster is None:
+            return []
+        return [name for name in roster.names() if name != username]
+
+    def rooms(self):
+        """Return {room: number of listed users}."""
+        return {room: len(roster) for room, roster in self._rooms.items()}
@@ -0,0 +1,248 @@
+import asyncio
+import collections
+import logging
+import time
+
+import av
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+
+# Per-subscriber buffer depth, in frames. Video subscribers only ever need the
+# freshest picture; audio gets a little more slack to ride out encoder jitter.
+VIDEO_BUFFER_SIZE = 2
+AUDIO_BUFFER_SIZE = 10
+
+
+def plane_data(source_plane, plane):
+    """Return `source_plane`'s contents laid out to fit `plane`.
+
+    Decoders may allocate larger buffers or wider rows than a fresh frame of
+    the same shape, so padding is dropped or rows are repacked as needed.
+    """
+    data = memoryview(source_plane)
+    if isinstance(plane, av.video.plane.VideoPlane) and source_plane.line_size != plane.line_size:
+        stride = source_plane.line_size
+        padding = bytes(plane.line_size - plane.width)
+        return b''.join(bytes(data[row * stride:row * stride + plane.width]) + padding for row in range(plane.height))
+    return data[:plane.buffer_size]
+
+
+def copy_frame(frame, width=None, height=None):
+    """Return a private copy of `frame`, scaled to `width`x`height` for video.
+
+    The copy keeps the frame's timestamp, so it can be changed without
+    touching the original.
+    """
+    if isinstance(frame, av.VideoFrame):
+        source = frame.reformat(width=width, height=height, format='yuv420p')
+        if source is not frame:
+            return source # Scaling already produced a new frame, timestamp included
+        copy = av.VideoFrame(source.width, source.height, 'yuv420p')
+    else:
+        source = frame
+        copy = av.AudioFrame(format=frame.format.name, layout=frame.layout.name, samples=frame.samples)
+        copy.sample_rate = frame.sample_rate
+    for source_plane, plane in zip(source.planes, copy.planes):
+        plane.update(plane_data(source_plane, plane))
+    copy.pts = frame.pts
+    copy.time_base = frame.time_base
+    return copy
+
+
+class RelayTrack(MediaStreamTrack):
+    """One subscriber's view of a relayed source track.
+
+    Frames are buffered in a bounded deque; when a slow consumer falls behind,
+    the oldest buffered frame is dropped so the consumer never stalls the
+    source or the other subscribers.
+
+    A video frame read by several subscribers is copied for each of them:
+    every sender encodes on its own thread, and aiortc's video encoders set
+    the frame's picture type (forcing a keyframe for one subscriber would
+    otherwise force it for all). Audio encoders only read their input, so
+    audio frames stay shared.
+    """
+
+    def __init__(self, fanout, maxsize):
+        super().__init__()
+        self.kind = fanout.source.kind
+        self._fanout = fanout
+        self._frames = collections.deque(maxlen=maxsize) # (frame, shared with other subscribers)
+        self._wakeup = asyncio.Event()
+        self._source_ended = False
+        self._time_base = None # Timeline of the frames this track returns
+        self._offset = 0 # Added to source timestamps to keep that timeline going
+        self._last_pts = None
+        self._delivered_at = None
+        self._rebase = False # Set when the source changes
+        self.frames_delivered = 0
+        self.frames_dropped = 0
+
+    @property
+    def source(self):
+        return self._fanout.source
+
+    def _push(self, frame, shared):
+        """Buffer `frame`, returning True if an older frame had to be dropped."""
+        dropped = len(self._frames) == self._frames.maxlen
+        if dropped:
+            self.frames_dropped += 1 # deque drops the oldest frame for us
+        self._frames.append((frame, shared))
+        self._wakeup.set()
+        return dropped
+
+    def _end(self):
+        self._source_ended = True
+        self._wakeup.set()
+
+    async def recv(self):
+        while not self._frames:
+            if self._source_ended or self.readyState != "live":
+                raise MediaStreamError
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        self.frames_delivered += 1
+        frame, shared = self._frames.popleft()
+        pts, time_base = self._retime(frame)
+        if shared and (self.kind == "video" or pts != frame.pts or time_base != frame.time_base):
+            frame = copy_frame(frame) # Copied only once it is sent, never for dropped frames
+        frame.pts = pts
+        frame.time_base = time_base
+        return frame
+
+    def _retime(self, frame):
+        """Return `frame`'s (pts, time_base) on this track's own timeline.
+
+        Senders turn pts straight into RTP timestamps, and every source has
+        its own random timestamp origin. After a resubscribe, the new
+        source's timestamps are offset to carry on from the last frame sent,
+        advanced by the time that has passed since.
+        """
+        if frame.pts is None or frame.time_base is None:
+            return frame.pts, frame.time_base
+        now = time.monotonic()
+        if self._time_base is None:
+            self._time_base = frame.time_base
+        pts = frame.pts
+        if frame.time_base != self._time_base:
+            pts = int(pts * frame.time_base / self._time_base)
+        if self._rebase:
+            self._rebase = False
+            if self._last_pts is not None:
+                gap = max(round((now - self._delivered_at) / self._time_base), 1)
+                self._offset = self._last_pts + gap - pts
+        pts += self._offset
+        self._last_pts = pts
+        self._delivered_at = now
+        return pts, self._time_base
+
+    def stop(self):
+        if self.readyState != "ended":
+            super().stop()
+            self._fanout.remove(self)
+            self._frames.clear()
+            self._wakeup.set()
+
+
+class _Fanout:
+    """Reads a single source track and copies each frame to its subscribers."""
+
+    def __init__(self, relay, source):
+        self.relay = relay
+        self.source = source
+        self.subscribers = set()
+        self.frames_read = 0
+        self.frames_dropped = 0
+        # The reader runs for the whole life of the source, even with no
+        # subscribers, so the receiver's own (unbounded) queue never backs up.
+        self.task = asyncio.ensure_future(self._run())
+
+    def remove(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    async def _run(self):
+        try:
+            while True:
+                frame = await self.source.recv()
+                self.frames_read += 1
+                self.relay.frames_read += 1
+                shared = len(self.subscribers) > 1
+                for subscriber in self.subscribers:
+                    if subscriber._push(frame, shared):
+                        self.frames_dropped += 1
+                        self.relay.frames_dropped += 1
+        except MediaStreamError:
+            logging.info("Relay source %s track %s ended", self.source.kind, self.source.id)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for subscriber in self.subscribers:
+                subscriber._end()
+            self.subscribers.clear()
+            self.relay._fanouts.pop(self.source, None)
+
+
+class TrackRelay:
+    """Fan out inbound tracks to any number of outbound connections.
+
+    Each source track is read exactly once, by its own reader task, no matter
+    how many connections forward it. Use `subscribe()` to get a track that can
+    be passed to `RTCPeerConnection.addTrack()`.
+    """
+
+    def __init__(self):
+        self._fanouts = {}
+        self.frames_read = 0
+        self.frames_dropped = 0
+
+    def add_source(self, track):
+        """Start reading `track` if it is not already being relayed."""
+        fanout = self._fanouts.get(track)
+        if fanout is None:
+            fanout = self._fanouts[track] = _Fanout(self, track)
+        return fanout
+
+    def subscribe(self, track, maxsize=None):
+        """Return a new subscriber track fed from the source `track`."""
+        if maxsize is None:
+            maxsize = AUDIO_BUFFER_SIZE if track.kind == "audio" else VIDEO_BUFFER_SIZE
+        fanout = self.add_source(track)
+        subscriber = RelayTrack(fanout, maxsize)
+        fanout.subscribers.add(subscriber)
+        return subscriber
+
+    def resubscribe(self, subscriber, track):
+        """Feed an existing subscriber track from the source `track` instead.
+
+        The subscriber stays live, so a sender reading from it carries on
+        without renegotiation; frames still buffered from the old source are
+        discarded, and the new source's timestamps are rebased to continue
+        the subscriber's own.
+        """
+        fanout = self.add_source(track)
+        subscriber._fanout.remove(subscriber)
+        subscriber._fanout = fanout
+        subscriber._frames.clear()
+        subscriber._rebase = True
+        fanout.subscribers.add(subscriber)
+
+    def source_stats(self, track):
+        """Return (frames read, frames dropped, subscribers) for a relayed source, or None."""
+        fanout = self._fanouts.get(track)
+        if fanout is None:
+            return None
+        return fanout.frames_read, fanout.frames_dropped, len(fanout.subscribers)
+
+    def remove_source(self, track):
+        """Stop relaying `track` and end all of its subscribers."""
+        fanout = self._fanouts.pop(track, None)
+        if fanout is not None:
+            fanout.task.cancel()
+
+    def stats(self):
+        """Return relay-wide counters."""
+        return {
+            'sources': len(self._fanouts),
+            'subscribers': sum(len(f.subscribers) for f in self._fanouts.values()),
+            'frames_read': self.frames_read,
+            'frames_dropped': self.frames_dropped,
+        }
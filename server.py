@@ -1,369 +1,1122 @@
+import argparse
 import asyncio
+import collections
+import hmac
 import logging
 import json
+import os
+import resource
 import ssl
+import time
 from pathlib import Path
 from aiortc import RTCPeerConnection, RTCSessionDescription, RTCIceCandidate
-from aiohttp import web
+from aiortc.sdp import candidate_from_sdp
+from aiohttp import web, WSCloseCode, WSMsgType
 import aiohttp_cors
 from pathlib import Path
+from admission import (MAX_NEGOTIATIONS, MAX_QUEUE_WAIT, MAX_QUEUED, PRIORITY_JOIN, PRIORITY_SETUP,
+                       USER_BURST, USER_RATE, NegotiationScheduler)
+from assets import PAGE_CACHE_CONTROL, AssetCache
+from candidates import PendingCandidates
+from directory import CLUSTER_TOKEN_HEADER, FORWARDED_HEADER, NodeLink, SqliteDirectory
+from layers import LAYER_NAMES, LayerSelector
+from logsetup import CANDIDATE_LOGGER, setup_logging
+from mixer import AudioMixer
+from metrics import LAG_BUCKETS, QUEUE_WAIT_BUCKETS, MetricsRegistry, monitor_loop_lag
+from pool import ConnectionPool
+from reaper import CONNECT_TIMEOUT, DRAIN_TIMEOUT, IDLE_TIMEOUT, MAX_LINKS_PER_USER, Reaper, open_files
+from recording import RecordingManager
+from registry import DEFAULT_ROOM, SessionRegistry
+from relay import TrackRelay
+from workers import LOCAL_ADDRESSES, ROUTED_PATHS
 
-# Configure logging
+# Configure logging; __main__ replaces this with setup_logging() from the command line
 logging.basicConfig(level=logging.INFO)
 
-# Store active peer connections
-peers = {}
+# Per-candidate logs, sampled separately from the rest (see --candidate-log-sample)
+candidate_log = logging.getLogger(CANDIDATE_LOGGER)
 
-async def index(request):
-    content = open('templates/index.html', 'r').read()
-    return web.Response(content_type='text/html', text=content)
+# Store active peers, the relay links between them and the rooms
+sessions = SessionRegistry()
 
-async def cleanup_peer(username, app_peers_dict):
+# Longest room name accepted from clients
+MAX_ROOM_LENGTH = 64
+
+# Open signaling WebSockets, keyed by username
+sockets = {}
+
+# ICE candidates that arrived before their connection was ready
+pending_candidates = PendingCandidates()
+
+# Fans each inbound track out to every connection that forwards it
+relay = TrackRelay()
+
+# Optional pool of pre-built connections, created by init_app()
+pool = None
+
+# Set to a workers.ShardLink when this process serves one shard of a cluster,
+# or to a directory.NodeLink when it is one node sharing a session directory
+cluster = None
+
+# When set, cluster-internal routes require it in the X-Cluster-Token header
+cluster_token = None
+
+# How often a node pulls the rosters of its rooms from the session directory, in seconds
+DIRECTORY_SYNC_INTERVAL = 1.0
+
+# Closes connections the state callbacks missed, created by init_app()
+reaper = None
+
+# Opt-in recording to disk, created by init_app() when a directory is given
+recordings = None
+
+# Set to a dict of room -> AudioMixer when audio mixing is enabled. Local
+# users' audio is then mixed, per room, into one mix-minus-self track on each
+# main connection and is not forwarded over links.
+mixers = None
+
+# How often speaker changes are pushed to signaling sockets, in seconds
+SPEAKER_INTERVAL = 0.5
+
+STATIC_PATH = str(Path(__file__).parent / 'static')
+TEMPLATE_PATH = Path(__file__).parent / 'templates'
+
+# The page, script and stylesheet, held in memory with compressed variants
+assets = AssetCache()
+
+# RTCPeerConnection.connectionState values, reported for every connection
+CONNECTION_STATES = ('new', 'connecting', 'connected', 'disconnected', 'failed', 'closed')
+
+# Prometheus metrics for /metrics. Counters and histograms are updated inline;
+# gauges describing current state are filled in by collect_metrics() per scrape.
+metrics = MetricsRegistry()
+handler_seconds = metrics.histogram('signaling_handler_seconds', 'Time spent handling a signaling request', ('handler',))
+connections_created = metrics.counter('peer_connections_created_total', 'RTCPeerConnections handed out for negotiation')
+connection_states = metrics.gauge('peer_connections', 'RTCPeerConnections by role and connection state', ('role', 'state'))
+tracks_received = metrics.counter('tracks_received_total', 'Inbound tracks received from local users')
+tracks_stored = metrics.gauge('tracks_stored', 'Inbound tracks currently held for local users')
+tracks_forwarded = metrics.gauge('tracks_forwarded', 'Relay subscriptions currently feeding outbound senders')
+track_frames = metrics.counter('track_frames_total', 'Frames read from an inbound track', ('user', 'kind', 'layer'))
+track_frames_dropped = metrics.counter('track_frames_dropped_total', 'Frames of an inbound track dropped for slow subscribers', ('user', 'kind', 'layer'))
+track_fps = metrics.gauge('track_frames_per_second', 'Frame rate of an inbound track since the previous scrape', ('user', 'kind', 'layer'))
+track_packets_lost = metrics.counter('track_packets_lost_total', 'RTP packets of an inbound track lost before reaching the server', ('user', 'kind', 'layer'))
+track_subscribers = metrics.gauge('track_subscribers', 'Outbound senders fed from an inbound track', ('user', 'kind', 'layer'))
+peer_received_bytes = metrics.counter('peer_received_bytes_total', "Bytes received on a user's main connection", ('user',))
+peer_bitrate = metrics.gauge('peer_receive_bitrate_bps', "Receive bitrate of a user's main connection since the previous scrape", ('user',))
+loop_lag_seconds = metrics.histogram('event_loop_lag_seconds', 'How late the event loop ran a timer', buckets=LAG_BUCKETS)
+loop_lag = metrics.gauge('event_loop_lag_last_seconds', 'Most recent event loop lag measurement')
+rooms_active = metrics.gauge('rooms', 'Rooms with at least one listed user')
+connections_reaped = metrics.counter('peer_connections_reaped_total', 'Connections closed by the reaper', ('role', 'reason'))
+pool_checkouts = metrics.counter('peer_connection_pool_checkouts_total', 'Connections taken from the pool, by whether one was ready', ('result',))
+pool_saved_seconds = metrics.counter('peer_connection_pool_saved_seconds_total', 'Connection build time saved by pool hits')
+pool_build_seconds = metrics.gauge('peer_connection_pool_build_seconds', 'Smoothed time to build one connection, saved by each hit')
+pool_idle = metrics.gauge('peer_connection_pool_idle', 'Pre-built connections ready in the pool')
+negotiations_active = metrics.gauge('signaling_negotiations_active', 'SDP negotiations holding a slot')
+negotiation_queue_depth = metrics.gauge('signaling_queue_depth', 'SDP negotiations waiting for a slot')
+negotiation_queue_wait = metrics.histogram('signaling_queue_wait_seconds', 'Time an SDP negotiation waited for a slot',
+                                           buckets=QUEUE_WAIT_BUCKETS)
+negotiations_refused = metrics.counter('signaling_negotiations_refused_total', 'SDP negotiations turned away', ('reason',))
+
+# Bounds concurrent SDP negotiations and queues the rest, setup before joins;
+# init_app() applies the configured limits
+admission = NegotiationScheduler(wait_observer=negotiation_queue_wait.observe)
+
+# Previous scrape's (time, total) per track and per user, for the rate gauges
+rate_samples = {}
+
+
+def load_assets():
+    """Load the files every client fetches into the asset cache."""
+    if not assets.assets:
+        assets.add('/', TEMPLATE_PATH / 'index.html', 'text/html; charset=utf-8', PAGE_CACHE_CONTROL)
+        assets.add('/static/js/client.js', Path(STATIC_PATH) / 'js' / 'client.js', 'application/javascript; charset=utf-8')
+        assets.add('/static/css/style.css', Path(STATIC_PATH) / 'css' / 'style.css', 'text/css; charset=utf-8')
+    return assets
+
+def new_connection():
+    """Return a fresh RTCPeerConnection, from the pool when one is configured."""
+    connections_created.inc()
+    if pool is not None:
+        return pool.acquire()
+    return RTCPeerConnection()
+
+async def close_connection(pc):
+    """Close `pc` and release the relay subscriptions feeding its senders."""
+    for sender in pc.getSenders():
+        if sender.track is not None:
+            sender.track.stop()
+    # aioice keeps polling its check list after close() until the remote side
+    # has signalled end-of-candidates, which clients that trickle never do.
+    # Signal it here so a connection closed mid-checks does not leak its task.
+    if pc.iceConnectionState in ('new', 'checking'):
+        await pc.addIceCandidate(None)
+    await pc.close()
+
+def room_param(params):
+    """Return the room named in `params`, or the default room."""
+    room = params.get('room') or DEFAULT_ROOM
+    if not isinstance(room, str) or len(room) > MAX_ROOM_LENGTH:
+        raise web.HTTPBadRequest(text=f"Room must be a name of at most {MAX_ROOM_LENGTH} characters")
+    return room
+
+def room_mixer(room):
+    """Return `room`'s AudioMixer, starting one for the room's first user."""
+    mixer = mixers.get(room)
+    if mixer is None:
+        mixer = mixers[room] = AudioMixer()
+        mixer.start()
+    return mixer
+
+async def release_mixer(room, username):
+    """Take `username` out of `room`'s mix, stopping the mixer once it is unused."""
+    mixer = mixers.get(room)
+    if mixer is None:
+        return
+    mixer.remove(username)
+    if not mixer.inputs and not mixer.outputs:
+        del mixers[room]
+        await mixer.stop()
+
+async def cleanup_peer(username):
     """Clean up peer connection resources for a given username."""
-    if username in app_peers_dict:
-        logging.info(f"Attempting to clean up resources for user: {username}")
-        peer_data = app_peers_dict.pop(username, None) # Atomically remove and get
-        if peer_data:
-            if peer_data.get('connection') and peer_data['connection'].signalingState != "closed":
-                logging.info(f"Closing main connection for {username}")
-                await peer_data['connection'].close()
-            
+    if username in sessions:
+        logging.info("Attempting to clean up resources for user: %s", username)
+        # Unregister first (synchronously) so concurrent callbacks see it gone;
+        # this only touches the user's own links and their reverse index.
+        peer, links = sessions.remove(username)
+        if peer:
+            if recordings is not None and username in recordings:
+                await recordings.stop(username)
+            if mixers is not None:
+                await release_mixer(peer.room, username)
+            if peer.connection and peer.connection.signalingState != "closed":
+                logging.info("Closing main connection for %s", username)
+                await close_connection(peer.connection)
+            for track in peer.tracks:
+                relay.remove_source(track)
+
             # Close all P2P connections this peer was involved in
-            for target_peer_name, p2p_conn in peer_data.get('peer_connections', {}).items():
+            for (subscriber, source), p2p_conn in links:
                 if p2p_conn and p2p_conn.signalingState != "closed":
-                    logging.info(f"Closing P2P connection between {username} and {target_peer_name}")
-                    await p2p_conn.close()
-                # Also remove the reverse reference from the target peer
-                if target_peer_name in app_peers_dict and username in app_peers_dict[target_peer_name]['peer_connections']:
-                    del app_peers_dict[target_peer_name]['peer_connections'][username]
-            logging.info(f"Successfully cleaned up resources for user: {username}")
+                    logging.info("Closing P2P connection between %s and %s", subscriber, source)
+                    await close_connection(p2p_conn)
+            logging.info("Successfully cleaned up resources for user: %s", username)
+            await broadcast({'type': 'peer-left', 'username': username}, peer.room)
+            if cluster is not None:
+                await cluster.publish('left', username, peer.room)
         else:
-            logging.info(f"User {username} already cleaned up or not found during cleanup.")
+            logging.info("User %s already cleaned up or not found during cleanup.", username)
 
-async def handle_ice_candidate(request):
-    """Handle incoming ICE candidate from a remote peer."""
-    try:
-        params = await request.json()
-        username = params.get('username')
-        target = params.get('target')
-        candidate_payload = params.get('candidate') # This is the object from client: {sdpMid, sdpMLineIndex, candidate}
-        
-        logging.info(f"Received ICE candidate from {username} to {target}: {candidate}")
-        logging.info(f"Current peers: {list(peers.keys())}")
-        
-        if target == 'server':
-            if username in peers:
-                pc = peers[username]['connection']
-                logging.info(f"Using main connection for {username}")
-            else:
-                logging.warning(f"No main connection found for {username}")
-                return web.Response(status=404, text=f"No connection found for {username}")
-        else:
-            if target in peers and username in peers[target]['peer_connections']:
-                pc = peers[target]['peer_connections'][username]
-                logging.info(f"Using peer connection {username}->{target}")
-            else:
-                if target not in peers:
-                    logging.warning(f"Target peer {target} not found. Available peers: {list(peers.keys())}")
-                else:
-                    logging.warning(f"No peer connection found for {username} in {target}'s connections. Available connections: {list(peers[target]['peer_connections'].keys())}")
-                return web.Response(status=404, text='Peer connection not found')
+def parse_candidate(candidate_payload):
+    """Build an RTCIceCandidate from the client's {sdpMid, sdpMLineIndex, candidate} object.
 
-        try:
-            candidate_string = candidate_payload.get('candidate')
-            client_sdp_mid = candidate_payload.get('sdpMid')
-            client_sdp_mline_index = candidate_payload.get('sdpMLineIndex')
-
-            if not candidate_string:
-                logging.error("ICE candidate string is missing from client payload.")
-                return web.Response(status=400, text="ICE candidate string is missing")
-            if client_sdp_mid is None:
-                logging.error("sdpMid is missing from client payload for ICE candidate.")
-                return web.Response(status=400, text="sdpMid is missing")
-            if client_sdp_mline_index is None: # sdpMLineIndex can be 0
-                logging.error("sdpMLineIndex is missing from client payload for ICE candidate.")
-                return web.Response(status=400, text="sdpMLineIndex is missing")
+    An empty `candidate` string is the browser's end-of-candidates marker and
+    yields None, which addIceCandidate() takes to mean the same.
+    """
+    if not isinstance(candidate_payload, dict):
+        raise web.HTTPBadRequest(text="ICE candidate is missing")
+
+    candidate_string = candidate_payload.get('candidate')
+    client_sdp_mid = candidate_payload.get('sdpMid')
+    client_sdp_mline_index = candidate_payload.get('sdpMLineIndex')
+
+    if candidate_string == '':
+        return None
+    if not candidate_string:
+        logging.error("ICE candidate string is missing from client payload.")
+        raise web.HTTPBadRequest(text="ICE candidate string is missing")
+    if client_sdp_mid is None:
+        logging.error("sdpMid is missing from client payload for ICE candidate.")
+        raise web.HTTPBadRequest(text="sdpMid is missing")
+    if client_sdp_mline_index is None: # sdpMLineIndex can be 0
+        logging.error("sdpMLineIndex is missing from client payload for ICE candidate.")
+        raise web.HTTPBadRequest(text="sdpMLineIndex is missing")
 
+    try:
+        if hasattr(RTCIceCandidate, 'from_string'):
             # For aiortc versions (likely < 1.0) where RTCIceCandidate.__init__
             # does not accept a 'candidate' keyword argument.
             # Use from_string() and then explicitly set sdpMid and sdpMLineIndex.
             ice_candidate_obj = RTCIceCandidate.from_string(candidate_string)
-            
-            # Ensure sdpMid and sdpMLineIndex from the client payload are used,
-            # as these are directly from the browser's event.candidate object.
-            ice_candidate_obj.sdpMid = client_sdp_mid
-            ice_candidate_obj.sdpMLineIndex = client_sdp_mline_index
-
-            # Defensive logging for the candidate string part
-            log_candidate_str_part = ""
-            if hasattr(ice_candidate_obj, 'candidate') and isinstance(ice_candidate_obj.candidate, str): # Modern aiortc
-                log_candidate_str_part = ice_candidate_obj.candidate[:30]
-            elif hasattr(ice_candidate_obj, 'to_string'): # Older aiortc
-                try:
-                    log_candidate_str_part = ice_candidate_obj.to_string()[:30]
-                except Exception:
-                    log_candidate_str_part = "[error getting string]"
-            else: # Fallback to the raw string from client
-                log_candidate_str_part = candidate_string[:30]
+        else:
+            # Current aiortc parses the SDP attribute value, without the "candidate:" prefix
+            if candidate_string.startswith('candidate:'):
+                candidate_string = candidate_string.split(':', 1)[1]
+            ice_candidate_obj = candidate_from_sdp(candidate_string)
+    except Exception as e:
+        logging.error("Error parsing ICE candidate: %s", e)
+        raise web.HTTPBadRequest(text=f"Error processing ICE candidate: {str(e)}")
+
+    # Ensure sdpMid and sdpMLineIndex from the client payload are used,
+    # as these are directly from the browser's event.candidate object.
+    ice_candidate_obj.sdpMid = client_sdp_mid
+    ice_candidate_obj.sdpMLineIndex = client_sdp_mline_index
+    return ice_candidate_obj
+
+def find_connection(username, target):
+    """Return the connection `username`'s candidates for `target` belong to, if registered."""
+    if target == 'server':
+        peer = sessions.get(username)
+        return peer.connection if peer is not None else None
+    return sessions.get_link(username, target)
 
-            logging.info(f"Adding ICE candidate for {target} (from {username}): sdpMid={ice_candidate_obj.sdpMid}, sdpMLineIndex={ice_candidate_obj.sdpMLineIndex}, candidate_str_part={log_candidate_str_part}...")
+async def apply_candidates(pc, candidates, username, target):
+    """Add a batch of parsed candidates to `pc`; return {position in batch: error} for those refused."""
+    candidate_log.info("Adding %s ICE candidates for %s (from %s)", len(candidates), target, username,
+                       extra={'username': username, 'target': target, 'count': len(candidates)})
+    errors = {}
+    for position, ice_candidate_obj in enumerate(candidates):
+        try:
             await pc.addIceCandidate(ice_candidate_obj)
-            return web.Response(status=200)
         except Exception as e: # More general catch for addIceCandidate issues
-            logging.error(f"Error processing or adding ICE candidate: {str(e)}")
-            return web.Response(status=400, text=f"Error processing or adding ICE candidate: {str(e)}")
+            logging.error("Error adding ICE candidate: %s", e)
+            errors[position] = f"Error adding ICE candidate: {e}"
+    return errors
+
+async def flush_pending_candidates(username, target, pc):
+    """Apply candidates that arrived before `pc` had its remote description."""
+    candidates = pending_candidates.pop((username, target))
+    if candidates:
+        await apply_candidates(pc, candidates, username, target)
+
+@handler_seconds.labels('ice_candidate').time
+async def add_ice_candidate(params):
+    """Add trickled ICE candidates to the connection they belong to.
 
+    Accepts either a single `candidate` or a `candidates` array. Candidates for
+    a connection that is not registered yet, or has no remote description,
+    are queued and applied once negotiation reaches that point. Entries are
+    taken one by one: a bad entry is reported under `rejected` (by its index
+    in the batch) without losing the rest, and only a batch with nothing
+    usable is refused outright.
+    """
+    username = params.get('username')
+    target = params.get('target')
+    payloads = params.get('candidates')
+    if payloads is None:
+        payloads = [params.get('candidate')] # This is the object from client: {sdpMid, sdpMLineIndex, candidate}
+    if not isinstance(payloads, list) or not payloads:
+        raise web.HTTPBadRequest(text="ICE candidates are missing")
+    if not username or not target:
+        raise web.HTTPBadRequest(text='Username and target are required')
+
+    candidate_log.info("Received %s ICE candidates from %s to %s", len(payloads), username, target,
+                       extra={'username': username, 'target': target, 'count': len(payloads)})
+    indexes = [] # Batch index of each entry in `candidates`
+    candidates = []
+    rejected = []
+    end_of_candidates = None
+    for index, payload in enumerate(payloads):
+        try:
+            candidate = parse_candidate(payload)
+        except web.HTTPBadRequest as e:
+            rejected.append({'index': index, 'error': e.text})
+            continue
+        if candidate is None:
+            end_of_candidates = index # Applied after every candidate of the batch
+            continue
+        indexes.append(index)
+        candidates.append(candidate)
+    if end_of_candidates is not None:
+        indexes.append(end_of_candidates)
+        candidates.append(None)
+    if not candidates:
+        raise web.HTTPBadRequest(text=rejected[0]['error'])
+
+    pc = find_connection(username, target)
+    if pc is None or pc.remoteDescription is None:
+        if target != 'server' and not sessions.is_listed(target):
+            logging.warning("Target peer %s not found (%s local peers in %s rooms)", target, len(sessions), len(sessions.rooms()))
+            raise web.HTTPNotFound(text='Peer connection not found')
+        queued = pending_candidates.add((username, target), candidates)
+        if queued is None:
+            candidate_log.warning("Early ICE candidate queue is full; refusing candidates from %s to %s", username, target,
+                                  extra={'username': username, 'target': target, 'count': len(candidates)})
+            raise web.HTTPServiceUnavailable(headers={'Retry-After': str(pending_candidates.retry_after())},
+                                             text='Too many connections are waiting for candidates')
+        candidate_log.info("Queued %s early ICE candidates from %s to %s", queued, username, target,
+                           extra={'username': username, 'target': target, 'count': queued})
+        result = {'queued': queued}
+    else:
+        errors = await apply_candidates(pc, candidates, username, target)
+        rejected.extend({'index': indexes[position], 'error': error} for position, error in errors.items())
+        result = {'added': len(candidates) - len(errors)}
+    if rejected:
+        result['rejected'] = sorted(rejected, key=lambda entry: entry['index'])
+    return result
+
+async def handle_ice_candidate(request):
+    """Handle incoming ICE candidates from a remote peer."""
+    try:
+        params = await request.json()
+        result = await add_ice_candidate(params)
+        return web.json_response(result, status=202 if 'queued' in result else 200)
+    except web.HTTPException as e:
+        return web.Response(status=e.status, text=e.text, headers=e.headers)
     except Exception as e:
-        logging.error(f"Error handling ICE candidate: {str(e)}")
+        logging.error("Error handling ICE candidate: %s", e)
         return web.Response(status=500, text=str(e))
 
+@admission.admit(PRIORITY_SETUP)
+@handler_seconds.labels('connect_peer').time
+async def negotiate_peer(params):
+    """Answer a client's offer for a P2P relay connection to a remote peer."""
+    username = params.get('username')
+    target = params.get('target')
+    sdp = params.get('sdp')
+    sdp_type = params.get('type')
+
+    # Validate required parameters
+    if not username:
+        raise web.HTTPBadRequest(text='Username is required')
+    if not target:
+        raise web.HTTPBadRequest(text='Target is required')
+    if not sdp:
+        raise web.HTTPBadRequest(text='SDP is required')
+    if not sdp_type:
+        raise web.HTTPBadRequest(text='SDP type is required')
+
+    # Ensure the initiating user ('username') is already known (i.e., has called /offer)
+    if username not in sessions:
+        logging.warning("Initiator user '%s' for connect-peer not found. User must call /offer first.", username)
+        raise web.HTTPNotFound(text=f"Initiating user '{username}' not found. Please establish a server connection first via /offer.")
+
+    # Media is only relayed between users of the same room
+    room = sessions.get(username).room
+    if params.get('room') is not None and params['room'] != room:
+        raise web.HTTPConflict(text=f"{username} is in room {room}")
+    if sessions.room_of(target) != room:
+        raise web.HTTPNotFound(text='Target peer not found')
+    if sessions.get_link(username, target) is None and sessions.subscription_count(username) >= reaper.max_links:
+        raise web.HTTPTooManyRequests(text=f"{username} already holds {reaper.max_links} peer connections")
+
+    logging.info("Connecting peers: %s -> %s", username, target)
+
+    # Create a new peer connection for the target
+    pc = new_connection()
+    
+    @pc.on("iceconnectionstatechange")
+    async def on_iceconnectionstatechange():
+        logging.info("P2P ICE connection state between %s and %s is %s", username, target, pc.iceConnectionState)
+        if pc.iceConnectionState == "failed" or pc.iceConnectionState == "closed" or pc.iceConnectionState == "disconnected":
+            logging.warning("P2P connection %s<->%s failed/closed/disconnected. Cleaning up %s's side.", username, target, username)
+            await cleanup_peer_p2p_connection(username, target, pc) # Cleanup this specific P2P
+
+    @pc.on("track")
+    async def on_track(track):
+        logging.info("Track received on connection %s->%s: %s", username, target, track.kind)
+        # This track is from 'target' and is being sent to 'username' over their P2P connection.
+        # The server typically doesn't need to process this track in a simple P2P setup;
+        # it's handled by 'username's client.
+        # The previous logic incorrectly added this track to username's own outgoing tracks.
+        logging.info("P2P track (%s) received from %s for %s on their direct connection.", track.kind, target, username)
+
+    # Store the P2P connection, indexed under both users.
+    # It's crucial that both users are still listed after their /offer calls.
+    if username in sessions and sessions.is_listed(target):
+        previous = sessions.add_link(username, target, pc)
+        if previous is not None and previous.signalingState != "closed":
+            logging.info("Replacing existing P2P connection %s->%s", username, target)
+            await close_connection(previous)
+    else:
+        logging.error("Cannot establish P2P: %s or %s not found in session registry.", username, target)
+        await close_connection(pc) # Clean up the newly created PC
+        raise web.HTTPNotFound(text=f"Initiator {username} or target {target} not found.")
+
+    # Set up the offer
+    offer = RTCSessionDescription(sdp=sdp, type=sdp_type)
+    await pc.setRemoteDescription(offer)
+    await flush_pending_candidates(username, target, pc)
+    
+    # Add existing tracks from the target peer to this connection
+    if target in sessions:
+        target_tracks = sessions.get(target).tracks
+        layers = sessions.get(target).layers
+    else:
+        target_tracks = await cluster.remote_tracks(target) # Cascaded from the owning shard
+        layers = {} # Cascades carry the best layer only
+    layered = set(layers.values())
+    for track in target_tracks:
+        if track in layered:
+            continue
+        if track.kind == 'audio' and mixers is not None and target in sessions:
+            continue # Already in the subscriber's mix
+        pc.addTrack(relay.subscribe(track))
+        logging.info("Added existing %s track from %s to %s's new P2P connection with %s", track.kind, target, username, target)
+
+    # Simulcast senders get one video track whose layer follows this subscriber's link quality
+    selector = None
+    if layers:
+        selector = LayerSelector(layers, relay, f"{target}->{username}")
+        selector.attach(pc)
+        logging.info("Added %s video layer from %s to %s's new P2P connection with %s", selector.layer, target, username, target)
+    
+    # Create and send answer
+    answer = await pc.createAnswer()
+    await pc.setLocalDescription(answer)
+    if selector is not None:
+        selector.start()
+
+    response_data = {
+        'sdp': pc.localDescription.sdp,
+        'type': pc.localDescription.type
+    }
+    
+    return response_data
+
 async def connect_peer(request):
     """Connect to a remote peer."""
     try:
         params = await request.json()
-        username = params.get('username')
-        target = params.get('target')
-        sdp = params.get('sdp')
-        sdp_type = params.get('type')
-
-        # Validate required parameters
-        if not username:
-            raise web.HTTPBadRequest(text='Username is required')
-        if not target:
-            raise web.HTTPBadRequest(text='Target is required')
-        if not sdp:
-            raise web.HTTPBadRequest(text='SDP is required')
-        if not sdp_type:
-            raise web.HTTPBadRequest(text='SDP type is required')
-
-        if target not in peers:
-            raise web.HTTPNotFound(text='Target peer not found')
-
-        # Ensure the initiating user ('username') is already known (i.e., has called /offer)
-        if username not in peers:
-            logging.warning(f"Initiator user '{username}' for connect-peer not found. User must call /offer first.")
-            raise web.HTTPNotFound(text=f"Initiating user '{username}' not found. Please establish a server connection first via /offer.")
-
-        logging.info(f"Connecting peers: {username} -> {target}")
-
-        # Create a new peer connection for the target
-        pc = RTCPeerConnection()
-        
-        @pc.on("iceconnectionstatechange")
-        async def on_iceconnectionstatechange():
-            logging.info(f"P2P ICE connection state between {username} and {target} is {pc.iceConnectionState}")
-            if pc.iceConnectionState == "failed" or pc.iceConnectionState == "closed" or pc.iceConnectionState == "disconnected":
-                logging.warning(f"P2P connection {username}<->{target} failed/closed/disconnected. Cleaning up {username}'s side.")
-                await cleanup_peer_p2p_connection(username, target, pc) # Cleanup this specific P2P
-
-        @pc.on("track")
-        async def on_track(track):
-            logging.info(f"Track received on connection {username}->{target}: {track.kind}")
-            # This track is from 'target' and is being sent to 'username' over their P2P connection.
-            # The server typically doesn't need to process this track in a simple P2P setup;
-            # it's handled by 'username's client.
-            # The previous logic incorrectly added this track to peers[username]['tracks'] (username's outgoing tracks).
-            logging.info(f"P2P track ({track.kind}) received from {target} for {username} on their direct connection.")
-
-        # Store the P2P connection.
-        # It's crucial that peers[username] and peers[target] exist from their /offer calls.
-        if username in peers and target in peers:
-            peers[username]['peer_connections'][target] = pc
-            peers[target]['peer_connections'][username] = pc # Bidirectional reference to the same pc object
-        else:
-            logging.error(f"Cannot establish P2P: {username} or {target} not found in peers dictionary.")
-            await pc.close() # Clean up the newly created PC
-            raise web.HTTPNotFound(text=f"Initiator {username} or target {target} not found.")
-
-        # Set up the offer
-        offer = RTCSessionDescription(sdp=sdp, type=sdp_type)
-        await pc.setRemoteDescription(offer)
-        
-        # Add existing tracks from the target peer to this connection
-        if target in peers:
-            for track in peers[target].get('tracks', []): # Ensure 'tracks' key exists
-                pc.addTrack(track)
-                logging.info(f"Added existing {track.kind} track from {target} to {username}'s new P2P connection with {target}")
-        
-        # Create and send answer
-        answer = await pc.createAnswer()
-        await pc.setLocalDescription(answer)
-
-        response_data = {
-            'sdp': pc.localDescription.sdp,
-            'type': pc.localDescription.type
-        }
-        
-        return web.Response(
-            content_type='application/json',
-            text=json.dumps(response_data)
-        )
+        return web.json_response(await negotiate_peer(params))
+    except web.HTTPException:
+        raise
     except Exception as e:
-        logging.error(f"Error connecting peers: {str(e)}")
+        logging.error("Error connecting peers: %s", e)
         raise web.HTTPInternalServerError(text=str(e))
 
-async def cleanup_peer_p2p_connection(user_a, user_b, pc_to_close):
-    """Cleans up a specific P2P connection between two users."""
-    logging.info(f"Cleaning up P2P connection between {user_a} and {user_b}")
+async def cleanup_peer_p2p_connection(subscriber, source, pc_to_close):
+    """Cleans up the P2P connection relaying `source`'s media to `subscriber`."""
+    logging.info("Cleaning up P2P connection between %s and %s", subscriber, source)
     if pc_to_close and pc_to_close.signalingState != "closed":
-        await pc_to_close.close()
+        await close_connection(pc_to_close)
 
-    if user_a in peers and user_b in peers[user_a].get('peer_connections', {}):
-        del peers[user_a]['peer_connections'][user_b]
-        logging.info(f"Removed P2P conn {user_a}->{user_b}")
+    if sessions.remove_link(subscriber, source, pc_to_close) is not None:
+        logging.info("Removed P2P conn %s->%s", subscriber, source)
 
-    if user_b in peers and user_a in peers[user_b].get('peer_connections', {}):
-        del peers[user_b]['peer_connections'][user_a]
-        logging.info(f"Removed P2P conn {user_b}->{user_a}")
+def list_peers(params):
+    """Return the usernames of every peer in the requesting one's room except itself."""
+    username = params.get('username')
+    if not username:
+        raise web.HTTPBadRequest(text='Username is required')
+
+    room = sessions.room_of(username) or room_param(params)
+    roster = sessions.roster(room)
+    if roster is None:
+        return {'peers': [], 'version': 0}
+
+    # Clients that pass the roster version they last saw get only the changes
+    since = params.get('since')
+    if isinstance(since, int):
+        changes = roster.changes_since(since)
+        if changes is not None:
+            joined, left = changes
+            return {'joined': [peer for peer in joined if peer != username], 'left': left, 'version': roster.version}
+
+    # Get list of all peers in the room except the requesting one
+    return {'peers': [peer for peer in roster.names() if peer != username], 'version': roster.version}
 
 async def notify_new_peer(request):
     """Notify about new peer joining."""
     try:
         params = await request.json()
-        username = params.get('username')
-        if not username:
-            raise web.HTTPBadRequest(text='Username is required')
-        
-        # Get list of all peers except the requesting one
-        other_peers = [peer for peer in peers.keys() if peer != username]
-        
-        return web.Response(
-            content_type='application/json',
-            text=json.dumps({'peers': other_peers})
-        )
+        return web.json_response(list_peers(params))
+    except web.HTTPException:
+        raise
     except Exception as e:
-        logging.error(f"Error in notify_new_peer: {str(e)}")
+        logging.error("Error in notify_new_peer: %s", e)
         raise web.HTTPInternalServerError(text=str(e))
 
+@admission.admit(PRIORITY_JOIN)
+@handler_seconds.labels('offer').time
+async def negotiate_offer(params):
+    """Answer a client's offer for its main server connection."""
+    username = params.get('username')
+    sdp = params.get('sdp')
+    sdp_type = params.get('type')
+
+    # Validate required parameters
+    if not username:
+        raise web.HTTPBadRequest(text='Username is required')
+    if not sdp:
+        raise web.HTTPBadRequest(text='SDP is required')
+    if not sdp_type:
+        raise web.HTTPBadRequest(text='SDP type is required')
+    room = room_param(params)
+
+    # Optional simulcast: {mid: layer name} for video tracks sent as layers
+    layer_mids = params.get('layers') or {}
+    if not isinstance(layer_mids, dict) or not all(isinstance(name, str) and name in LAYER_NAMES
+                                                   for name in layer_mids.values()):
+        raise web.HTTPBadRequest(text=f"Layers must map mids to one of {', '.join(LAYER_NAMES)}")
+
+    logging.info("Received offer from %s for room %s", username, room)
+
+    # A re-offer keeps the user in its room; moving means leaving first
+    peer = sessions.get(username)
+    if peer is not None and peer.room != room:
+        raise web.HTTPConflict(text=f"{username} is already in room {peer.room}")
+
+    # Create new peer connection for this user
+    pc = new_connection()
+
+    # Initialize or update peer state
+    is_new_peer = peer is None
+    if is_new_peer:
+        peer = sessions.add(username, pc, room)
+    else:
+        # User is re-offering. Close old main connection, update to new one.
+        if peer.connection:
+            logging.info("User %s is re-offering. Closing old main server connection.", username)
+            await close_connection(peer.connection)
+        peer.connection = pc
+        # The old connection's tracks ended with it: release them, and close the
+        # links that carried them. Subscribers are told to resubscribe below;
+        # links this user receives over are unaffected and kept.
+        if recordings is not None and username in recordings:
+            await recordings.stop(username)
+        for track in peer.tracks:
+            relay.remove_source(track)
+        peer.tracks = []
+        peer.layers = {}
+        for subscriber, link in sessions.subscribers_of(username):
+            sessions.remove_link(subscriber, username, link)
+            await close_connection(link)
+
+    @pc.on("track")
+    async def on_track(track):
+        logging.info("Track %s received from %s on main server connection.", track.kind, username)
+        # Store user's own track if not already present
+        # This list (`peer.tracks`) holds tracks *sent by* this username to the server.
+        if sessions.get(username) is peer and track not in peer.tracks:
+            peer.tracks.append(track)
+            relay.add_source(track)
+            tracks_received.inc()
+            logging.info("Stored %s track from %s.", track.kind, username)
+            mid = next((t.mid for t in pc.getTransceivers() if t.receiver.track is track), None)
+            if track.kind == 'video' and mid in layer_mids:
+                peer.layers[layer_mids[mid]] = track
+                logging.info("Track is the %s simulcast layer from %s.", layer_mids[mid], username)
+                return # Layers are forwarded by each subscriber's LayerSelector
+            if track.kind == 'audio' and mixers is not None:
+                room_mixer(room).add_input(username, relay.subscribe(track))
+                logging.info("Mixing audio from %s.", username)
+                return
+        elif sessions.get(username) is peer:
+            logging.info("%s track from %s already stored.", track.kind, username)
+        else:
+            logging.warning("Could not store track from %s as peer entry not fully initialized or track already present.", username)
+            return
+
+        # Forward this track from 'username' to the peers subscribed to it
+        for target_peer_name, p2p_conn in sessions.subscribers_of(username):
+            if p2p_conn and p2p_conn.signalingState != "closed":
+                try:
+                    logging.info("Attempting to forward %s track from %s to %s.", track.kind, username, target_peer_name)
+                    p2p_conn.addTrack(relay.subscribe(track))
+                except Exception as e: # Consider more specific exceptions like aiortc.InvalidStateError
+                    logging.error("Error forwarding %s track from %s to %s: %s", track.kind, username, target_peer_name, e)
+
+    @pc.on("iceconnectionstatechange")
+    async def on_iceconnectionstatechange():
+        logging.info("Main server connection ICE state for %s is %s", username, pc.iceConnectionState)
+        if pc.iceConnectionState == "failed" or pc.iceConnectionState == "closed" or pc.iceConnectionState == "disconnected":
+            logging.warning("Main server connection for %s failed/closed. Cleaning up peer.", username)
+            if sessions.get(username) is peer and peer.connection is pc: # Ignore connections replaced by a re-offer
+                await cleanup_peer(username)
+
+    # Set up the offer
+    offer = RTCSessionDescription(sdp=sdp, type=sdp_type)
+    await pc.setRemoteDescription(offer)
+    await flush_pending_candidates(username, 'server', pc)
+
+    # With mixing on, everyone else's audio comes back on this connection
+    if mixers is not None:
+        pc.addTrack(room_mixer(room).add_output(username))
+    
+    # Create and send answer
+    answer = await pc.createAnswer()
+    await pc.setLocalDescription(answer)
+
+    if is_new_peer:
+        await broadcast({'type': 'peer-joined', 'username': username}, room, exclude=username)
+    else:
+        await broadcast({'type': 'peer-rejoined', 'username': username}, room, exclude=username)
+    if cluster is not None:
+        # Published on re-offers too, so other shards drop stale cascades
+        await cluster.publish('joined', username, room, [t.kind for t in peer.primary_tracks()])
+
+    # A new user's room may already have members on other nodes
+    if is_new_peer and cluster is not None:
+        await sync_rooms([room])
+
+    # Get list of other connected peers in the room
+    other_peers = sessions.others(username)
+    
+    return {
+        'sdp': pc.localDescription.sdp,
+        'type': pc.localDescription.type,
+        'room': room,
+        'otherPeers': other_peers
+    }
+
 async def offer(request):
     """Handle offer from remote peer."""
     try:
         params = await request.json()
-        username = params.get('username')
-        sdp = params.get('sdp')
-        sdp_type = params.get('type')
-
-        # Validate required parameters
-        if not username:
-            raise web.HTTPBadRequest(text='Username is required')
-        if not sdp:
-            raise web.HTTPBadRequest(text='SDP is required')
-        if not sdp_type:
-            raise web.HTTPBadRequest(text='SDP type is required')
-
-        logging.info(f"Received offer from {username}")
-
-        # Create new peer connection for this user
-        pc = RTCPeerConnection()
-
-        # Initialize or update peer state
-        if username not in peers:
-            peers[username] = {
-                'connection': pc,
-                'peer_connections': {},
-                'tracks': []
-            }
-        else:
-            # User is re-offering. Close old main connection, update to new one.
-            if peers[username].get('connection'):
-                logging.info(f"User {username} is re-offering. Closing old main server connection.")
-                await peers[username]['connection'].close()
-            peers[username]['connection'] = pc
-            # Decide on re-offer strategy:
-            # Option A: Preserve P2P connections and tracks (current implicit behavior if not cleared)
-            # Option B: Clear P2P connections and tracks, forcing re-establishment
-            # For simplicity and to avoid breaking existing P2P, let's preserve them for now.
-            # If Option B is desired:
-            # for p2p_target, p2p_conn_obj in list(peers[username]['peer_connections'].items()): # list() for safe iteration
-            #     await cleanup_peer_p2p_connection(username, p2p_target, p2p_conn_obj)
-            # peers[username]['peer_connections'] = {}
-            # peers[username]['tracks'] = []
-
-            # To match original implicit behavior of clearing P2P on re-offer:
-            # peers[username]['peer_connections'] = {}
-            # peers[username]['tracks'] = [] # And reset tracks
-
-        @pc.on("track")
-        async def on_track(track):
-            logging.info(f"Track {track.kind} received from {username} on main server connection.")
-            # Store user's own track if not already present
-            # This list (`peers[username]['tracks']`) holds tracks *sent by* this username to the server.
-            if username in peers and track not in peers[username]['tracks']:
-                peers[username]['tracks'].append(track)
-                logging.info(f"Stored {track.kind} track from {username}.")
-            elif username in peers and track in peers[username]['tracks']:
-                logging.info(f"{track.kind} track from {username} already stored.")
-            else:
-                logging.warning(f"Could not store track from {username} as peer entry not fully initialized or track already present.")
-
-            # Forward this track from 'username' to other peers 'username' is directly connected to
-            if username in peers and 'peer_connections' in peers[username]:
-                for target_peer_name, p2p_conn in peers[username]['peer_connections'].items():
-                    if p2p_conn and p2p_conn.signalingState != "closed":
-                        try:
-                            logging.info(f"Attempting to forward {track.kind} track from {username} to {target_peer_name}.")
-                            p2p_conn.addTrack(track)
-                        except Exception as e: # Consider more specific exceptions like aiortc.InvalidStateError
-                            logging.error(f"Error forwarding {track.kind} track from {username} to {target_peer_name}: {str(e)}")
-
-        @pc.on("iceconnectionstatechange")
-        async def on_iceconnectionstatechange():
-            logging.info(f"Main server connection ICE state for {username} is {pc.iceConnectionState}")
-            if pc.iceConnectionState == "failed" or pc.iceConnectionState == "closed" or pc.iceConnectionState == "disconnected":
-                logging.warning(f"Main server connection for {username} failed/closed. Cleaning up peer.")
-                await cleanup_peer(username, peers) # Pass the global peers dict
-
-        # Set up the offer
-        offer = RTCSessionDescription(sdp=sdp, type=sdp_type)
-        await pc.setRemoteDescription(offer)
-        
-        # Create and send answer
-        answer = await pc.createAnswer()
-        await pc.setLocalDescription(answer)
-
-        # Get list of other connected peers
-        other_peers = [peer for peer in peers.keys() if peer != username]
-        
-        return web.Response(
-            content_type='application/json',
-            text=json.dumps({
-                'sdp': pc.localDescription.sdp,
-                'type': pc.localDescription.type,
-                'otherPeers': other_peers
-            })
-        )
+        return web.json_response(await negotiate_offer(params))
+    except web.HTTPException:
+        raise
+    except Exception as e:
+        logging.error("Error processing offer: %s", e)
+        raise web.HTTPInternalServerError(text=str(e))
+
+async def apply_answer(params):
+    """Apply a client's answer to an existing P2P relay connection."""
+    username = params.get('username')
+    target = params.get('target')
+
+    if not all([username, target]):
+        raise web.HTTPBadRequest(text='Username and target are required')
+
+    if not sessions.is_listed(target):
+        raise web.HTTPNotFound(text='Target peer not found')
+
+    pc = sessions.get_link(username, target)
+    if pc is None:
+        raise web.HTTPNotFound(text='Connection not found')
+
+    answer = RTCSessionDescription(sdp=params['sdp'], type=params['type'])
+    await pc.setRemoteDescription(answer)
+
+async def start_recording(params):
+    """Start recording the tracks a local user sends to the server."""
+    username = params.get('username')
+    if not username:
+        raise web.HTTPBadRequest(text='Username is required')
+    if recordings is None:
+        raise web.HTTPNotFound(text='Recording is not enabled on this server')
+    peer = sessions.get(username)
+    if peer is None or not peer.tracks:
+        raise web.HTTPNotFound(text=f"No tracks from {username} to record")
+    if username in recordings:
+        raise web.HTTPConflict(text=f"{username} is already being recorded")
+    if not recordings.start(username, peer.primary_tracks()):
+        raise web.HTTPServiceUnavailable(text='Too many recordings in progress')
+    logging.info("Started recording %s", username)
+    return {'recording': username}
+
+async def stop_recording(params):
+    """Stop a user's recording and report what was written."""
+    username = params.get('username')
+    if not username:
+        raise web.HTTPBadRequest(text='Username is required')
+    if recordings is None or username not in recordings:
+        raise web.HTTPNotFound(text=f"{username} is not being recorded")
+    stats = await recordings.stop(username)
+    logging.info("Stopped recording %s after %s segments", username, len(stats['segments']))
+    return stats
+
+async def recording_start(request):
+    """Handle a request to start recording a user."""
+    try:
+        params = await request.json()
+        return web.json_response(await start_recording(params))
+    except web.HTTPException:
+        raise
     except Exception as e:
-        logging.error(f"Error processing offer: {str(e)}")
+        logging.error("Error starting recording: %s", e)
+        raise web.HTTPInternalServerError(text=str(e))
+
+async def recording_stop(request):
+    """Handle a request to stop recording a user."""
+    try:
+        params = await request.json()
+        return web.json_response(await stop_recording(params))
+    except web.HTTPException:
+        raise
+    except Exception as e:
+        logging.error("Error stopping recording: %s", e)
+        raise web.HTTPInternalServerError(text=str(e))
+
+async def audio_levels(request):
+    """Report each mixed user's smoothed audio level and who is speaking in a room."""
+    if mixers is None:
+        raise web.HTTPNotFound(text='Audio mixing is not enabled on this server')
+    mixer = mixers.get(room_param(request.query))
+    if mixer is None:
+        return web.json_response({'levels': {}, 'speaking': []})
+    return web.json_response({'levels': mixer.levels, 'speaking': mixer.speaking()})
+
+async def announce_speakers():
+    """Push each room's set of speaking users to its sockets whenever it changes."""
+    announced = {} # room -> speaking users last pushed
+    while True:
+        await asyncio.sleep(SPEAKER_INTERVAL)
+        for room, mixer in list(mixers.items()):
+            speaking = mixer.speaking()
+            if speaking != announced.get(room, []):
+                announced[room] = speaking
+                levels = {username: round(level, 3) for username, level in mixer.levels.items()}
+                await broadcast({'type': 'audio-levels', 'speaking': speaking, 'levels': levels}, room)
+        for room in [room for room in announced if room not in mixers]:
+            del announced[room]
+
+async def drain_room(params):
+    """Disconnect every local user in a room so it can be closed or moved."""
+    room = params.get('room')
+    if not room:
+        raise web.HTTPBadRequest(text='Room is required')
+    members = sessions.members(room)
+    if not members:
+        raise web.HTTPNotFound(text=f"No users in room {room} on this server")
+
+    # Tell clients first; once cleaned up they are no longer in the room to hear it
+    await broadcast({'type': 'room-closed', 'room': room}, room)
+    for peer in members:
+        await cleanup_peer(peer.username)
+    logging.info("Drained %s users from room %s", len(members), room)
+    return {'room': room, 'drained': [peer.username for peer in members]}
+
+async def room_drain(request):
+    """Handle an operator's request to drain a room; only accepted from localhost."""
+    if request.remote not in LOCAL_ADDRESSES:
+        raise web.HTTPForbidden()
+    try:
+        params = await request.json()
+        return web.json_response(await drain_room(params))
+    except web.HTTPException:
+        raise
+    except Exception as e:
+        logging.error("Error draining room: %s", e)
         raise web.HTTPInternalServerError(text=str(e))
 
 async def answer(request):
     """Handle answer from remote peer."""
     try:
         params = await request.json()
-        username = params.get('username')
-        target = params.get('target')
-        
-        if not all([username, target]):
-            raise web.HTTPBadRequest(text='Username and target are required')
-            
-        if target not in peers:
-            raise web.HTTPNotFound(text='Target peer not found')
-            
-        peer_data = peers[target]
-        if username in peer_data['peer_connections']:
-            pc = peer_data['peer_connections'][username]
-            answer = RTCSessionDescription(sdp=params['sdp'], type=params['type'])
-            await pc.setRemoteDescription(answer)
-            return web.Response(status=200)
-            
-        return web.HTTPNotFound(text='Connection not found')
+        await apply_answer(params)
+        return web.Response(status=200)
+    except web.HTTPException:
+        raise
     except Exception as e:
-        logging.error(f"Error processing answer: {str(e)}")
+        logging.error("Error processing answer: %s", e)
         raise web.HTTPInternalServerError(text=str(e))
 
-def init_app():
-    """Create and configure the application."""
-    app = web.Application()
+def check_cluster_token(request):
+    """Reject internal requests without the cluster token, when one is configured."""
+    if cluster_token is None:
+        return
+    # Constant-time, so response timing does not reveal how much of a guess matched
+    if not hmac.compare_digest(request.headers.get(CLUSTER_TOKEN_HEADER, '').encode(), cluster_token.encode()):
+        raise web.HTTPForbidden()
+
+async def presence_handler(request):
+    """Apply a join/leave event from another shard."""
+    check_cluster_token(request)
+    await apply_presence(await request.json())
+    return web.Response(status=200)
+
+async def apply_presence(message):
+    """Apply a join/leave of a user served elsewhere and push it to local sockets."""
+    is_new = await cluster.apply_presence(message)
+    if message['event'] == 'joined':
+        room = message.get('room', DEFAULT_ROOM)
+        if sessions.join(message['username'], room):
+            await broadcast({'type': 'peer-joined', 'username': message['username']}, room)
+        elif not is_new:
+            # A re-offer: the cascade carrying the old tracks was dropped
+            await broadcast({'type': 'peer-rejoined', 'username': message['username']}, room)
+    else:
+        room = sessions.leave(message['username'])
+        if room is not None:
+            await broadcast({'type': 'peer-left', 'username': message['username']}, room)
+
+async def sync_rooms(rooms, complete=False):
+    """Apply the joins and leaves the cluster link has pulled for `rooms`."""
+    for message in await cluster.poll(rooms, complete):
+        await apply_presence(message)
+
+async def sync_directory():
+    """Keep the rosters of rooms with local users in step with the session directory."""
+    while True:
+        await asyncio.sleep(DIRECTORY_SYNC_INTERVAL)
+        try:
+            await sync_rooms({peer.room for peer in sessions}, complete=True)
+        except Exception as e:
+            logging.error("Session directory sync failed: %s", e)
+
+@web.middleware
+async def route_to_owner(request, handler):
+    """Forward signaling for a user owned by another node to that node."""
+    if request.method != 'POST' or request.path not in ROUTED_PATHS or FORWARDED_HEADER in request.headers:
+        return await handler(request)
+    body = await request.read() # Cached, so the handler can still read it
+    try:
+        username = json.loads(body).get('username')
+    except (ValueError, AttributeError):
+        return await handler(request) # Let the handler report the bad request
+    if not username or username in sessions:
+        return await handler(request)
+    owner = await cluster.owner_of(username)
+    if owner is None or owner == cluster.index:
+        return await handler(request)
+    return await cluster.forward(owner, request.path, body)
+
+async def subscription_handler(request):
+    """Answer another shard's offer to receive a local user's tracks."""
+    check_cluster_token(request)
+    params = await request.json()
+    username = params.get('username')
+    peer = sessions.get(username)
+    if peer is None:
+        raise web.HTTPNotFound(text=f"{username} is not served by this worker")
+
+    # Registered like a P2P link so the usual cleanup paths close it
+    key = f"@worker{params.get('worker')}"
+    pc = new_connection()
+    previous = sessions.add_link(key, username, pc)
+    if previous is not None:
+        await close_connection(previous)
+
+    @pc.on("iceconnectionstatechange")
+    async def on_iceconnectionstatechange():
+        logging.info("Cascade of %s to %s ICE state is %s", username, key, pc.iceConnectionState)
+        if pc.iceConnectionState == "failed" or pc.iceConnectionState == "closed" or pc.iceConnectionState == "disconnected":
+            await cleanup_peer_p2p_connection(key, username, pc)
+
+    await pc.setRemoteDescription(RTCSessionDescription(sdp=params['sdp'], type=params['type']))
+    for track in peer.primary_tracks():
+        pc.addTrack(relay.subscribe(track))
+    await pc.setLocalDescription(await pc.createAnswer())
+    return web.json_response({'sdp': pc.localDescription.sdp, 'type': pc.localDescription.type})
+
+def process_usage():
+    """Return this process's CPU time in seconds and resident memory in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # Peak, where /proc is unavailable
+    return {'cpu_seconds': time.process_time(), 'rss_bytes': rss, 'open_fds': open_files()}
+
+async def stats_handler(request):
+    """Report internal counters as JSON."""
+    stats = {
+        'peers': len(sessions),
+        'links': sessions.link_count(),
+        'rooms': len(sessions.rooms()),
+        'sockets': len(sockets),
+        'relay': relay.stats(),
+        'pending_candidates': pending_candidates.stats(),
+        'process': process_usage(),
+        'reaper': reaper.stats(),
+        'admission': admission.stats(),
+    }
+    if pool is not None:
+        stats['pool'] = pool.stats()
+    if recordings is not None:
+        stats['recordings'] = recordings.stats()
+    if mixers is not None:
+        stats['mixers'] = {room: mixer.stats() for room, mixer in mixers.items()}
+    return web.json_response(stats)
+
+def sample_rate(key, total, now):
+    """Return the per-second rate of `total` since the previous scrape, remembering it."""
+    previous = rate_samples.get(key)
+    rate_samples[key] = (now, total)
+    if previous is None or now <= previous[0]:
+        return 0.0
+    return max(total - previous[1], 0) / (now - previous[0])
+
+@metrics.collector
+async def collect_metrics():
+    """Fill in the current-state gauges for a /metrics scrape."""
+    states = collections.Counter()
+    for peer in sessions:
+        states['main', peer.connection.connectionState] += 1
+    for key, pc in sessions.links():
+        states['link', pc.connectionState] += 1
+    for role in ('main', 'link'):
+        for state in CONNECTION_STATES:
+            connection_states.labels(role, state).set(states[role, state])
+
+    tracks_stored.set(sum(len(peer.tracks) for peer in sessions))
+    rooms_active.set(len(sessions.rooms()))
+    for (role, reason), count in reaper.reclaimed.items():
+        connections_reaped.labels(role, reason).set(count)
+    if pool is not None:
+        pool_checkouts.labels('hit').set(pool.hits)
+        pool_checkouts.labels('miss').set(pool.misses)
+        pool_saved_seconds.set(pool.saved_seconds)
+        pool_build_seconds.set(pool.build_seconds)
+        pool_idle.set(len(pool))
+    admitted = admission.stats()
+    negotiations_active.set(admitted['active'])
+    negotiation_queue_depth.set(admitted['queued'])
+    for reason in ('rejected', 'expired', 'rate_limited'):
+        negotiations_refused.labels(reason).set(admitted[reason])
+    tracks_forwarded.set(relay.stats()['subscribers'])
+
+    # Per-track figures come from the relay's counters and the receivers' RTCP state
+    now = time.monotonic()
+    live_tracks = set()
+    live_users = set()
+    for peer in list(sessions):
+        layer_names = {track: name for name, track in peer.layers.items()}
+        transport_bytes = None
+        for receiver in peer.connection.getReceivers():
+            track = receiver.track
+            if track not in peer.tracks:
+                continue
+            labels = (peer.username, track.kind, layer_names.get(track, ''))
+            live_tracks.add(labels)
+            report = await receiver.getStats()
+            track_packets_lost.labels(*labels).set(sum(s.packetsLost for s in report.values() if s.type == 'inbound-rtp'))
+            transport_bytes = next((s.bytesReceived for s in report.values() if s.type == 'transport'), transport_bytes)
+            relayed = relay.source_stats(track)
+            if relayed is not None:
+                frames, dropped, subscribers = relayed
+                track_frames.labels(*labels).set(frames)
+                track_frames_dropped.labels(*labels).set(dropped)
+                track_subscribers.labels(*labels).set(subscribers)
+                track_fps.labels(*labels).set(sample_rate(labels, frames, now))
+        # aiortc counts bytes per transport, not per track, so bitrate is per connection
+        if transport_bytes is not None:
+            live_users.add((peer.username,))
+            peer_received_bytes.labels(peer.username).set(transport_bytes)
+            peer_bitrate.labels(peer.username).set(8 * sample_rate(peer.username, transport_bytes, now))
+
+    for metric in (track_frames, track_frames_dropped, track_fps, track_packets_lost, track_subscribers):
+        metric.retain(live_tracks)
+    for metric in (peer_received_bytes, peer_bitrate):
+        metric.retain(live_users)
+    for key in [key for key in rate_samples if key not in live_tracks and (key,) not in live_users]:
+        del rate_samples[key]
+
+async def metrics_handler(request):
+    """Serve metrics in the Prometheus text exposition format."""
+    return web.Response(body=(await metrics.render()).encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+# Signaling messages accepted over the WebSocket, mapped to the same coroutines
+# that back the REST routes.
+SIGNALING_HANDLERS = {
+    'offer': negotiate_offer,
+    'connect-peer': negotiate_peer,
+    'answer': apply_answer,
+    'candidate': add_ice_candidate,
+    'roster': list_peers,
+}
+
+async def broadcast(message, room, exclude=None):
+    """Push a signaling event to the open WebSocket of everyone in `room` except `exclude`."""
+    roster = sessions.roster(room)
+    if roster is None:
+        return
+    targets = [sockets[name] for name in roster.names()
+               if name != exclude and name in sockets and not sockets[name].closed]
+    if not targets:
+        return
+    data = json.dumps(message) # Serialize once for all recipients
+    results = await asyncio.gather(*(ws.send_str(data) for ws in targets), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logging.warning("Failed to push %s event: %s", message['type'], result)
+
+async def dispatch_signal(username, message):
+    """Run one signaling message from `username` and build its reply."""
+    handler = SIGNALING_HANDLERS.get(message.get('type'))
+    if handler is None:
+        return {'status': 400, 'error': f"Unknown message type: {message.get('type')}"}
+
+    data = message.get('data')
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return {'status': 400, 'error': 'Message data must be a JSON object'}
+
+    # The socket is bound to its username; never trust one sent in the message.
+    params = dict(data, username=username)
+    try:
+        result = handler(params)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return {'status': 200, 'data': result}
+    except web.HTTPException as e:
+        reply = {'status': e.status, 'error': e.text}
+        if 'Retry-After' in e.headers:
+            reply['retryAfter'] = int(e.headers['Retry-After'])
+        return reply
+    except Exception as e:
+        logging.error("Error handling %s message from %s: %s", message.get('type'), username, e)
+        return {'status': 500, 'error': str(e)}
+
+async def websocket_handler(request):
+    """Multiplex signaling for one user over a persistent WebSocket."""
+    username = request.query.get('username')
+    if not username:
+        raise web.HTTPBadRequest(text='Username is required')
+
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+
+    previous = sockets.get(username)
+    sockets[username] = ws
+    if previous is not None and not previous.closed:
+        logging.info("Replacing existing signaling socket for %s", username)
+        await previous.close()
+    logging.info("Signaling socket opened for %s", username)
+
+    try:
+        # Messages are handled in arrival order so that candidates are never
+        # applied before the offer that creates their connection.
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            try:
+                message = json.loads(msg.data)
+            except ValueError:
+                await ws.send_json({'type': 'error', 'error': 'Invalid JSON'})
+                continue
+            if not isinstance(message, dict):
+                await ws.send_json({'type': 'error', 'error': 'Messages must be JSON objects'})
+                continue
+
+            reply = await dispatch_signal(username, message)
+            if message.get('id') is not None:
+                reply.update(type='reply', id=message['id'])
+                await ws.send_json(reply)
+            elif reply['status'] != 200:
+                await ws.send_json(dict(reply, type='error'))
+    finally:
+        if sockets.get(username) is ws:
+            del sockets[username]
+        logging.info("Signaling socket closed for %s", username)
+    return ws
+
+async def drain_peers(app_instance):
+    """Tell every client the server is going away, then close all connections."""
+    for room in sessions.rooms():
+        await broadcast({'type': 'room-closed', 'room': room}, room)
+    peers = [peer.username for peer in sessions]
+    try:
+        await asyncio.wait_for(asyncio.gather(*(cleanup_peer(username) for username in peers)), DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.warning("Shutdown drain timed out with %s peers left", len(sessions))
+    for ws in list(sockets.values()):
+        await ws.close(code=WSCloseCode.GOING_AWAY, message=b'Server shutdown')
+    logging.info("Drained %s peers for shutdown", len(peers))
+
+def init_app(pool_size=0, record_dir=None, max_recordings=4, segment_seconds=60.0, audio_mix=False,
+             directory_path=None, node_url=None, token=None, connect_timeout=CONNECT_TIMEOUT,
+             idle_timeout=IDLE_TIMEOUT, max_links_per_user=MAX_LINKS_PER_USER,
+             max_negotiations=MAX_NEGOTIATIONS, max_queued=MAX_QUEUED, max_queue_wait=MAX_QUEUE_WAIT,
+             user_rate=USER_RATE, user_burst=USER_BURST):
+    """Create and configure the application.
+
+    With `directory_path`, this process is the node at `node_url` among
+    several sharing an SQLite session directory.
+    """
+    global pool, recordings, mixers, cluster, cluster_token, reaper
+    middlewares = []
+    if directory_path is not None:
+        if not token:
+            raise ValueError('A session directory requires a cluster token')
+        cluster = NodeLink(node_url, SqliteDirectory(directory_path), relay, token)
+        cluster_token = token
+        middlewares.append(route_to_owner)
+    app = web.Application(middlewares=middlewares)
     
     # Configure CORS with proper options
     cors = aiohttp_cors.setup(app, defaults={
@@ -375,12 +1128,18 @@ def init_app():
         )
     })    # Create routes with CORS support
     routes = [
-        web.get('/', index),
         web.post('/offer', offer),
         web.post('/answer', answer),
         web.post('/ice-candidate', handle_ice_candidate),
         web.post('/connect-peer', connect_peer),
-        web.post('/notify-new-peer', notify_new_peer)
+        web.post('/notify-new-peer', notify_new_peer),
+        web.get('/ws', websocket_handler),
+        web.get('/stats', stats_handler),
+        web.get('/metrics', metrics_handler),
+        web.post('/recording/start', recording_start),
+        web.post('/recording/stop', recording_stop),
+        web.get('/audio-levels', audio_levels),
+        web.post('/rooms/drain', room_drain)
     ]
     
     # Add routes and enable CORS
@@ -388,25 +1147,177 @@ def init_app():
         app.router.add_route(route.method, route.path, route.handler)
         cors.add(app.router.add_resource(route.path))
     
-    # Add static route for serving CSS and JavaScript files
-    # Use absolute path to avoid any path resolution issues
-    static_path = str(Path(__file__).parent / 'static')
-    app.router.add_static('/static/', static_path)
+    # The page, script and stylesheet come from memory; anything else under
+    # /static/ falls through to the plain static route
+    load_assets().add_routes(app.router)
+    app.router.add_static('/static/', STATIC_PATH)
 
     # Apply CORS to all routes
     for route in list(app.router.routes()):
         cors.add(route)
 
-    # Pass the peers dictionary to cleanup tasks if needed, e.g., on shutdown
-    # async def on_shutdown(app_instance):
-    #    for peer_name in list(peers.keys()): # list() for safe iteration
-    #        await cleanup_peer(peer_name, peers)
-    # app.on_shutdown.append(on_shutdown)
+    # Keep pre-built connections ready for offers
+    if pool_size > 0:
+        pool = ConnectionPool(pool_size)
+
+        async def start_pool(app_instance):
+            pool.start()
+
+        async def close_pool(app_instance):
+            await pool.close()
+        app.on_startup.append(start_pool)
+        app.on_cleanup.append(close_pool)
+
+    # Recording is opt-in; writer threads are only created when it is enabled
+    if record_dir is not None:
+        recordings = RecordingManager(record_dir, relay, max_recordings, segment_seconds)
+
+        async def close_recordings(app_instance):
+            await recordings.close()
+        app.on_cleanup.append(close_recordings)
+
+    # One mix-minus-self audio track per user instead of one per pair; each
+    # room's mixer starts with its first user
+    if audio_mix:
+        mixers = {}
+
+        async def start_mixer(app_instance):
+            app_instance['speakers'] = asyncio.ensure_future(announce_speakers())
+
+        async def stop_mixer(app_instance):
+            app_instance['speakers'].cancel()
+            for mixer in mixers.values():
+                await mixer.stop()
+            mixers.clear()
+        app.on_startup.append(start_mixer)
+        app.on_cleanup.append(stop_mixer)
+
+    # Measure event-loop lag for as long as the app runs
+    async def start_lag_monitor(app_instance):
+        app_instance['lag_monitor'] = asyncio.ensure_future(monitor_loop_lag(loop_lag_seconds, loop_lag))
+
+    async def stop_lag_monitor(app_instance):
+        app_instance['lag_monitor'].cancel()
+    app.on_startup.append(start_lag_monitor)
+    app.on_cleanup.append(stop_lag_monitor)
+
+    # Cluster-internal routes; workers only listen on localhost, nodes check the token.
+    # Nodes pull presence from the directory, so they never accept it over HTTP.
+    if cluster is not None:
+        if not isinstance(cluster, NodeLink):
+            app.router.add_post('/internal/presence', presence_handler)
+        app.router.add_post('/internal/subscribe', subscription_handler)
+
+    # Nodes announce themselves in the directory and follow the rosters of their rooms
+    if isinstance(cluster, NodeLink):
+        async def start_directory_sync(app_instance):
+            await cluster.directory.heartbeat(cluster.index)
+            app_instance['directory_sync'] = asyncio.ensure_future(sync_directory())
+
+        async def stop_directory_sync(app_instance):
+            app_instance['directory_sync'].cancel()
+            await cluster.close()
+        app.on_startup.append(start_directory_sync)
+        app.on_cleanup.append(stop_directory_sync)
+
+    # Reclaim connections the ICE callbacks missed, for as long as the app runs
+    reaper = Reaper(sessions, cleanup_peer, cleanup_peer_p2p_connection, lambda: process_usage()['rss_bytes'],
+                    connect_timeout=connect_timeout, idle_timeout=idle_timeout, max_links=max_links_per_user)
+
+    async def start_reaper(app_instance):
+        reaper.start()
+
+    async def stop_reaper(app_instance):
+        reaper.stop()
+    app.on_startup.append(start_reaper)
+    app.on_cleanup.append(stop_reaper)
+    app.on_shutdown.append(drain_peers)
+
+    # Limits on concurrent and per-user SDP negotiation
+    admission.concurrency = max_negotiations
+    admission.max_queued = max_queued
+    admission.max_wait = max_queue_wait
+    admission.rate = user_rate
+    admission.burst = user_burst
     return app
 
 # Run the application
 if __name__ == '__main__':
-    app = init_app()
-    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-    ssl_context.load_cert_chain('ssl/cert.pem', 'ssl/key.pem')
-    web.run_app(app, host='0.0.0.0', port=8443, ssl_context=ssl_context)
+    parser = argparse.ArgumentParser(description='WebRTC video chat server')
+    parser.add_argument('--host', default='0.0.0.0', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8443, help='Port to listen on')
+    parser.add_argument('--cert', default='ssl/cert.pem', help='TLS certificate file')
+    parser.add_argument('--key', default='ssl/key.pem', help='TLS private key file')
+    parser.add_argument('--http', action='store_true', help='Serve plain HTTP instead of HTTPS (local testing only)')
+    parser.add_argument('--pool-size', type=int, default=0,
+                        help='Keep this many pre-built peer connections ready for offers (0 disables the pool)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Shard users across this many worker processes (0 runs everything in this process)')
+    parser.add_argument('--worker-base-port', type=int, default=9000,
+                        help='First localhost port used by worker processes')
+    parser.add_argument('--record-dir',
+                        help='Enable /recording/start and write recordings under this directory')
+    parser.add_argument('--max-recordings', type=int, default=4, help='Recordings that may run at once')
+    parser.add_argument('--segment-seconds', type=float, default=60.0, help='Length of each recorded file')
+    parser.add_argument('--audio-mix', action='store_true',
+                        help='Send each user one mix of everyone else\'s audio instead of a track per user')
+    parser.add_argument('--directory',
+                        help='Share users with other nodes through this SQLite session directory file')
+    parser.add_argument('--node-url',
+                        help='Base URL other nodes reach this one at (required with --directory)')
+    parser.add_argument('--cluster-token',
+                        help='Shared secret other nodes must send to internal routes (required with --directory)')
+    parser.add_argument('--connect-timeout', type=float, default=CONNECT_TIMEOUT,
+                        help='Close connections that are not connected after this many seconds')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='Close connections that receive nothing for this many seconds (0 disables)')
+    parser.add_argument('--max-links-per-user', type=int, default=MAX_LINKS_PER_USER,
+                        help='Peer connections one user may receive media over')
+    parser.add_argument('--max-negotiations', type=int, default=MAX_NEGOTIATIONS,
+                        help='SDP negotiations run at once; the rest wait in a queue')
+    parser.add_argument('--negotiation-queue', type=int, default=MAX_QUEUED,
+                        help='Negotiations that may wait; more are refused with 503 and Retry-After')
+    parser.add_argument('--negotiation-wait', type=float, default=MAX_QUEUE_WAIT,
+                        help='Seconds a negotiation may wait before it is refused with 503')
+    parser.add_argument('--user-rate', type=float, default=USER_RATE,
+                        help='Negotiations per second one user may sustain (0 disables the limit)')
+    parser.add_argument('--user-burst', type=int, default=USER_BURST,
+                        help='Negotiations one user may make in a burst above --user-rate')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='Discard log records below this level before formatting them')
+    parser.add_argument('--log-json', action='store_true', help='Write one JSON object per log record')
+    parser.add_argument('--candidate-log-sample', type=int, default=1,
+                        help='Log only one in every N per-candidate signaling records')
+    args = parser.parse_args()
+    if args.directory and not args.node_url:
+        parser.error('--directory requires --node-url')
+    if args.directory and not args.cluster_token:
+        parser.error('--directory requires --cluster-token')
+    if args.directory and args.workers > 0:
+        parser.error('--directory cannot be combined with --workers')
+    if args.max_negotiations < 1:
+        parser.error('--max-negotiations must be at least 1')
+
+    log_options = {'level': args.log_level, 'json_format': args.log_json, 'candidate_sample': args.candidate_log_sample}
+    setup_logging(**log_options)
+
+    ssl_context = None
+    if not args.http:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(args.cert, args.key)
+
+    app_options = {'pool_size': args.pool_size, 'record_dir': args.record_dir,
+                   'max_recordings': args.max_recordings, 'segment_seconds': args.segment_seconds,
+                   'audio_mix': args.audio_mix, 'directory_path': args.directory,
+                   'node_url': args.node_url, 'token': args.cluster_token,
+                   'connect_timeout': args.connect_timeout, 'idle_timeout': args.idle_timeout,
+                   'max_links_per_user': args.max_links_per_user,
+                   'max_negotiations': args.max_negotiations, 'max_queued': args.negotiation_queue,
+                   'max_queue_wait': args.negotiation_wait, 'user_rate': args.user_rate,
+                   'user_burst': args.user_burst}
+    if args.workers > 0:
+        from workers import run_cluster
+        run_cluster(args.workers, args.host, args.port, ssl_context, args.worker_base_port, app_options, log_options)
+    else:
+        app = init_app(**app_options)
+        web.run_app(app, host=args.host, port=args.port, ssl_context=ssl_context)
@@ -8,8 +8,20 @@ document.addEventListener('DOMContentLoaded', () => {
     const peerConnections = new Map(); // Store all peer connections
 
     let localStream = null;
+    let lowVideoTrack = null; // Reduced-resolution copy of the camera sent as the 'low' simulcast layer
     let localUsername = '';
+    // Users only see and receive media from others in the same room, e.g. /?room=standup
+    const localRoom = new URLSearchParams(window.location.search).get('room') || 'default';
     let checkNewPeersInterval;
+    let rosterVersion = null; // Last roster version seen while polling
+    let signalingSocket = null; // Persistent signaling channel; REST routes are the fallback
+    let nextRequestId = 1;
+    const pendingRequests = new Map(); // WebSocket request id -> {resolve, reject}
+    const pendingIceCandidates = new Map(); // target -> candidates waiting to be sent
+    const ICE_BATCH_DELAY_MS = 50;
+    // Times a signaling request refused with Retry-After is tried again
+    const SIGNAL_RETRIES = 5;
+    const LOW_LAYER_CONSTRAINTS = { width: { max: 320 }, height: { max: 240 }, frameRate: { max: 15 } };
 
     muteButton.addEventListener('click', () => {
         console.log('Mute button clicked (listener attached on DOMContentLoaded)');
@@ -35,6 +47,9 @@ document.addEventListener('DOMContentLoaded', () => {
             if (videoTracks.length > 0) {
                 const videoTrack = videoTracks[0];
                 videoTrack.enabled = !videoTrack.enabled;
+                if (lowVideoTrack) {
+                    lowVideoTrack.enabled = videoTrack.enabled;
+                }
                 videoButton.textContent = videoTrack.enabled ? 'Stop Video' : 'Start Video';
                 console.log(`Video track enabled: ${videoTrack.enabled}`);
             } else {
@@ -82,6 +97,165 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    function openSignalingSocket(username) {
+        return new Promise((resolve) => {
+            const scheme = window.location.protocol === 'https:' ? 'wss' : 'ws';
+            let ws;
+            try {
+                ws = new WebSocket(`${scheme}://${window.location.host}/ws?username=${encodeURIComponent(username)}`);
+            } catch (error) {
+                console.warn('WebSocket signaling unavailable, falling back to HTTP:', error);
+                resolve(null);
+                return;
+            }
+
+            ws.onopen = () => {
+                console.log('Signaling socket open');
+                signalingSocket = ws;
+                resolve(ws);
+            };
+            ws.onmessage = (event) => handleSignalingMessage(JSON.parse(event.data));
+            ws.onerror = (error) => {
+                console.warn('Signaling socket error:', error);
+                resolve(null); // No-op if already resolved by onopen
+            };
+            ws.onclose = () => {
+                console.log('Signaling socket closed');
+                if (signalingSocket === ws) {
+                    signalingSocket = null;
+                }
+                pendingRequests.forEach(({ reject }) => reject(new Error('Signaling socket closed')));
+                pendingRequests.clear();
+                // Fall back to polling for roster changes while the socket is gone
+                if (localUsername && !checkNewPeersInterval) {
+                    checkNewPeersInterval = setInterval(checkForNewPeers, 5000);
+                }
+                resolve(null);
+            };
+        });
+    }
+
+    function handleSignalingMessage(message) {
+        switch (message.type) {
+            case 'reply': {
+                const pending = pendingRequests.get(message.id);
+                if (pending) {
+                    pendingRequests.delete(message.id);
+                    pending.resolve(message);
+                }
+                break;
+            }
+            case 'peer-joined':
+                console.log(`Peer joined: ${message.username}`);
+                if (message.username !== localUsername && !peerConnections.has(message.username)) {
+                    connectToPeer(message.username);
+                }
+                break;
+            case 'peer-rejoined':
+                // Their media restarted; links carrying the old tracks were closed
+                console.log(`Peer rejoined: ${message.username}`);
+                removeParticipant(message.username);
+                connectToPeer(message.username);
+                break;
+            case 'peer-left':
+                console.log(`Peer left: ${message.username}`);
+                removeParticipant(message.username);
+                break;
+            case 'audio-levels':
+                highlightSpeakers(message.speaking);
+                break;
+            case 'room-closed':
+                console.warn(`Room ${message.room} was closed by the server`);
+                leaveRoom();
+                break;
+            case 'error':
+                console.error('Signaling error:', message.error);
+                break;
+            default:
+                console.warn('Unknown signaling message:', message);
+        }
+    }
+
+    // Send a signaling request over the WebSocket when it is open, otherwise
+    // POST it to the equivalent REST route. Requests the server turns away
+    // for load (503) or rate (429) are retried after its Retry-After, with
+    // jitter so refused clients do not all come back at once.
+    async function signal(type, path, data) {
+        for (let attempt = 0; ; attempt++) {
+            const reply = await sendSignal(type, path, data);
+            if (reply.status === 200) {
+                return reply.data;
+            }
+            if (reply.retryAfter === undefined || attempt >= SIGNAL_RETRIES) {
+                throw new Error(`${type} failed: ${reply.status} - ${reply.error}`);
+            }
+            const delay = reply.retryAfter * 1000 * (1 + Math.random());
+            console.warn(`${type} refused (${reply.status}), retrying in ${Math.round(delay)} ms`);
+            await new Promise(resolve => setTimeout(resolve, delay));
+        }
+    }
+
+    async function sendSignal(type, path, data) {
+        if (signalingSocket && signalingSocket.readyState === WebSocket.OPEN) {
+            const id = nextRequestId++;
+            return new Promise((resolve, reject) => {
+                pendingRequests.set(id, { resolve, reject });
+                signalingSocket.send(JSON.stringify({ type, id, data }));
+            });
+        }
+
+        const response = await fetch(path, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ username: localUsername, ...data })
+        });
+        const text = await response.text();
+        if (!response.ok) {
+            const retryAfter = response.headers.get('Retry-After');
+            return { status: response.status, error: text, retryAfter: retryAfter === null ? undefined : Number(retryAfter) };
+        }
+        return { status: 200, data: text ? JSON.parse(text) : null };
+    }
+
+    // Gathering emits candidates in quick bursts; each burst is sent as one
+    // request. The server queues candidates that arrive before it is ready.
+    function queueIceCandidate(targetUsername, candidate) {
+        let batch = pendingIceCandidates.get(targetUsername);
+        if (!batch) {
+            batch = [];
+            pendingIceCandidates.set(targetUsername, batch);
+            setTimeout(() => sendIceCandidates(targetUsername), ICE_BATCH_DELAY_MS);
+        }
+        batch.push(candidate);
+    }
+
+    async function sendIceCandidates(targetUsername) {
+        const candidates = pendingIceCandidates.get(targetUsername);
+        pendingIceCandidates.delete(targetUsername);
+        if (!candidates || candidates.length === 0) {
+            return;
+        }
+
+        console.log(`Sending ${candidates.length} ICE candidates to ${targetUsername}`);
+        try {
+            if (signalingSocket && signalingSocket.readyState === WebSocket.OPEN) {
+                // Fire-and-forget: failures come back as 'error' messages
+                signalingSocket.send(JSON.stringify({
+                    type: 'candidate',
+                    data: { target: targetUsername, candidates: candidates }
+                }));
+                return;
+            }
+
+            await signal('candidate', '/ice-candidate', {
+                target: targetUsername,
+                candidates: candidates
+            });
+        } catch (error) {
+            console.error('Error sending ICE candidates:', error);
+        }
+    }
+
     async function createPeerConnection(targetUsername) {
 
         console.log(`Creating peer connection for ${targetUsername}`);
@@ -97,6 +271,14 @@ document.addEventListener('DOMContentLoaded', () => {
           
         pc.ontrack = (event) => {            
             console.log(`Received track from ${targetUsername}:`, event.track.kind);
+
+            // In audio mixing mode the server sends everyone else's voices as one track
+            if (targetUsername === 'server') {
+                if (event.track.kind === 'audio') {
+                    playMixedAudio(event.track);
+                }
+                return;
+            }
             
             // Always create a new MediaStream for the track
             const stream = new MediaStream([event.track]);
@@ -161,34 +343,16 @@ document.addEventListener('DOMContentLoaded', () => {
             videos.forEach(v => console.log(` - ${v.getAttribute('data-peer')}`));
         };
 
-        pc.onicecandidate = async (event) => {
+        pc.onicecandidate = (event) => {
             if (event.candidate) {
-                try {
-                    const candidate = {
-                        sdpMid: event.candidate.sdpMid,
-                        sdpMLineIndex: event.candidate.sdpMLineIndex,
-                        candidate: event.candidate.candidate
-                    };
-                    
-                    console.log('Sending ICE candidate:', candidate);
-                    
-                    const response = await fetch('/ice-candidate', {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({
-                            username: localUsername,
-                            target: targetUsername,
-                            candidate: candidate
-                        })
-                    });
-                    
-                    if (!response.ok) {
-                        const error = await response.text();
-                        throw new Error(`Failed to send ICE candidate: ${response.status} - ${error}`);
-                    }
-                } catch (error) {
-                    console.error('Error sending ICE candidate:', error);
-                }
+                const candidate = {
+                    sdpMid: event.candidate.sdpMid,
+                    sdpMLineIndex: event.candidate.sdpMLineIndex,
+                    candidate: event.candidate.candidate
+                };
+
+                console.log('Queueing ICE candidate:', candidate);
+                queueIceCandidate(targetUsername, candidate);
             }
         };        
         
@@ -203,6 +367,28 @@ document.addEventListener('DOMContentLoaded', () => {
         return pc;
     }
 
+    function playMixedAudio(track) {
+        let audio = document.querySelector('audio[data-peer="server"]');
+        if (!audio) {
+            audio = document.createElement('audio');
+            audio.autoplay = true;
+            audio.setAttribute('data-peer', 'server');
+            document.body.appendChild(audio);
+        }
+        audio.srcObject = new MediaStream([track]);
+        audio.play().catch(e => console.error('Error playing mixed audio:', e));
+    }
+
+    // Mark the users the server hears speaking and move their videos to the front
+    function highlightSpeakers(speaking) {
+        participantView.querySelectorAll('video[data-peer]').forEach(video => {
+            const container = video.parentElement === participantView ? video : video.parentElement;
+            const isSpeaking = speaking.includes(video.getAttribute('data-peer'));
+            container.classList.toggle('speaking', isSpeaking);
+            container.style.order = isSpeaking ? -1 : '';
+        });
+    }
+
     function removeParticipant(username) {
         console.log(`Removing participant: ${username}`);
         const video = document.querySelector(`video[data-peer="${username}"]`);
@@ -234,10 +420,23 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // Drop every connection and remote participant; the local preview stays
+    function leaveRoom() {
+        Array.from(peerConnections.keys()).forEach(peer => {
+            if (peer !== 'server') {
+                removeParticipant(peer);
+            }
+        });
+        if (peerConnections.has('server')) {
+            peerConnections.get('server').close();
+            peerConnections.delete('server');
+        }
+    }
+
     async function joinSession(username) {
         try {
             localUsername = username;
-            console.log(`Joining session as ${username}`);
+            console.log(`Joining room ${localRoom} as ${username}`);
 
             // Get user media first
             localStream = await navigator.mediaDevices.getUserMedia({ 
@@ -262,6 +461,9 @@ document.addEventListener('DOMContentLoaded', () => {
             participantView.appendChild(localVideo);
             console.log('Added local video element');            
             
+            // Open the signaling channel before negotiating so the offer can use it
+            await openSignalingSocket(username);
+
             // Create server connection
             const pc = await createPeerConnection('server');
             peerConnections.set('server', pc);
@@ -272,6 +474,7 @@ document.addEventListener('DOMContentLoaded', () => {
                     pc.addTrack(track, localStream);
                     console.log(`Added ${track.kind} track to server connection`);
                 });
+                await addLowVideoLayer(pc);
             }
 
             // Wait a moment for tracks to be processed
@@ -285,21 +488,12 @@ document.addEventListener('DOMContentLoaded', () => {
             await pc.setLocalDescription(offer);
             console.log('Created initial offer:', offer);
 
-            const response = await fetch('/offer', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({
-                    username: username,
-                    type: offer.type,
-                    sdp: offer.sdp
-                })
+            const data = await signal('offer', '/offer', {
+                type: offer.type,
+                sdp: offer.sdp,
+                room: localRoom,
+                layers: simulcastLayers(pc)
             });
-
-            if (!response.ok) {
-                throw new Error('Failed to send offer');
-            }
-
-            const data = await response.json();
             console.log('Received server response:', data);
             await pc.setRemoteDescription(new RTCSessionDescription({
                 type: data.type,
@@ -314,8 +508,8 @@ document.addEventListener('DOMContentLoaded', () => {
                 }
             }
 
-            // Start checking for new peers periodically
-            if (!checkNewPeersInterval) { // Start only if not already started
+            // Roster changes are pushed over the signaling socket; poll only without it
+            if (!signalingSocket && !checkNewPeersInterval) { // Start only if not already started
                 checkNewPeersInterval = setInterval(checkForNewPeers, 5000);
             }
         } catch (error) {
@@ -324,6 +518,43 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }    
     
+    // The server forwards each subscriber the best layer its link can sustain,
+    // so send a second, cheaper copy of the camera alongside the full one.
+    async function addLowVideoLayer(pc) {
+        const videoTrack = localStream.getVideoTracks()[0];
+        if (!videoTrack) {
+            return;
+        }
+        const clone = videoTrack.clone();
+        try {
+            await clone.applyConstraints(LOW_LAYER_CONSTRAINTS);
+        } catch (error) {
+            console.warn('Could not create low video layer, sending a single layer:', error);
+            clone.stop();
+            return;
+        }
+        lowVideoTrack = clone;
+        pc.addTrack(lowVideoTrack, localStream);
+        console.log('Added low video layer to server connection');
+    }
+
+    // Map each simulcast video sender's mid to its layer name for the /offer request
+    function simulcastLayers(pc) {
+        if (!lowVideoTrack) {
+            return null;
+        }
+        const layers = {};
+        pc.getTransceivers().forEach(transceiver => {
+            const track = transceiver.sender.track;
+            if (track === lowVideoTrack) {
+                layers[transceiver.mid] = 'low';
+            } else if (track && track.kind === 'video') {
+                layers[transceiver.mid] = 'high';
+            }
+        });
+        return layers;
+    }
+
     async function connectToPeer(targetUsername) {
         try {
             console.log(`Connecting to peer ${targetUsername}`);
@@ -354,22 +585,12 @@ document.addEventListener('DOMContentLoaded', () => {
             // Set local description first
             await pc.setLocalDescription(offer);
 
-            const response = await fetch('/connect-peer', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({
-                    username: localUsername,
-                    target: targetUsername,
-                    type: offer.type,
-                    sdp: offer.sdp
-                })
+            const data = await signal('connect-peer', '/connect-peer', {
+                target: targetUsername,
+                room: localRoom,
+                type: offer.type,
+                sdp: offer.sdp
             });
-
-            if (!response.ok) {
-                throw new Error('Failed to connect to peer');
-            }
-
-            const data = await response.json();
             await pc.setRemoteDescription(new RTCSessionDescription({
                 type: data.type,
                 sdp: data.sdp
@@ -393,15 +614,20 @@ document.addEventListener('DOMContentLoaded', () => {
             const response = await fetch('/notify-new-peer', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ username: localUsername })
+                body: JSON.stringify({ username: localUsername, room: localRoom, since: rosterVersion })
             });
 
             if (!response.ok) {
                 throw new Error('Failed to check for new peers');
             }
 
+            // The server answers with only the changes since `rosterVersion`
+            // when it still has them, and with the full roster otherwise.
             const data = await response.json();
-            const newPeers = data.peers.filter(peer => !peerConnections.has(peer));
+            rosterVersion = data.version;
+            (data.left || []).forEach(peer => removeParticipant(peer));
+            const candidates = data.peers || data.joined || [];
+            const newPeers = candidates.filter(peer => !peerConnections.has(peer));
             
             if (newPeers.length > 0) {
                 console.log('Found new peers:', newPeers);
@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from admission import PRIORITY_JOIN, PRIORITY_SETUP, NegotiationScheduler
+
+
+async def hold(scheduler, name, priority, log, seconds=0.01):
+    async with scheduler.slot(name, priority):
+        log.append(name)
+        await asyncio.sleep(seconds)
+
+
+def test_setup_runs_before_joins_and_joins_stay_in_order():
+    async def main():
+        scheduler = NegotiationScheduler(concurrency=1, rate=0)
+        log = []
+        first = asyncio.ensure_future(hold(scheduler, 'first', PRIORITY_JOIN, log))
+        await asyncio.sleep(0)
+        queued = [asyncio.ensure_future(hold(scheduler, name, priority, log))
+                  for name, priority in (('j1', PRIORITY_JOIN), ('j2', PRIORITY_JOIN), ('setup', PRIORITY_SETUP))]
+        await asyncio.gather(first, *queued)
+        return scheduler, log
+
+    scheduler, log = asyncio.run(main())
+    assert log == ['first', 'setup', 'j1', 'j2']
+    assert scheduler.stats()['active'] == 0
+    assert scheduler.stats()['delayed'] == 3
+
+
+def test_cancelled_waiter_passes_its_turn_on():
+    async def main():
+        scheduler = NegotiationScheduler(concurrency=1, rate=0)
+        log = []
+        first = asyncio.ensure_future(hold(scheduler, 'first', PRIORITY_JOIN, log))
+        await asyncio.sleep(0)
+        gone = asyncio.ensure_future(hold(scheduler, 'gone', PRIORITY_SETUP, log))
+        last = asyncio.ensure_future(hold(scheduler, 'last', PRIORITY_JOIN, log))
+        await asyncio.sleep(0)
+        gone.cancel()
+        await asyncio.gather(first, last)
+        return scheduler, log
+
+    scheduler, log = asyncio.run(main())
+    assert log == ['first', 'last']
+    assert scheduler.stats()['active'] == 0
+    assert scheduler.stats()['queued'] == 0
+
+
+def test_waiter_times_out_with_503_and_frees_nothing():
+    async def main():
+        scheduler = NegotiationScheduler(concurrency=1, max_wait=0.05, rate=0)
+        log = []
+        long = asyncio.ensure_future(hold(scheduler, 'long', PRIORITY_JOIN, log, seconds=0.2))
+        await asyncio.sleep(0)
+        with pytest.raises(web.HTTPServiceUnavailable) as refused:
+            await hold(scheduler, 'late', PRIORITY_JOIN, log)
+        assert scheduler.stats()['active'] == 1 # Still held by 'long'
+        await long
+        # The expired entry must not swallow the next handoff
+        await hold(scheduler, 'next', PRIORITY_JOIN, log)
+        return scheduler, log, refused.value
+
+    scheduler, log, refused = asyncio.run(main())
+    assert log == ['long', 'next']
+    assert refused.headers['Retry-After'] == '1'
+    assert scheduler.stats()['expired'] == 1
+    assert scheduler.stats()['active'] == 0
+
+
+def test_full_queue_is_refused_at_once():
+    async def main():
+        scheduler = NegotiationScheduler(concurrency=1, max_queued=1, rate=0)
+        log = []
+        running = [asyncio.ensure_future(hold(scheduler, name, PRIORITY_JOIN, log)) for name in ('a', 'b')]
+        await asyncio.sleep(0)
+        with pytest.raises(web.HTTPServiceUnavailable):
+            await hold(scheduler, 'c', PRIORITY_JOIN, log)
+        await asyncio.gather(*running)
+        return scheduler, log
+
+    scheduler, log = asyncio.run(main())
+    assert log == ['a', 'b']
+    assert scheduler.stats()['rejected'] == 1
+
+
+def test_rate_limit_is_per_user():
+    async def main():
+        scheduler = NegotiationScheduler(rate=1.0, burst=2)
+        log = []
+        await hold(scheduler, 'a', PRIORITY_JOIN, log, seconds=0)
+        await hold(scheduler, 'a', PRIORITY_JOIN, log, seconds=0)
+        with pytest.raises(web.HTTPTooManyRequests) as limited:
+            await hold(scheduler, 'a', PRIORITY_JOIN, log, seconds=0)
+        await hold(scheduler, 'b', PRIORITY_JOIN, log, seconds=0)
+        return scheduler, log, limited.value
+
+    scheduler, log, limited = asyncio.run(main())
+    assert log == ['a', 'a', 'b']
+    assert limited.headers['Retry-After'] == '1'
+    assert scheduler.stats()['rate_limited'] == 1
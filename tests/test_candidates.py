@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+
+import candidates
+import server
+from candidates import PendingCandidates
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_candidates_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(candidates.time, 'monotonic', clock)
+    pending = PendingCandidates(ttl=30.0)
+
+    assert pending.add(('a', 'server'), ['c1', 'c2']) == 2
+    clock.now += 10
+    assert pending.add(('b', 'server'), ['c3']) == 1
+    assert pending.add(('a', 'server'), ['c4']) == 1 # Joins the entry, keeping its deadline
+
+    clock.now += 20
+    assert pending.pop(('a', 'server')) == []
+    assert pending.pop(('b', 'server')) == ['c3']
+    assert pending.stats() == {'pairs': 0, 'queued': 4, 'expired': 3, 'dropped': 0}
+
+
+def test_per_pair_limit_drops_the_excess():
+    pending = PendingCandidates(limit=2)
+    assert pending.add(('a', 'b'), ['c1', 'c2', 'c3']) == 2
+    assert pending.add(('a', 'b'), ['c4']) == 0
+    assert pending.pop(('a', 'b')) == ['c1', 'c2']
+    assert pending.stats()['dropped'] == 2
+
+
+def test_pair_cap_refuses_new_pairs_until_one_expires(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(candidates.time, 'monotonic', clock)
+    pending = PendingCandidates(ttl=30.0, max_pairs=2)
+    pending.add(('a', 'server'), ['c1'])
+    clock.now += 5
+    pending.add(('b', 'server'), ['c2'])
+
+    assert pending.add(('c', 'server'), ['c3', 'c4']) is None
+    assert pending.add(('a', 'server'), ['c5']) == 1 # Existing pairs still take candidates
+    assert pending.stats()['dropped'] == 2
+    assert pending.retry_after() == 25
+
+    clock.now += 25
+    assert pending.add(('c', 'server'), ['c3']) == 1
+    assert len(pending) == 2
+
+
+GOOD = {'candidate': 'candidate:1 1 udp 2122260223 10.0.0.1 5000 typ host', 'sdpMid': '0', 'sdpMLineIndex': 0}
+END = {'candidate': '', 'sdpMid': '0', 'sdpMLineIndex': 0}
+BAD = {'candidate': 'candidate:1 1 udp', 'sdpMid': '0', 'sdpMLineIndex': 0}
+
+
+def test_empty_candidate_is_end_of_candidates():
+    assert server.parse_candidate(END) is None
+    assert server.parse_candidate(GOOD).ip == '10.0.0.1'
+
+
+def test_bad_entries_do_not_sink_their_batch():
+    key = ('batch-user', 'server')
+    result = asyncio.run(server.add_ice_candidate({'username': key[0], 'target': key[1],
+                                                   'candidates': [END, BAD, GOOD, 'junk']}))
+    assert result['queued'] == 2
+    assert [entry['index'] for entry in result['rejected']] == [1, 3]
+    queued = server.pending_candidates.pop(key)
+    assert queued[0].ip == '10.0.0.1'
+    assert queued[1] is None # End-of-candidates goes last, after every real candidate
+
+
+def test_batch_with_nothing_usable_is_refused():
+    with pytest.raises(web.HTTPBadRequest):
+        asyncio.run(server.add_ice_candidate({'username': 'batch-user', 'target': 'server', 'candidates': [BAD]}))
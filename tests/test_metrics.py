@@ -0,0 +1,46 @@
+import asyncio
+
+from metrics import MetricsRegistry
+
+
+def test_histogram_buckets_are_inclusive_and_cumulative():
+    registry = MetricsRegistry()
+    histogram = registry.histogram('wait_seconds', 'Wait', buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 1.0, 3.0):
+        histogram.observe(value)
+
+    lines = asyncio.run(registry.render()).splitlines()
+    assert lines == [
+        '# HELP wait_seconds Wait',
+        '# TYPE wait_seconds histogram',
+        'wait_seconds_bucket{le="0.1"} 2',
+        'wait_seconds_bucket{le="1"} 4',
+        'wait_seconds_bucket{le="+Inf"} 5',
+        'wait_seconds_sum 4.65',
+        'wait_seconds_count 5',
+    ]
+
+
+def test_labelled_histogram_puts_le_after_labels():
+    registry = MetricsRegistry()
+    histogram = registry.histogram('handler_seconds', 'Handler time', ('handler',), buckets=(0.5,))
+    histogram.labels('offer').observe(0.25)
+    histogram.labels('a"b').observe(2)
+
+    text = asyncio.run(registry.render())
+    assert 'handler_seconds_bucket{handler="offer",le="0.5"} 1\n' in text
+    assert 'handler_seconds_bucket{handler="offer",le="+Inf"} 1\n' in text
+    assert 'handler_seconds_sum{handler="offer"} 0.25\n' in text
+    assert 'handler_seconds_bucket{handler="a\\"b",le="0.5"} 0\n' in text
+    assert 'handler_seconds_count{handler="a\\"b"} 1\n' in text
+
+
+def test_collectors_run_before_rendering():
+    registry = MetricsRegistry()
+    gauge = registry.gauge('rooms', 'Rooms')
+
+    @registry.collector
+    async def collect():
+        gauge.set(3)
+
+    assert 'rooms 3\n' in asyncio.run(registry.render())
@@ -0,0 +1,26 @@
+from pathlib import Path
+
+from recording import MAX_NAME_LENGTH, Recording, directory_name
+from relay import TrackRelay
+
+
+def test_plain_usernames_are_kept():
+    assert directory_name('alice') == 'alice'
+    assert directory_name('bob.smith') == 'bob.smith'
+
+
+def test_usernames_never_leave_the_recording_directory(tmp_path):
+    for username in ('../evil', '..', '.', '/etc/x', 'a/../../b', '..\\evil', 'x\x00y', 'é' * 200):
+        name = directory_name(username)
+        assert '/' not in name and '\\' not in name and '\x00' not in name
+        assert name not in ('', '.', '..')
+        assert len(name) <= MAX_NAME_LENGTH
+
+        directory = Recording(username, [], tmp_path, TrackRelay()).directory
+        assert directory.parent == tmp_path
+        assert directory.resolve().parent == Path(tmp_path).resolve()
+
+
+def test_distinct_usernames_get_distinct_directories():
+    usernames = ['../evil', '%2E%2E%2Fevil', 'a/b', 'a%2Fb', 'x' * 300, 'x' * 299 + 'y']
+    assert len({directory_name(username) for username in usernames}) == len(usernames)
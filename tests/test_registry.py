@@ -0,0 +1,72 @@
+from registry import Roster, SessionRegistry
+
+
+def test_changes_since_returns_latest_event_per_user():
+    roster = Roster()
+    roster.join('a')
+    version = roster.version
+    roster.join('b')
+    roster.leave('a')
+    roster.join('c')
+    roster.leave('c')
+
+    assert roster.changes_since(version) == (['b'], ['a', 'c'])
+    assert roster.changes_since(roster.version) == ([], [])
+
+
+def test_changes_since_at_history_boundary():
+    roster = Roster(history=3)
+    for name in ('a', 'b', 'c', 'd', 'e'):
+        roster.join(name)
+
+    # Changes 3, 4 and 5 are kept: a client at version 2 can still catch up
+    assert roster.changes_since(2) == (['c', 'd', 'e'], [])
+    assert roster.changes_since(1) is None
+    assert roster.changes_since(roster.version + 1) is None
+
+
+def test_recreated_room_never_reuses_versions():
+    sessions = SessionRegistry()
+    sessions.join('a', 'x')
+    sessions.join('b', 'x')
+    seen = sessions.roster('x').version
+    sessions.leave('a')
+    sessions.leave('b')
+    assert sessions.roster('x') is None
+
+    sessions.join('c', 'x')
+    sessions.join('d', 'x')
+    roster = sessions.roster('x')
+    assert roster.version > seen
+    assert roster.changes_since(seen) is None # Too old: the client needs a snapshot
+    assert roster.names() == ('c', 'd')
+
+
+def test_pop_links_clears_both_indexes():
+    sessions = SessionRegistry()
+    sessions.add_link('b', 'a', 'pc-ba')
+    sessions.add_link('c', 'a', 'pc-ca')
+    sessions.add_link('a', 'b', 'pc-ab')
+    sessions.add_link('c', 'b', 'pc-cb')
+
+    removed = sessions.pop_links('a')
+    assert sorted(removed) == [(('a', 'b'), 'pc-ab'), (('b', 'a'), 'pc-ba'), (('c', 'a'), 'pc-ca')]
+    assert sessions.links() == [(('c', 'b'), 'pc-cb')]
+    assert sessions.subscribers_of('a') == []
+    assert sessions.subscribers_of('b') == [('c', 'pc-cb')]
+    assert sessions.subscription_count('b') == 0
+    assert sessions.subscription_count('c') == 1
+    assert sessions.pop_links('a') == []
+
+
+def test_remove_link_only_removes_the_registered_connection():
+    sessions = SessionRegistry()
+    assert sessions.add_link('b', 'a', 'old') is None
+    assert sessions.add_link('b', 'a', 'new') == 'old'
+
+    assert sessions.remove_link('b', 'a', 'old') is None
+    assert sessions.get_link('b', 'a') == 'new'
+    assert sessions.remove_link('b', 'a', 'new') == 'new'
+    assert sessions.link_count() == 0
+    assert sessions.pop_links('a') == []
+    assert sessions.pop_links('b') == []
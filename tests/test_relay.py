@@ -0,0 +1,110 @@
+import asyncio
+import fractions
+
+import av
+from aiortc.mediastreams import MediaStreamTrack
+
+from relay import TrackRelay
+
+VIDEO_TIME_BASE = fractions.Fraction(1, 90000)
+
+
+class CountingTrack(MediaStreamTrack):
+    """A source producing small frames whose pts start at `origin` and step by `step`."""
+
+    def __init__(self, kind, origin=0, step=3000, time_base=VIDEO_TIME_BASE):
+        super().__init__()
+        self.kind = kind
+        self.time_base = time_base
+        self.pts = origin
+        self.step = step
+        self.produced = []
+
+    async def recv(self):
+        await asyncio.sleep(0.001)
+        if self.kind == 'video':
+            frame = av.VideoFrame(16, 16, 'yuv420p')
+            frame.time_base = self.time_base
+        else:
+            frame = av.AudioFrame(format='s16', layout='mono', samples=960)
+            frame.sample_rate = 48000
+            frame.time_base = fractions.Fraction(1, 48000)
+        frame.pts = self.pts
+        self.pts += self.step
+        self.produced.append(frame)
+        return frame
+
+
+def test_subscribers_never_share_a_video_frame():
+    async def main():
+        relay = TrackRelay()
+        source = CountingTrack('video')
+        first, second = relay.subscribe(source), relay.subscribe(source)
+        frames = [(await first.recv(), await second.recv()) for _ in range(3)]
+        relay.remove_source(source)
+        return frames
+
+    for a, b in asyncio.run(main()):
+        assert a is not b
+        assert a.pts == b.pts
+        a.pict_type = av.video.frame.PictureType.I # What an encoder does on a keyframe request
+        assert b.pict_type != av.video.frame.PictureType.I
+
+
+def test_sole_subscriber_gets_the_frame_uncopied():
+    async def main():
+        relay = TrackRelay()
+        source = CountingTrack('video')
+        subscriber = relay.subscribe(source)
+        frame = await subscriber.recv()
+        relay.remove_source(source)
+        return frame, source.produced
+
+    frame, produced = asyncio.run(main())
+    assert frame is produced[0]
+
+
+def test_resubscribe_keeps_timestamps_increasing():
+    async def main():
+        relay = TrackRelay()
+        high = CountingTrack('video', origin=4_000_000_000)
+        low = CountingTrack('video', origin=12345)
+        relay.add_source(low)
+        subscriber = relay.subscribe(high)
+        stamps = []
+        for index in range(12):
+            frame = await subscriber.recv()
+            stamps.append((frame.pts, frame.time_base))
+            if index in (3, 7):
+                relay.resubscribe(subscriber, low if index == 3 else high)
+        relay.remove_source(high)
+        relay.remove_source(low)
+        return stamps
+
+    stamps = asyncio.run(main())
+    assert all(time_base == VIDEO_TIME_BASE for pts, time_base in stamps)
+    steps = [b[0] - a[0] for a, b in zip(stamps, stamps[1:])]
+    assert all(step > 0 for step in steps)
+    assert all(step % 3000 == 0 for step in steps[:3]) # Untouched until the first switch (frames may drop)
+    assert max(steps) < 90000 # No jump across a switch
+
+
+def test_rebase_converts_to_the_first_time_base():
+    async def main():
+        relay = TrackRelay()
+        video = CountingTrack('video', origin=900, step=3000)
+        coarse = CountingTrack('video', origin=500, step=1, time_base=fractions.Fraction(1, 30))
+        relay.add_source(coarse)
+        subscriber = relay.subscribe(video)
+        first = await subscriber.recv()
+        relay.resubscribe(subscriber, coarse)
+        second, third = await subscriber.recv(), await subscriber.recv()
+        relay.remove_source(video)
+        relay.remove_source(coarse)
+        return first, second, third
+
+    first, second, third = asyncio.run(main())
+    assert second.time_base == third.time_base == VIDEO_TIME_BASE
+    assert second.pts > first.pts
+    step = third.pts - second.pts
+    assert step > 0 and step % 3000 == 0 # Whole 1/30 s ticks on the 90 kHz timeline
@@ -0,0 +1,389 @@
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+
+import aiohttp
+from aiohttp import web, WSMsgType
+from aiortc import RTCPeerConnection, RTCSessionDescription
+
+# Signaling routes the front process forwards to the worker that owns the
+# requesting user. Every one of them carries the client's own `username`.
+ROUTED_PATHS = ['/offer', '/answer', '/ice-candidate', '/connect-peer', '/recording/start', '/recording/stop']
+
+# Internal cluster routes only accept requests from these addresses
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+# Response headers kept when a forwarded signaling reply is passed back to the client
+RELAYED_HEADERS = ('Content-Type', 'Retry-After')
+
+
+def shard_for(username, worker_count):
+    """Return the index of the worker that owns `username`."""
+    digest = hashlib.blake2b(username.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % worker_count
+
+
+def relayed_headers(resp):
+    """Return the headers of a forwarded reply that the client should see."""
+    headers = {name: resp.headers[name] for name in RELAYED_HEADERS if name in resp.headers}
+    headers.setdefault('Content-Type', 'text/plain')
+    return headers
+
+
+class ShardLink:
+    """A worker's view of the rest of the cluster.
+
+    Tracks which users live on other workers (as announced through the front
+    process) and pulls their media over cascaded peer connections, so that
+    each remote source is received once per worker and then fanned out
+    locally through the relay.
+    """
+
+    def __init__(self, index, worker_urls, front_url, relay):
+        self.index = index
+        self.worker_urls = worker_urls
+        self.front_url = front_url
+        self.relay = relay
+        self.remote_peers = {} # username -> {'worker': index, 'room': room, 'kinds': [...]}
+        self._cascades = {} # username -> asyncio.Task resolving to {'connection', 'tracks'}
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            # Only ever talks to cluster members on localhost; the front may be
+            # using a self-signed certificate.
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False))
+        return self._session
+
+    def is_remote(self, username):
+        return username in self.remote_peers
+
+    def owner_url(self, owner):
+        """Return the base URL of the process serving a `remote_peers` entry."""
+        return self.worker_urls[owner['worker']]
+
+    async def poll(self, rooms, complete=False):
+        """Return presence messages pulled for `rooms`; the front pushes them to shards instead."""
+        return []
+
+    async def publish(self, event, username, room, kinds=()):
+        """Announce a local join/leave to the other workers via the front."""
+        message = {'event': event, 'username': username, 'room': room, 'worker': self.index, 'kinds': list(kinds)}
+        try:
+            async with self.session.post(f"{self.front_url}/internal/presence", json=message) as resp:
+                if resp.status != 200:
+                    logging.warning("Front rejected %s presence for %s: %s", event, username, resp.status)
+        except aiohttp.ClientError as e:
+            logging.error("Failed to publish %s presence for %s: %s", event, username, e)
+
+    async def apply_presence(self, message):
+        """Update the remote roster; return True if `username` is newly known."""
+        username = message['username']
+        is_new = username not in self.remote_peers
+        if message['event'] == 'joined':
+            self.remote_peers[username] = {'worker': message['worker'], 'room': message.get('room'),
+                                           'kinds': message.get('kinds', [])}
+            if not is_new:
+                await self.drop_cascade(username) # Re-offer: the old media is gone
+            return is_new
+        self.remote_peers.pop(username, None)
+        await self.drop_cascade(username)
+        return False
+
+    async def remote_tracks(self, username):
+        """Return local relay sources carrying a remote user's tracks."""
+        task = self._cascades.get(username)
+        if task is None or (task.done() and (task.cancelled() or task.exception())):
+            task = self._cascades[username] = asyncio.ensure_future(self._open_cascade(username))
+        cascade = await asyncio.shield(task)
+        return cascade['tracks']
+
+    async def _open_cascade(self, username):
+        owner = self.remote_peers[username]
+        pc = RTCPeerConnection()
+        for kind in owner['kinds']:
+            pc.addTransceiver(kind, direction='recvonly')
+
+        @pc.on("iceconnectionstatechange")
+        async def on_iceconnectionstatechange():
+            if pc.iceConnectionState in ("failed", "closed", "disconnected"):
+                logging.warning("Cascade for %s from worker %s is %s", username, owner['worker'], pc.iceConnectionState)
+                await self.drop_cascade(username, pc)
+
+        try:
+            await pc.setLocalDescription(await pc.createOffer())
+            url = f"{self.owner_url(owner)}/internal/subscribe"
+            params = {'username': username, 'worker': self.index,
+                      'sdp': pc.localDescription.sdp, 'type': pc.localDescription.type}
+            async with self.session.post(url, json=params) as resp:
+                if resp.status != 200:
+                    raise web.HTTPBadGateway(text=f"Owner of {username} refused cascade: {await resp.text()}")
+                answer = await resp.json()
+            await pc.setRemoteDescription(RTCSessionDescription(sdp=answer['sdp'], type=answer['type']))
+        except Exception:
+            await pc.close()
+            raise
+
+        tracks = [t.receiver.track for t in pc.getTransceivers() if t.receiver.track is not None]
+        for track in tracks:
+            self.relay.add_source(track)
+        logging.info("Cascading %s tracks for %s from worker %s", len(tracks), username, owner['worker'])
+        return {'connection': pc, 'tracks': tracks}
+
+    async def drop_cascade(self, username, pc=None):
+        """Close the cascade carrying `username`'s media, if any."""
+        task = self._cascades.get(username)
+        if task is None or not task.done() or task.cancelled() or task.exception():
+            return
+        cascade = task.result()
+        if pc is not None and cascade['connection'] is not pc:
+            return # A newer cascade already replaced this one
+        del self._cascades[username]
+        for track in cascade['tracks']:
+            self.relay.remove_source(track)
+        await cascade['connection'].close()
+
+    async def close(self):
+        for username in list(self._cascades):
+            await self.drop_cascade(username)
+        if self._session is not None:
+            await self._session.close()
+
+
+def run_worker(index, worker_urls, front_url, app_options=None, log_options=None):
+    """Entry point of a worker process: serve one shard on localhost."""
+    import server
+    from logsetup import setup_logging
+
+    if log_options is not None:
+        setup_logging(**log_options) # Spawned workers start with a fresh logging setup
+
+    server.cluster = ShardLink(index, worker_urls, front_url, server.relay)
+    app = server.init_app(**(app_options or {}))
+
+    async def close_link(app_instance):
+        await server.cluster.close()
+    app.on_cleanup.append(close_link)
+
+    port = int(worker_urls[index].rsplit(':', 1)[1])
+    logging.info("Worker %s serving on %s", index, worker_urls[index])
+    web.run_app(app, host='127.0.0.1', port=port, print=None)
+
+
+async def route_signal(request):
+    """Forward a signaling POST to the worker owning the requesting user."""
+    body = await request.read()
+    try:
+        username = json.loads(body).get('username')
+    except (ValueError, AttributeError):
+        raise web.HTTPBadRequest(text='Invalid JSON')
+    if not username:
+        raise web.HTTPBadRequest(text='Username is required')
+
+    front = request.app['front']
+    url = front['worker_urls'][shard_for(username, len(front['worker_urls']))] + request.path
+    try:
+        async with front['session'].post(url, data=body, headers={'Content-Type': 'application/json'}) as resp:
+            return web.Response(status=resp.status, body=await resp.read(),
+                                headers=relayed_headers(resp))
+    except aiohttp.ClientError as e:
+        logging.error("Worker for %s unreachable: %s", username, e)
+        raise web.HTTPBadGateway(text='Worker unavailable')
+
+
+async def route_websocket(request):
+    """Splice a client's signaling WebSocket onto its owning worker."""
+    username = request.query.get('username')
+    if not username:
+        raise web.HTTPBadRequest(text='Username is required')
+
+    front = request.app['front']
+    url = front['worker_urls'][shard_for(username, len(front['worker_urls']))] + '/ws'
+    client_ws = web.WebSocketResponse(heartbeat=30)
+    await client_ws.prepare(request)
+
+    async def pump(source, destination):
+        async for msg in source:
+            if msg.type == WSMsgType.TEXT:
+                await destination.send_str(msg.data)
+            elif msg.type == WSMsgType.BINARY:
+                await destination.send_bytes(msg.data)
+            else:
+                break
+
+    try:
+        async with front['session'].ws_connect(url, params={'username': username}) as worker_ws:
+            pumps = [asyncio.ensure_future(pump(client_ws, worker_ws)),
+                     asyncio.ensure_future(pump(worker_ws, client_ws))]
+            _, pending = await asyncio.wait(pumps, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+    except aiohttp.ClientError as e:
+        logging.error("Worker socket for %s unavailable: %s", username, e)
+    await client_ws.close()
+    return client_ws
+
+
+def unlist(front, username):
+    """Drop `username` from the front's directory and its room."""
+    entry = front['directory'].pop(username, None)
+    if entry is None:
+        return
+    members = front['rooms'][entry['room']]
+    del members[username]
+    if not members:
+        del front['rooms'][entry['room']]
+
+
+async def relay_presence(request):
+    """Record a worker's join/leave event and rebroadcast it to the others."""
+    if request.remote not in LOCAL_ADDRESSES:
+        raise web.HTTPForbidden()
+    message = await request.json()
+    front = request.app['front']
+    username = message['username']
+    if message['event'] == 'joined':
+        unlist(front, username)
+        front['directory'][username] = {'worker': message['worker'], 'room': message['room']}
+        front['rooms'].setdefault(message['room'], {})[username] = None
+    elif front['directory'].get(username, {}).get('worker') == message['worker']:
+        unlist(front, username)
+
+    others = [url for i, url in enumerate(front['worker_urls']) if i != message['worker']]
+
+    async def deliver(url):
+        async with front['session'].post(f"{url}/internal/presence", json=message) as resp:
+            return resp.status
+    results = await asyncio.gather(*(deliver(url) for url in others), return_exceptions=True)
+    for url, result in zip(others, results):
+        if isinstance(result, Exception):
+            logging.warning("Failed to deliver presence to %s: %s", url, result)
+    return web.Response(status=200)
+
+
+async def list_cluster_peers(request):
+    """Answer /notify-new-peer from the front's cluster-wide directory of the user's room."""
+    import server
+
+    params = await request.json()
+    username = params.get('username')
+    if not username:
+        raise web.HTTPBadRequest(text='Username is required')
+    front = request.app['front']
+    entry = front['directory'].get(username)
+    room = entry['room'] if entry is not None else server.room_param(params)
+    return web.json_response({'peers': [peer for peer in front['rooms'].get(room, ()) if peer != username]})
+
+
+async def drain_cluster_room(request):
+    """Drain a room on every worker, since its users may be spread across shards."""
+    if request.remote not in LOCAL_ADDRESSES:
+        raise web.HTTPForbidden()
+    body = await request.read()
+    try:
+        room = json.loads(body).get('room')
+    except (ValueError, AttributeError):
+        raise web.HTTPBadRequest(text='Invalid JSON')
+    if not room:
+        raise web.HTTPBadRequest(text='Room is required')
+    front = request.app['front']
+
+    async def drain(url):
+        async with front['session'].post(f"{url}/rooms/drain", data=body,
+                                         headers={'Content-Type': 'application/json'}) as resp:
+            if resp.status == 200:
+                return (await resp.json())['drained']
+            if resp.status == 404:
+                return []
+            raise web.HTTPBadGateway(text=f"Worker {url} failed to drain: {await resp.text()}")
+    results = await asyncio.gather(*(drain(url) for url in front['worker_urls']), return_exceptions=True)
+
+    drained = []
+    for url, result in zip(front['worker_urls'], results):
+        if isinstance(result, Exception):
+            logging.warning("Failed to drain room on %s: %s", url, result)
+        else:
+            drained.extend(result)
+    if not drained:
+        raise web.HTTPNotFound(text=f"No users in room {room}")
+    return web.json_response({'room': room, 'drained': drained})
+
+
+async def cluster_audio_levels(request):
+    """Merge every worker's audio levels for a room, since its users may be spread across shards."""
+    front = request.app['front']
+
+    async def levels(url):
+        async with front['session'].get(f"{url}/audio-levels", params=request.query) as resp:
+            if resp.status == 404:
+                return None # Audio mixing is not enabled
+            if resp.status != 200:
+                raise web.HTTPBadGateway(text=f"Worker {url} failed to report levels: {await resp.text()}")
+            return await resp.json()
+    results = await asyncio.gather(*(levels(url) for url in front['worker_urls']), return_exceptions=True)
+
+    merged = {'levels': {}, 'speaking': set()}
+    reported = False
+    for url, result in zip(front['worker_urls'], results):
+        if isinstance(result, Exception):
+            logging.warning("Failed to read audio levels from %s: %s", url, result)
+        elif result is not None:
+            reported = True
+            for username, level in result['levels'].items():
+                merged['levels'][username] = max(level, merged['levels'].get(username, 0.0))
+            merged['speaking'].update(result['speaking'])
+    if not reported:
+        raise web.HTTPNotFound(text='Audio mixing is not enabled on this server')
+    return web.json_response({'levels': merged['levels'], 'speaking': sorted(merged['speaking'])})
+
+
+def init_front_app(worker_urls):
+    """Create the front application that routes requests to workers."""
+    import server
+
+    app = web.Application()
+    app['front'] = {'worker_urls': worker_urls, 'directory': {}, 'rooms': {}, 'session': None}
+
+    async def open_session(app_instance):
+        app_instance['front']['session'] = aiohttp.ClientSession()
+
+    async def close_session(app_instance):
+        await app_instance['front']['session'].close()
+    app.on_startup.append(open_session)
+    app.on_cleanup.append(close_session)
+
+    server.load_assets().add_routes(app.router)
+    for path in ROUTED_PATHS:
+        app.router.add_post(path, route_signal)
+    app.router.add_post('/notify-new-peer', list_cluster_peers)
+    app.router.add_post('/rooms/drain', drain_cluster_room)
+    app.router.add_get('/audio-levels', cluster_audio_levels)
+    app.router.add_get('/ws', route_websocket)
+    app.router.add_post('/internal/presence', relay_presence)
+    app.router.add_static('/static/', server.STATIC_PATH)
+    return app
+
+
+def run_cluster(worker_count, host, port, ssl_context=None, worker_base_port=9000, app_options=None, log_options=None):
+    """Start `worker_count` shard processes behind a routing front process.
+
+    `app_options` are passed to each worker's server.init_app().
+    """
+    front_url = f"http://127.0.0.1:{port}" if ssl_context is None else f"https://127.0.0.1:{port}"
+    worker_urls = [f"http://127.0.0.1:{worker_base_port + i}" for i in range(worker_count)]
+
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_worker, args=(i, worker_urls, front_url, app_options, log_options), daemon=True)
+                 for i in range(worker_count)]
+    for process in processes:
+        process.start()
+    try:
+        web.run_app(init_front_app(worker_urls), host=host, port=port, ssl_context=ssl_context)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()